@@ -1,34 +1,86 @@
 #!/usr/bin/env python3
 from os import environ
-import json
 import os
-from common import amqp_lib
-import pika  # or your preferred AMQP library
+import time
+from flask import Flask, request, jsonify
+from common import amqp_lib, codec, serving, webapp
+from activity_store import ActivityStore, ENTITY_KEYS
+
+app = Flask(__name__)
+webapp.setup_app(app)
 
 # Retrieve connection parameters from the environment if available.
 rabbit_host = environ.get("rabbit_host") or "localhost"
-rabbit_port = int(environ.get("rabbit_port")) or 5672
-exchange_name = environ.get("exchange_name") or "activity_log_exchange"
-exchange_type = environ.get("exchange_type") or "topic"
+rabbit_port = int(environ.get("rabbit_port") or 5672)
 queue_name = environ.get("queue_name") or "activity_log_queue"
 
+# Messages are written in batches: whichever of BATCH_SIZE messages or BATCH_INTERVAL seconds comes first
+BATCH_SIZE = int(environ.get("ACTIVITY_BATCH_SIZE") or 500)
+BATCH_INTERVAL = float(environ.get("ACTIVITY_BATCH_INTERVAL") or 1.0)
+DB_PATH = environ.get("ACTIVITY_DB_PATH") or "activity_log.db"
+MAX_LIMIT = 1000
+
+# The SQLite file is opened on first use, so importing the service does not create it
+store = ActivityStore(DB_PATH)
+
+
+def store_batch(messages):
+    """Decode a batch of (method, properties, body) and append it in one transaction."""
+    records = []
+    for method, properties, body in messages:
+        text = body.decode(errors="replace") if isinstance(body, bytes) else str(body)
+        try:
+            payload = codec.loads(body)
+        except ValueError:
+            payload = None  # plain-text activity, stored as is
+        ts = properties.timestamp or time.time()
+        records.append((ts, method.routing_key, method.exchange, text, payload))
+    store.append_many(records)
+    print(f"Stored {len(records)} activity message(s)")
+
+
+consumer = amqp_lib.BatchConsumer(
+    rabbit_host, rabbit_port, queue_name, store_batch,
+    batch_size=BATCH_SIZE, flush_interval=BATCH_INTERVAL, topology=amqp_lib.load_topology(),
+)
+serving.background(consumer.start, consumer.stop)
+
 
-def callback(channel, method, properties, body):
-    # required signature for the callback; no return
+@app.route("/", methods=["GET"])
+def health_check():
+    return jsonify({"code": 200, "status": "ok", "data": {"stored": store.count()}}), 200
+
+
+@app.route("/activity", methods=["GET"])
+def get_activity():
+    """
+    Query stored activity, newest first.
+    Filters: one entity id (recipientId, deliveryId, orderId, ...), routingKey,
+    since / until (epoch seconds) and limit.
+    """
     try:
-        error = json.loads(body)
-        print(f"JSON: {error}")
+        entity_key = next((key for key in ENTITY_KEYS if request.args.get(key)), None)
+        entity_id = request.args.get(entity_key) if entity_key else None
+        since = request.args.get("since", type=float)
+        until = request.args.get("until", type=float)
+        limit = request.args.get("limit", default=100, type=int)
+        if limit < 1:
+            return jsonify({"code": 400, "message": "limit must be a positive integer."}), 400
+        limit = min(limit, MAX_LIMIT)
+        data = store.query(
+            entity_key=entity_key,
+            entity_id=entity_id,
+            routing_key=request.args.get("routingKey"),
+            since=since,
+            until=until,
+            limit=limit,
+        )
+        return jsonify({"code": 200, "data": data, "message": f"Found {len(data)} activity records"}), 200
     except Exception as e:
-        print(f"Unable to parse JSON: {e=}")
-        print(f"Message: {body}")
-    print()
-    # channel.basic_ack(delivery_tag=method.delivery_tag)  # Ensure message is acknowledged
+        return jsonify({"code": 500, "message": str(e)}), 500
+
 
 if __name__ == "__main__":
     print(f"This is {os.path.basename(__file__)} - amqp consumer (Activity_Log)...")
-    try:
-        amqp_lib.start_consuming(
-            rabbit_host, rabbit_port, exchange_name, exchange_type ,queue_name, callback
-        )
-    except Exception as exception:
-        print(f"  Unable to connect to RabbitMQ.\n     {exception=}\n")
+    serving.start_background()
+    app.run(host="0.0.0.0", port=5001)
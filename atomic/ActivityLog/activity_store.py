@@ -0,0 +1,140 @@
+"""
+Append-only SQLite (WAL) store for activity log messages.
+
+Every message is one row in `activity`. The entity ids it mentions (recipientId, deliveryId,
+...) go into `activity_entity`, so looking up the history of one recipient or delivery
+is an index lookup rather than a scan of the raw bodies.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+# Keys whose values identify an entity worth indexing
+ENTITY_KEYS = ("recipientId", "deliveryId", "orderId", "matchId", "organId", "donorId", "driverId", "doctorId")
+# List-valued keys whose items are entity ids
+LIST_KEYS = {"listOfMatchId": "matchId", "listOfOrganId": "organId"}
+MAX_DEPTH = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS activity (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    routing_key TEXT NOT NULL,
+    exchange TEXT,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_activity_ts ON activity (ts);
+CREATE INDEX IF NOT EXISTS idx_activity_routing_key ON activity (routing_key, ts);
+CREATE TABLE IF NOT EXISTS activity_entity (
+    entity_key TEXT NOT NULL,
+    entity_id TEXT NOT NULL,
+    activity_id INTEGER NOT NULL REFERENCES activity (id)
+);
+CREATE INDEX IF NOT EXISTS idx_activity_entity ON activity_entity (entity_key, entity_id, activity_id);
+"""
+
+
+def extract_entities(payload, depth=0):
+    """Collect (entity_key, entity_id) pairs from a decoded message body."""
+    found = set()
+    if depth > MAX_DEPTH:
+        return found
+    if isinstance(payload, dict):
+        for key, value in payload.items():
+            if key in ENTITY_KEYS and isinstance(value, (str, int)):
+                found.add((key, str(value)))
+            elif key in LIST_KEYS and isinstance(value, list):
+                found.update((LIST_KEYS[key], str(item)) for item in value if isinstance(item, (str, int)))
+            elif isinstance(value, (dict, list)):
+                found |= extract_entities(value, depth + 1)
+    elif isinstance(payload, list):
+        for item in payload[:100]:
+            found |= extract_entities(item, depth + 1)
+    return found
+
+
+class ActivityStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        """
+        One connection per thread; WAL lets the API read while the consumer writes.
+        The database file is only created here, on first use, not at import.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            connection.row_factory = sqlite3.Row
+            self._local.connection = connection
+        return connection
+
+    def append_many(self, records):
+        """
+        Append records in one transaction. Each record is
+        (ts, routing_key, exchange, body_text, payload), where payload is the decoded body or None.
+        """
+        connection = self._connection()
+        with connection:
+            for ts, routing_key, exchange, body, payload in records:
+                cursor = connection.execute(
+                    "INSERT INTO activity (ts, routing_key, exchange, body) VALUES (?, ?, ?, ?)",
+                    (ts, routing_key, exchange, body),
+                )
+                entities = extract_entities(payload) if payload is not None else ()
+                if entities:
+                    connection.executemany(
+                        "INSERT INTO activity_entity (entity_key, entity_id, activity_id) VALUES (?, ?, ?)",
+                        [(key, entity_id, cursor.lastrowid) for key, entity_id in entities],
+                    )
+        return len(records)
+
+    def query(self, entity_key=None, entity_id=None, routing_key=None, since=None, until=None, limit=100):
+        """Most recent activity first, filtered by entity, routing key and time range."""
+        clauses, params = [], []
+        if entity_id is not None:
+            sql = ("SELECT a.* FROM activity_entity e JOIN activity a ON a.id = e.activity_id "
+                   "WHERE e.entity_key = ? AND e.entity_id = ?")
+            params += [entity_key, entity_id]
+        else:
+            sql = "SELECT a.* FROM activity a WHERE 1 = 1"
+        if routing_key is not None:
+            clauses.append("a.routing_key = ?")
+            params.append(routing_key)
+        if since is not None:
+            clauses.append("a.ts >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("a.ts < ?")
+            params.append(until)
+        for clause in clauses:
+            sql += " AND " + clause
+        sql += " ORDER BY a.id DESC LIMIT ?"
+        params.append(limit)
+        rows = self._connection().execute(sql, params).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+
+    def count(self):
+        return self._connection().execute("SELECT COUNT(*) FROM activity").fetchone()[0]
+
+    @staticmethod
+    def _row_to_dict(row):
+        body = row["body"]
+        try:
+            body = json.loads(body)
+        except ValueError:
+            pass
+        return {
+            "id": row["id"],
+            "timestamp": row["ts"],
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(row["ts"])),
+            "routingKey": row["routing_key"],
+            "exchange": row["exchange"],
+            "message": body,
+        }
@@ -2,14 +2,25 @@ from datetime import datetime
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from os import environ
+import json
 import os
-from azure.communication.email import EmailClient
 import re
+from common import amqp_lib, serving, webapp
+from email_dispatch import AzureTransport, EmailDispatcher, LocalTransport, QueueFull
 
 app = Flask(__name__)
 CORS(app)
+webapp.setup_app(app)
 
 CONNECTION_STRING = os.environ.get("AZURE_CONNECTION_STRING") or "null"
+# "azure" sends through Azure Communication Services, "local" only logs (for testing)
+EMAIL_TRANSPORT = environ.get("EMAIL_TRANSPORT") or "azure"
+EMAIL_WORKERS = int(environ.get("EMAIL_WORKERS") or 4)
+EMAIL_QUEUE_SIZE = int(environ.get("EMAIL_QUEUE_SIZE") or 1000)
+EMAIL_LOCAL_DELAY = float(environ.get("EMAIL_LOCAL_DELAY") or 0)
+rabbit_host = environ.get("rabbit_host") or "localhost"
+rabbit_port = int(environ.get("rabbit_port") or 5672)
+MAX_BATCH = 100
 
 def get_sender_address():
     """
@@ -23,80 +34,128 @@ def get_sender_address():
             return f"DoNotReply@{domain.group(1)}.communication.azure.com"
     except Exception as e:
         print(f"Error generating sender address: {e}")
-    
+
     # Fallback to a default sender address
     return "DoNotReply@azurecomm.net"
 
+SENDER_ADDRESS = get_sender_address()
+
+if EMAIL_TRANSPORT == "local":
+    transport = LocalTransport(EMAIL_LOCAL_DELAY)
+else:
+    transport = AzureTransport(CONNECTION_STRING)
+# POST /email answers 202 before sending, so failed sends are reported here as email.error
+publisher = amqp_lib.Publisher(rabbit_host, rabbit_port)
+
+def report_failure(job, index, error):
+    message = job.messages[index]
+    publisher.publish(
+        exchange="error_handling_exchange",
+        routing_key="email.error",
+        body=json.dumps({
+            "code": 500,
+            "message": f"Failed to send email: {error}",
+            "jobId": job.job_id,
+            "recipients": [r.get("address") for r in message["recipients"]["to"]],
+            "subject": message["content"].get("subject"),
+        }),
+    )
+
+dispatcher = EmailDispatcher(
+    transport, workers=EMAIL_WORKERS, max_queued=EMAIL_QUEUE_SIZE, on_failure=report_failure
+)
+# Registered first so it is closed last, after the dispatcher has drained
+serving.background(publisher.start, publisher.close)
+serving.background(dispatcher.start, dispatcher.stop)
+
+def validate_message(message):
+    """Return an error message for an invalid email message, or None; fills in the sender address."""
+    if not isinstance(message, dict) or not all(key in message for key in ['recipients', 'content']):
+        return "Invalid email message structure"
+    # Use dynamically generated sender address if not provided
+    if 'senderAddress' not in message or not message['senderAddress']:
+        message['senderAddress'] = SENDER_ADDRESS
+    if not message['recipients'].get('to'):
+        return "No recipients specified"
+    if not message['content'].get('subject') or not message['content'].get('plainText'):
+        return "Missing email subject or body"
+    return None
+
+def transport_error():
+    if transport.name == "azure" and (CONNECTION_STRING == "null" or not CONNECTION_STRING):
+        print("ERROR: No valid Azure connection string provided")
+        return jsonify({"code": 500, "message": "Azure connection string not configured"}), 500
+    return None
+
+def submit(messages):
+    try:
+        job = dispatcher.submit(messages)
+    except QueueFull as e:
+        return jsonify({"code": 503, "message": str(e)}), 503
+    return jsonify({
+        "code": 202,
+        "message": f"Queued {len(messages)} email(s)",
+        "data": {"jobId": job.job_id, "status": job.status},
+    }), 202
+
 @app.route("/", methods=["GET"])
 def health_check():
-    return jsonify({"code": 200, "status": "ok"}), 200
+    return jsonify({"code": 200, "status": "ok", "transport": transport.name, "queued": dispatcher.pending()}), 200
 
 @app.route("/email", methods=["POST"])
 def send_email():
+    """Validate one email message, queue it and return its job id without waiting for the send."""
     try:
         message = request.get_json()
         print("Received email request:", message)
-        
-        connection_string = CONNECTION_STRING
-        if connection_string == "null" or not connection_string:
-            print("ERROR: No valid Azure connection string provided")
-            return jsonify({"code": 500, "message": "Azure connection string not configured"}), 500
-        
-        try:
-            client = EmailClient.from_connection_string(connection_string)
-            print("Email client created successfully")
-        except Exception as client_error:
-            print(f"Detailed client creation error: {str(client_error)}")
-            print(f"Error type: {type(client_error)}")
-            return jsonify({"code": 500, "message": f"Failed to create email client: {str(client_error)}"}), 500
-        
-        try:
-            # Validate message structure
-            if not all(key in message for key in ['recipients', 'content']):
-                print("Invalid message structure")
-                return jsonify({"code": 400, "message": "Invalid email message structure"}), 400
-            
-            # Use dynamically generated sender address if not provided
-            if 'senderAddress' not in message or not message['senderAddress']:
-                message['senderAddress'] = get_sender_address()
-            
-            # Validate recipients
-            if not message['recipients'].get('to') or not message['recipients']['to']:
-                print("No recipients specified")
-                return jsonify({"code": 400, "message": "No recipients specified"}), 400
-            
-            # Validate content
-            if not message['content'].get('subject') or not message['content'].get('plainText'):
-                print("Missing subject or plain text content")
-                return jsonify({"code": 400, "message": "Missing email subject or body"}), 400
-
-            # Send email
-            poller = client.begin_send(message)
-            result = poller.result()
-            print("Message sent successfully:", result.get("id", "No ID provided"))
-            return jsonify({
-                "code": 200, 
-                "message": "Email sent successfully",
-                "details": result
-            }), 200
-        
-        except Exception as send_error:
-            print(f"Detailed send error: {str(send_error)}")
-            print(f"Error type: {type(send_error)}")
-            print(f"Full message sent: {message}")
-            return jsonify({
-                "code": 500, 
-                "message": f"Failed to send email: {str(send_error)}",
-                "error_type": str(type(send_error))
-            }), 500
-    
+        error = transport_error()
+        if error:
+            return error
+        invalid = validate_message(message)
+        if invalid:
+            print(invalid)
+            return jsonify({"code": 400, "message": invalid}), 400
+        return submit([message])
     except Exception as ex:
         print(f"Unexpected error processing email request: {str(ex)}")
         return jsonify({
-            "code": 500, 
+            "code": 500,
             "message": f"Unexpected error: {str(ex)}"
         }), 500
 
+@app.route("/email/batch", methods=["POST"])
+def send_email_batch():
+    """
+    Queue several email messages as one job.
+    Body: {"messages": [<email message>, ...]}; every message is validated before any is queued.
+    """
+    try:
+        data = request.get_json() or {}
+        messages = data.get("messages")
+        if not isinstance(messages, list) or not messages:
+            return jsonify({"code": 400, "message": "messages must be a non-empty list"}), 400
+        if len(messages) > MAX_BATCH:
+            return jsonify({"code": 400, "message": f"At most {MAX_BATCH} messages per batch"}), 400
+        error = transport_error()
+        if error:
+            return error
+        for index, message in enumerate(messages):
+            invalid = validate_message(message)
+            if invalid:
+                return jsonify({"code": 400, "message": f"messages[{index}]: {invalid}"}), 400
+        return submit(messages)
+    except Exception as ex:
+        print(f"Unexpected error processing email batch: {str(ex)}")
+        return jsonify({"code": 500, "message": f"Unexpected error: {str(ex)}"}), 500
+
+@app.route("/email/jobs/<string:job_id>", methods=["GET"])
+def get_email_job(job_id):
+    job = dispatcher.get(job_id)
+    if job is None:
+        return jsonify({"code": 404, "message": f"Email job {job_id} not found"}), 404
+    return jsonify({"code": 200, "data": job.to_dict()}), 200
+
 if __name__ == '__main__':
     print("This is flask for " + os.path.basename(__file__) + ": manage azure emails ...")
-    app.run(host='0.0.0.0', port=5014, debug=True)
\ No newline at end of file
+    serving.start_background()
+    app.run(host='0.0.0.0', port=5014, debug=True, use_reloader=False)
@@ -0,0 +1,170 @@
+"""
+Background email dispatch for the AzureEmail service.
+
+Requests are turned into jobs and put on a bounded queue; a fixed pool of worker threads
+sends them through one long-lived transport. The Azure transport creates its EmailClient
+once and reuses it; the local transport only logs, for running the stack without Azure.
+"""
+
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+PENDING = "pending"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+PARTIAL = "partial"
+
+
+class QueueFull(Exception):
+    """Raised when the dispatch queue cannot take more jobs."""
+
+
+class AzureTransport:
+    name = "azure"
+
+    def __init__(self, connection_string):
+        self.connection_string = connection_string
+        self._client = None
+        self._lock = threading.Lock()
+
+    def client(self):
+        """Create the EmailClient on first use and keep it for the life of the process."""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from azure.communication.email import EmailClient
+                    self._client = EmailClient.from_connection_string(self.connection_string)
+                    print("Email client created successfully")
+        return self._client
+
+    def send(self, message):
+        poller = self.client().begin_send(message)
+        return poller.result()
+
+
+class LocalTransport:
+    """Stand-in transport: prints the message and reports success after an optional delay."""
+    name = "local"
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def send(self, message):
+        if self.delay:
+            time.sleep(self.delay)
+        recipients = [r.get("address") for r in message["recipients"]["to"]]
+        print(f"[local transport] to={recipients} subject={message['content']['subject']!r}")
+        return {"id": str(uuid.uuid4()), "status": "Succeeded"}
+
+
+class EmailJob:
+    def __init__(self, messages):
+        self.job_id = str(uuid.uuid4())
+        self.created = time.time()
+        self.finished = None
+        self.results = [{"status": PENDING} for _ in messages]
+        self.messages = messages
+        self._remaining = len(messages)
+
+    @property
+    def status(self):
+        statuses = {result["status"] for result in self.results}
+        if statuses <= {PENDING}:
+            return PENDING
+        if PENDING in statuses or RUNNING in statuses:
+            return RUNNING
+        if statuses == {SUCCEEDED}:
+            return SUCCEEDED
+        if statuses == {FAILED}:
+            return FAILED
+        return PARTIAL
+
+    def to_dict(self):
+        return {
+            "jobId": self.job_id,
+            "status": self.status,
+            "total": len(self.results),
+            "sent": sum(1 for result in self.results if result["status"] == SUCCEEDED),
+            "failed": sum(1 for result in self.results if result["status"] == FAILED),
+            "created": self.created,
+            "finished": self.finished,
+            "results": self.results,
+        }
+
+
+class EmailDispatcher:
+    """
+    Bounded queue of (job, index) items drained by `workers` threads. Callers only get a
+    job id back, so on_failure(job, index, error), if given, is called from the worker
+    thread for every message that could not be sent.
+    """
+
+    def __init__(self, transport, workers=4, max_queued=1000, max_jobs=10000, on_failure=None):
+        self.transport = transport
+        self.on_failure = on_failure
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"email-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=15):
+        """Wait up to timeout seconds for queued work to finish."""
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.05)
+
+    def submit(self, messages):
+        """Queue a job for the messages and return it; raises QueueFull if there is no room."""
+        job = EmailJob(messages)
+        with self._lock:
+            if self._queue.maxsize and self._queue.qsize() + len(messages) > self._queue.maxsize:
+                raise QueueFull(f"Email queue is full ({self._queue.qsize()} pending)")
+            self._jobs[job.job_id] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+            for index in range(len(messages)):
+                self._queue.put_nowait((job, index))
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            job, index = self._queue.get()
+            result = job.results[index]
+            result["status"] = RUNNING
+            try:
+                details = self.transport.send(job.messages[index])
+                result.update({"status": SUCCEEDED, "id": details.get("id")})
+            except Exception as e:
+                print(f"Failed to send email in job {job.job_id}: {e}")
+                result.update({"status": FAILED, "error": str(e)})
+                if self.on_failure is not None:
+                    try:
+                        self.on_failure(job, index, e)
+                    except Exception as report_error:
+                        print(f"Failed to report email failure in job {job.job_id}: {report_error}")
+            finally:
+                with self._lock:
+                    job._remaining -= 1
+                    if job._remaining == 0:
+                        job.finished = time.time()
+                        job.messages = None  # bodies are not needed once sent
+                self._queue.task_done()
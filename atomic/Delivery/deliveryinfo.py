@@ -1,31 +1,26 @@
 from datetime import datetime
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import firebase_admin
-from firebase_admin import credentials, firestore
 import os
 import uuid
+from common.conditional import etag_response
+from common.export import ndjson_response, wants_ndjson
+from common.models import Model
+from common.pagination import page_args
+from common.repository import NotFound, open_repository
+from common.webapp import setup_app
 
 # Initialize Flask app
 app = Flask(__name__)
 CORS(app)
-
-# Load Firestore credentials from environment variable
-key_path = os.getenv("DELIVERY_DB_KEY")
-
-if not key_path or not os.path.isfile(key_path):
-    raise FileNotFoundError(f"Could not find the Firebase JSON at {key_path}")
-
-cred = credentials.Certificate(key_path)
-firebase_app = firebase_admin.initialize_app(cred)
-
-print("Firestore initialized successfully for DeliveryInfo!")
-
-db = firestore.client()
+setup_app(app)
 
 # Firestore collection for delivery orders
 DELIVERY_COLLECTION = "delivery_orders"
 
+# Firebase credentials are only needed when DATA_BACKEND is firestore
+deliveries = open_repository(DELIVERY_COLLECTION, key_path=os.getenv("DELIVERY_DB_KEY"))
+
 # # Function to generate unique orderID
 # def generate_order_id(pickup_location, pickup_date):
 #     """Generates a unique Order ID in the format: <pickup_location><pickup_date><4-digit_increment>"""
@@ -72,69 +67,47 @@ DELIVERY_COLLECTION = "delivery_orders"
 #     return True
 
 # DeliveryInfo Class
-class DeliveryInfo:
-    def __init__(self, order_id, status, pickup, pickup_time, destination, destination_time, polyline, driverCoord, driverId, organType, doctorId, matchId):
-        self.order_id = order_id
-        self.status = status
-        self.pickup = pickup
-        self.pickup_time = pickup_time
-        self.destination = destination
-        self.destination_time = destination_time
-        self.polyline = polyline
-        self.driverCoord = driverCoord
-        self.driverId = driverId
-        self.organType = organType
-        self.doctorId = doctorId
-        self.matchId = matchId
-
-    def to_dict(self):
-        """Convert the object to a Firestore-compatible dictionary."""
-        return {
-            "orderID": self.order_id,
-            "status": self.status,
-            "pickup": self.pickup,
-            "pickup_time": self.pickup_time,
-            "destination": self.destination,
-            "destination_time": self.destination_time,
-            "polyline": self.polyline,
-            "driverCoord": self.driverCoord,
-            "driverId": self.driverId,
-            "organType": self.organType,
-            "doctorId" : self.doctorId,
-            "matchId": self.matchId
-        }
-
-    @staticmethod
-    def from_dict(order_id, data):
-        """Create a DeliveryInfo object from Firestore document data."""
-        return DeliveryInfo(
-            order_id=order_id,
-            status=data["status"],
-            pickup=data["pickup"],
-            pickup_time=data["pickup_time"],
-            destination=data["destination"],
-            destination_time=data["destination_time"],
-            polyline=data["polyline"],
-            driverCoord=data["driverCoord"],
-            driverId=data.get("driverId", ""),
-            organType=data["organType"],
-            doctorId=data.get("doctorId", ""),
-            matchId=data.get("matchId", "") 
-        )
-
-# 📌 Route: Get all delivery orders
+class DeliveryInfo(Model):
+    __slots__ = ("order_id", "status", "pickup", "pickup_time", "destination", "destination_time", "polyline",
+                 "driverCoord", "driverId", "organType", "doctorId", "matchId")
+    ID = ("orderID", "order_id")
+    FIELDS = (
+        ("status", "status", str, True, None),
+        ("pickup", "pickup", None, True, None),
+        ("pickup_time", "pickup_time", None, True, None),
+        ("destination", "destination", None, True, None),
+        ("destination_time", "destination_time", None, True, None),
+        ("polyline", "polyline", None, True, None),
+        ("driverCoord", "driverCoord", None, True, None),
+        ("driverId", "driverId", str, False, ""),
+        ("organType", "organType", str, True, None),
+        ("doctorId", "doctorId", str, False, ""),
+        ("matchId", "matchId", str, False, ""),
+    )
+
+def delivery_row(doc_id, delivery_data):
+    # Stored documents that already have exactly the model's fields are returned as they are
+    return DeliveryInfo.row(doc_id, delivery_data)
+
+def projected_row(doc_id, delivery_data):
+    # A projection is partial, so it cannot go through DeliveryInfo
+    return delivery_data
+
+# 📌 Route: Get all delivery orders (paged with limit/startAfter/fields, or NDJSON)
 @app.route("/deliveryinfo", methods=["GET"])
 def get_all_deliveries():
     try:
-        deliveries_ref = db.collection(DELIVERY_COLLECTION)
-        docs = deliveries_ref.get()
-        deliveries = {}
-
-        for doc in docs:
-            delivery_obj = DeliveryInfo.from_dict(doc.id, doc.to_dict())
-            deliveries[doc.id] = delivery_obj.to_dict()  # Convert back to dict
+        paging = page_args(request.args)
+    except ValueError as e:
+        return jsonify({"code": 400, "message": str(e)}), 400
+    row = projected_row if paging["fields"] else delivery_row
+    if wants_ndjson(request):
+        return ndjson_response(deliveries.stream(**paging), row)
+    try:
+        docs, next_start_after = deliveries.page(**paging)
+        all_deliveries = {doc_id: row(doc_id, delivery_data) for doc_id, delivery_data in docs}
         
-        return jsonify({"code": 200, "data": deliveries}), 200
+        return jsonify({"code": 200, "data": all_deliveries, "nextStartAfter": next_start_after}), 200
     
     except Exception as e:
         return jsonify({"code": 500, "message": str(e)}), 500
@@ -144,12 +117,11 @@ def get_all_deliveries():
 @app.route("/deliveryinfo/<string:order_id>", methods=["GET"])
 def get_delivery(order_id):
     try:
-        delivery_ref = db.collection(DELIVERY_COLLECTION).document(order_id)
-        doc = delivery_ref.get()
+        delivery_data, version = deliveries.get_with_version(order_id)
         
-        if doc.exists:
-            delivery_obj = DeliveryInfo.from_dict(order_id, doc.to_dict())
-            return jsonify({"code": 200, "data": delivery_obj.to_dict()}), 200
+        if delivery_data is not None:
+            delivery_obj = DeliveryInfo.from_dict(order_id, delivery_data)
+            return etag_response(request, {"code": 200, "data": delivery_obj.to_dict()}, version)
 
         else:
             return jsonify({"code": 404, "message": "Delivery order not found"}), 404
@@ -185,7 +157,7 @@ def create_delivery():
         
         # Add document to Firestore with auto-generated ID
         delivery_id = str(uuid.uuid4())
-        db.collection(DELIVERY_COLLECTION).document(delivery_id).set(delivery_data)
+        deliveries.set(delivery_id, delivery_data)
         
         print(f"Created delivery with ID: {delivery_id}")
         
@@ -204,12 +176,6 @@ def create_delivery():
 @app.route("/deliveryinfo/<string:order_id>", methods=["PUT"])
 def update_delivery(order_id):
     try:
-        delivery_ref = db.collection(DELIVERY_COLLECTION).document(order_id)
-        doc = delivery_ref.get()
-        
-        if not doc.exists:
-            return jsonify({"code": 404, "message": "Delivery order not found"}), 404
-
         update_data = request.get_json()
 
         # Ensure the update follows the expected structure
@@ -219,9 +185,6 @@ def update_delivery(order_id):
         if not filtered_data:
             return jsonify({"code": 400, "message": "No valid fields to update"}), 400
 
-        # Retrieve existing data
-        existing_data = doc.to_dict()
-
         # # Validate pickup_time (only if it exists)
         # pickup_dt = None
         # if "pickup_time" in filtered_data and filtered_data["pickup_time"]:
@@ -249,9 +212,11 @@ def update_delivery(order_id):
         #         return jsonify({"code": 400, "message": "destination_time should be empty if status is 'Awaiting pickup' or 'In progress'."}), 400
 
         # Update Firestore document
-        db.collection(DELIVERY_COLLECTION).document(order_id).set(filtered_data, merge=True)
+        deliveries.update(order_id, filtered_data)
 
         return jsonify({"code": 200, "message": "Delivery order updated successfully"}), 200
+    except NotFound:
+        return jsonify({"code": 404, "message": "Delivery order not found"}), 404
     
     except Exception as e:
         print(f"Error updating delivery: {e}")  # Log the error
@@ -261,14 +226,10 @@ def update_delivery(order_id):
 @app.route("/deliveryinfo/<string:order_id>", methods=["DELETE"])
 def delete_delivery(order_id):
     try:
-        delivery_ref = db.collection(DELIVERY_COLLECTION).document(order_id)
-        doc = delivery_ref.get()
-        
-        if not doc.exists:  # Fixed: removed parentheses
-            return jsonify({"code": 404, "message": "Delivery order not found"}), 404
-        
-        delivery_ref.delete()
+        deliveries.delete(order_id, must_exist=True)
         return jsonify({"code": 200, "message": "Delivery order deleted successfully"}), 200
+    except NotFound:
+        return jsonify({"code": 404, "message": "Delivery order not found"}), 404
     except Exception as e:
         return jsonify({"code": 500, "message": str(e)}), 500
 
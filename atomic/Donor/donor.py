@@ -1,105 +1,64 @@
 from datetime import datetime
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
 from os import environ
 import os
+from common.conditional import etag_response
+from common.export import ndjson_response, wants_ndjson
+from common.models import Model
+from common.pagination import page_args
+from common.repository import AlreadyExists, NotFound, open_repository
+from common.webapp import setup_app
 
 
 app = Flask(__name__)
 
 CORS(app)
-
-# Load the key from an environment variable
-key_path = os.getenv("DONOR_DB_KEY")
-
-if not key_path or not os.path.isfile(key_path):
-    raise FileNotFoundError(f"Could not find the Firebase JSON at {key_path}")
-# Initialize Firestore
-cred = credentials.Certificate(key_path)
-firebase_app = firebase_admin.initialize_app(cred)
-
-print("Firestore initialized successfully for Donor!")
-
-
-db = firestore.client()
-
-
-class Donor:
-    def __init__(self, donor_id, first_name, last_name ,date_of_birth, age, nric, email, address, datetime_of_death,
-                 gender, blood_type, organs, medical_history, allergies, nok_contact):
-        self.donor_id = donor_id
-        self.first_name = first_name
-        self.last_name = last_name
-        self.date_of_birth = date_of_birth
-        self.age = age
-        self.nric = nric
-        self.email = email
-        self.address = address
-        self.datetime_of_death = datetime_of_death
-        self.gender = gender
-        self.blood_type = blood_type
-        self.organs = organs  # List of organId
-        self.medical_history = medical_history  # List of medical history records
-        self.allergies = allergies  # List of allergies
-        self.nok_contact = nok_contact  # Next of kin contact details
-
-    def to_dict(self):
-        """Convert the object to a Firestore-compatible dictionary."""
-        return {
-            "firstName": self.first_name,
-            "lastName": self.last_name,
-            "dateOfBirth": self.date_of_birth,
-            "age": self.age,
-            "nric": self.nric,
-            "email": self.email,
-            "address": self.address,
-            "datetimeOfDeath": self.datetime_of_death,
-            "gender": self.gender,
-            "bloodType": self.blood_type,
-            "organs": self.organs,
-            "medicalHistory": self.medical_history,
-            "allergies": self.allergies,
-            "nokContact": self.nok_contact
-        }
-
-    @staticmethod
-    def from_dict(donor_id, data):
-        """Create a Donor object from Firestore document data."""
-        return Donor(
-            donor_id=donor_id,
-            first_name=data["firstName"],
-            last_name=data["lastName"],
-            date_of_birth=data["dateOfBirth"],
-            age=data["age"],
-            nric=data["nric"],
-            email=data["email"],
-            address=data["address"],
-            datetime_of_death=data["datetimeOfDeath"],
-            gender=data["gender"],
-            blood_type=data["bloodType"],
-            organs=data["organs"],
-            medical_history=data["medicalHistory"],
-            allergies=data["allergies"],
-            nok_contact=data["nokContact"]
-        )
+setup_app(app)
+
+# Firebase credentials are only needed when DATA_BACKEND is firestore
+donors = open_repository("donors", key_path=os.getenv("DONOR_DB_KEY"))
+
+
+class Donor(Model):
+    __slots__ = ("donor_id", "first_name", "last_name", "date_of_birth", "age", "nric", "email", "address",
+                 "datetime_of_death", "gender", "blood_type", "organs", "medical_history", "allergies", "nok_contact")
+    ID = (None, "donor_id")
+    FIELDS = (
+        ("firstName", "first_name", str, True, None),
+        ("lastName", "last_name", str, True, None),
+        ("dateOfBirth", "date_of_birth", None, True, None),
+        ("age", "age", None, True, None),
+        ("nric", "nric", str, True, None),
+        ("email", "email", str, True, None),
+        ("address", "address", str, True, None),
+        ("datetimeOfDeath", "datetime_of_death", None, True, None),
+        ("gender", "gender", str, True, None),
+        ("bloodType", "blood_type", str, True, None),
+        ("organs", "organs", list, True, None),  # List of organId
+        ("medicalHistory", "medical_history", list, True, None),  # List of medical history records
+        ("allergies", "allergies", list, True, None),  # List of allergies
+        ("nokContact", "nok_contact", dict, True, None),  # Next of kin contact details
+    )
+
+def donor_row(doc_id, donor_data):
+    donor_data["donorID"] = doc_id  # Add document ID
+    return donor_data
 
 @app.route("/donor", methods=['GET'])
 def get_all():
+    """All donors keyed by id; accepts limit, startAfter and fields, or streams NDJSON."""
+    try:
+        paging = page_args(request.args)
+    except ValueError as e:
+        return jsonify({"code": 400, "message": str(e)}), 400
+    if wants_ndjson(request):
+        return ndjson_response(donors.stream(**paging), donor_row)
     # Read data from firebase
     try:
-        donors_ref = db.collection("donors")
-        # docs = donors_ref.stream()
-        docs = donors_ref.get()
-        donors = {};
-
-        for doc in docs:
-            donor_data = doc.to_dict()
-            donor_data["donorID"] = doc.id  # Add document ID
-            donors[doc.id] = donor_data
-        return jsonify({"code":200, "data": donors}), 200
+        docs, next_start_after = donors.page(**paging)
+        all_donors = {doc_id: donor_row(doc_id, donor_data) for doc_id, donor_data in docs}
+        return jsonify({"code":200, "data": all_donors, "nextStartAfter": next_start_after}), 200
     except Exception as e:
         return jsonify({"code":500, "message": str(e)}), 500
 
@@ -107,11 +66,10 @@ def get_all():
 @app.route("/donor/<string:donorId>")
 def get_donor(donorId):
     try:
-        donors_ref = db.collection("donors").document(donorId)
-        doc = donors_ref.get()
-        if doc.exists:
-            donor_obj = Donor.from_dict(donorId, doc.to_dict())
-            return {"code":200, "data": donor_obj.to_dict()}  # Convert back to JSON-friendly format
+        donor_data, version = donors.get_with_version(donorId)
+        if donor_data is not None:
+            donor_obj = Donor.from_dict(donorId, donor_data)
+            return etag_response(request, {"code":200, "data": donor_obj.to_dict()}, version)
         else:
             return jsonify({"code":404, "message": "Donor does not exist"}), 404
 
@@ -122,23 +80,10 @@ def get_donor(donorId):
 @app.route("/donor/<string:donorId>", methods=['PUT'])
 def update_donor(donorId):
     try:
-        donors_ref = db.collection("donors").document(donorId)
-        doc = donors_ref.get()
-        if not doc.exists:
-            return jsonify(
-                {
-                    "code": 404,
-                    "data": {
-                        "donorId": donorId
-                    },
-                    "message": "Donor not found."
-                }
-            ), 404
-
         # update status
         new_data = request.get_json()
         if new_data:
-            db.collection("donors").document(donorId).set(new_data["data"], merge=True)
+            donors.update(donorId, new_data["data"])
             return jsonify(
                 {
                     "code": 200,
@@ -150,6 +95,16 @@ def update_donor(donorId):
                 "code": 400,
                 "message": "No data provided for update."
             }), 400
+    except NotFound:
+        return jsonify(
+            {
+                "code": 404,
+                "data": {
+                    "donorId": donorId
+                },
+                "message": "Donor not found."
+            }
+        ), 404
     except Exception as e:
         print("Error: {}".format(str(e)))
         return jsonify(
@@ -177,15 +132,6 @@ def create_donor():
                 "message": "Donor Id is required."
             }), 400
 
-        # Reference to the donor document in Firestore
-        donor_ref = db.collection("donors").document(donor_id)
-        if donor_ref.get().exists:
-            return jsonify({
-                "code": 409,
-                "data": {"donorId": donor_id},
-                "message": "Donor already exists."
-            }), 409
-
         # Create a new Donor object
         new_donor = Donor(
             donor_id=donor_id,
@@ -206,7 +152,7 @@ def create_donor():
         )
 
         # Save the new donor to Firestore
-        donor_ref.set(new_donor.to_dict())
+        donors.create(donor_id, new_donor.to_dict())
 
         # Return success response
         return jsonify({
@@ -215,6 +161,12 @@ def create_donor():
             "message": "Donor created successfully."
         }), 201
 
+    except AlreadyExists:
+        return jsonify({
+            "code": 409,
+            "data": {"donorId": donor_id},
+            "message": "Donor already exists."
+        }), 409
     except Exception as e:
         print("Error: {}".format(str(e)))
         return jsonify({
@@ -227,22 +179,17 @@ def create_donor():
 def delete_donor(donorId):
     """Delete an donor from Firestore."""
     try:
-        donor_ref = db.collection("donors").document(donorId)
-        doc = donor_ref.get()
-
-        if not doc.exists:
-            return jsonify({"code": 404, "message": "Donor not found"}), 404
-
         # Delete the organ document from Firestore
-        donor_ref.delete()
+        donors.delete(donorId, must_exist=True)
 
         return jsonify({"code": 200, "message": "Donor deleted successfully"}), 200
 
+    except NotFound:
+        return jsonify({"code": 404, "message": "Donor not found"}), 404
     except Exception as e:
         return jsonify({"code": 500, "message": str(e)}), 500
 
 
-
 if __name__ == '__main__':
     print("This is flask for " + os.path.basename(__file__) + ": manage donors ...")
     app.run(host='0.0.0.0', port=5003, debug=True)
\ No newline at end of file
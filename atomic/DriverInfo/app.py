@@ -1,18 +1,23 @@
-import firebase_admin
-from firebase_admin import credentials, firestore
 from flask import Flask, jsonify, request
 from flask_cors import CORS
 import os
+from common.conditional import etag_response
+from common.export import ndjson_response, wants_ndjson
+from common.pagination import page_args
+from common.replica import ReplicaRepository, replicate
+from common.repository import NotFound, open_repository
+from common.webapp import setup_app
 
 key_path = os.getenv("DRIVERINFO_DB_KEY", "./secrets/driverInfo_Key.json")  # Default for local testing
-cred = credentials.Certificate(key_path)
 
-# cred = credentials.Certificate("/usr/src/app/driverInfo_Key.json")
-firebase_admin.initialize_app(cred)
+# Firebase credentials are only needed when DATA_BACKEND is firestore
+drivers = open_repository("drivers", key_path=key_path)
+# READ_REPLICA=1 serves reads from an in-process copy kept current by a snapshot listener
+drivers = replicate(drivers, indexes=("stationed_hospital", "isBooked"))
 
-db = firestore.client()
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
+setup_app(app)
 
 #landing page
 @app.route("/", methods=["GET"])
@@ -21,11 +26,12 @@ def home():
         "message": "This is Driver Info Service API!",
         "endpoints": {
             "Add Driver": "POST /drivers",
-            "Get All Drivers": "GET /drivers",
+            "Get All Drivers": "GET /drivers?stationed_hospital=&isBooked=&limit=&startAfter=&fields=",
             "Get Driver by ID": "GET /drivers/<driver_id>",
             "Update Driver": "PATCH /drivers/<driver_id>",
             "Add Trip to History": "PATCH /drivers/<driver_id>/trip",
-            "Delete Driver": "DELETE /drivers/<driver_id>"
+            "Delete Driver": "DELETE /drivers/<driver_id>",
+            "Replica Stats": "GET /replica"
         }
     }), 200
 
@@ -61,8 +67,7 @@ def add_driver():
             return jsonify({"error": f"Unwanted fields detected: {', '.join(extra_fields)}"}), 400
 
         # Add driver and get ID
-        doc_ref = db.collection("drivers").add(driver_info)
-        doc_id = doc_ref[1].id
+        doc_id = drivers.add(driver_info)
 
         return jsonify({
             "message": "Driver added successfully",
@@ -73,22 +78,39 @@ def add_driver():
         return jsonify({"error": str(error)}), 500
 
 
-#get ALL drivers 
+def driver_filters(args):
+    """Optional equality filters on the list endpoint: stationed_hospital and isBooked."""
+    filters = []
+    if args.get("stationed_hospital"):
+        filters.append(("stationed_hospital", "==", args.get("stationed_hospital")))
+    if args.get("isBooked"):
+        filters.append(("isBooked", "==", args.get("isBooked").lower() == "true"))
+    return filters
+
+def driver_row(doc_id, driver_data):
+    driver_data["driver_id"] = doc_id  #need to add back the firestore ID
+    return driver_data
+
+#get ALL drivers (or an NDJSON stream with Accept: application/x-ndjson)
 @app.route("/drivers", methods=["GET"])
 def get_all_drivers():
+    # limit, startAfter and fields page the list; the response stays a bare list, so the
+    # cursor for the next page comes back in the X-Next-Start-After header
     try:
-        drivers_ref = db.collection("drivers")
-        docs = drivers_ref.stream()
-        
-        all_drivers = []
-        for doc in docs:
-            driver_data = doc.to_dict()
-            driver_data["driver_id"] = doc.id  #need to add back the firestore ID
-            all_drivers.append(driver_data)
+        paging = page_args(request.args)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    filters = driver_filters(request.args)
+    if wants_ndjson(request):
+        return ndjson_response(drivers.stream(*filters, **paging), driver_row)
+    try:
+        docs, next_start_after = drivers.page(*filters, **paging)
+        all_drivers = [driver_row(doc_id, driver_data) for doc_id, driver_data in docs]
 
         if not all_drivers:
             return  jsonify({"message": "No drivers found"}), 404
-        return jsonify(all_drivers), 200 
+        headers = {"X-Next-Start-After": next_start_after} if next_start_after else {}
+        return jsonify(all_drivers), 200, headers
     
     except Exception as error:
         return jsonify({"error": str(error)}), 500
@@ -98,10 +120,9 @@ def get_all_drivers():
 @app.route("/drivers/<driver_id>", methods=["GET"])
 def get_one_driver(driver_id):
     try:
-        doc_ref = db.collection("drivers").document(driver_id)
-        doc = doc_ref.get()
-        if doc.exists:
-            return jsonify(doc.to_dict()), 200
+        driver_data, version = drivers.get_with_version(driver_id)
+        if driver_data is not None:
+            return etag_response(request, driver_data, version)
         else:
             return jsonify({"error": f"Driver (id: {driver_id}) not found"}), 404
         
@@ -109,23 +130,27 @@ def get_one_driver(driver_id):
         return jsonify({"error": str(error)}), 500
         
 
+#read replica status
+@app.route("/replica", methods=["GET"])
+def get_replica_stats():
+    if not isinstance(drivers, ReplicaRepository):
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, **drivers.stats()}), 200
+
+
 #updates specific fields
 @app.route("/drivers/<driver_id>", methods=["PATCH"])
 def update_driver(driver_id):
     try:
-        #check if driver_id exists
-        doc_ref = db.collection("drivers").document(driver_id)
-        doc = doc_ref.get()
-        if not doc.exists:
-            return jsonify({"error": f"Driver (id: {driver_id}) not found"}), 404
-        
         data = request.json
-        doc_ref.update(data) #can only update non array fields
+        drivers.update(driver_id, data) #can only update non array fields
 
 
 
         return jsonify({"message": "Driver updated successfully"}), 200
     
+    except NotFound:
+        return jsonify({"error": f"Driver (id: {driver_id}) not found"}), 404
     except Exception as error:
         return jsonify({"error": str(error)}), 500
     
@@ -134,8 +159,7 @@ def update_driver(driver_id):
 @app.route("/drivers/<driver_id>", methods=["DELETE"])
 def delete_driver(driver_id):
     try:
-        doc_ref = db.collection("drivers").document(driver_id)
-        doc_ref.delete()
+        drivers.delete(driver_id)
         return jsonify({"message": f"Driver (id: {driver_id}) deleted successfully"}), 200
     except Exception as error:
         return jsonify({"error": str(error)}), 500
@@ -1,32 +1,87 @@
 #!/usr/bin/env python3
 import os
-import json
-from common import amqp_lib
-import pika
+import time
+from flask import Flask, request, jsonify
+from common import amqp_lib, codec, serving, webapp
 from os import environ
+from error_store import ErrorAggregator, ErrorStore
+
+app = Flask(__name__)
+webapp.setup_app(app)
 
 # Retrieve connection parameters from the environment if available.
 rabbit_host = environ.get("rabbit_host") or "localhost"
-rabbit_port = environ.get("rabbit_port") or 5672
-exchange_name = environ.get("exchange_name") or "error_handling_exchange"
-exchange_type = environ.get("exchange_type") or "topic"
+rabbit_port = int(environ.get("rabbit_port") or 5672)
 queue_name = environ.get("queue_name") or "error_queue"
 
-def callback(channel, method, properties, body):
-    # required signature for the callback; no return
+# Errors are counted per fingerprint in windows of ERROR_WINDOW_SECONDS and written once per batch
+BATCH_SIZE = int(environ.get("ERROR_BATCH_SIZE") or 500)
+BATCH_INTERVAL = float(environ.get("ERROR_BATCH_INTERVAL") or 2.0)
+WINDOW_SECONDS = int(environ.get("ERROR_WINDOW_SECONDS") or 60)
+DB_PATH = environ.get("ERROR_DB_PATH") or "error.db"
+MAX_MINUTES = 7 * 24 * 60
+
+# The SQLite file is opened on first use, so importing the service does not create it
+store = ErrorStore(DB_PATH, WINDOW_SECONDS)
+
+
+def store_batch(messages):
+    """Fingerprint a batch of (method, properties, body), then save the rollups in one transaction."""
+    # A fresh aggregator per batch: a failed batch is handled again message by message,
+    # and must not leave counts behind that the retry would add a second time
+    aggregator = ErrorAggregator(WINDOW_SECONDS)
+    for method, properties, body in messages:
+        text = body.decode(errors="replace") if isinstance(body, bytes) else str(body)
+        try:
+            payload = codec.loads(body)
+        except ValueError:
+            payload = None
+        aggregator.add(properties.timestamp or time.time(), method.routing_key, payload, text)
+    rollups, fingerprints = aggregator.drain()
+    store.save(rollups, fingerprints)
+    # One line per distinct error instead of one per message
+    for fp, entry in fingerprints.items():
+        print(f"{entry['count']}x {entry['routing_key']} [{fp}] {entry['sample'][:200]}")
+
+
+consumer = amqp_lib.BatchConsumer(
+    rabbit_host, rabbit_port, queue_name, store_batch,
+    batch_size=BATCH_SIZE, flush_interval=BATCH_INTERVAL, topology=amqp_lib.load_topology(),
+)
+serving.background(consumer.start, consumer.stop)
+
+
+@app.route("/", methods=["GET"])
+def health_check():
+    return jsonify({"code": 200, "status": "ok"}), 200
+
+
+@app.route("/errors", methods=["GET"])
+def get_error_rates():
+    """Error counts and rates per service over the last `minutes`, with the top fingerprints."""
+    try:
+        minutes = min(max(request.args.get("minutes", default=15, type=int), 1), MAX_MINUTES)
+        top = min(max(request.args.get("top", default=10, type=int), 1), 100)
+        data = store.rates(minutes=minutes, top=top)
+        return jsonify({"code": 200, "data": data}), 200
+    except Exception as e:
+        return jsonify({"code": 500, "message": str(e)}), 500
+
+
+@app.route("/errors/<string:fingerprint>", methods=["GET"])
+def get_error_fingerprint(fingerprint):
+    """Per-window counts and a sample message for one fingerprint."""
     try:
-        error = json.loads(body)
-        print(f"JSON: {error}")
+        minutes = min(max(request.args.get("minutes", default=60, type=int), 1), MAX_MINUTES)
+        data = store.fingerprint_detail(fingerprint, minutes=minutes)
+        if data is None:
+            return jsonify({"code": 404, "message": f"Fingerprint {fingerprint} not found"}), 404
+        return jsonify({"code": 200, "data": data}), 200
     except Exception as e:
-        print(f"Unable to parse JSON: {e=}")
-        print(f"Message: {body}")
-    print()
+        return jsonify({"code": 500, "message": str(e)}), 500
+
 
 if __name__ == "__main__":
     print(f"This is {os.path.basename(__file__)} - amqp consumer (Error)...")
-    try:
-        amqp_lib.start_consuming(
-            rabbit_host, rabbit_port, exchange_name, exchange_type ,queue_name, callback
-        )
-    except Exception as exception:
-        print(f"  Unable to connect to RabbitMQ.\n     {exception=}\n")
\ No newline at end of file
+    serving.start_background()
+    app.run(host="0.0.0.0", port=5005)
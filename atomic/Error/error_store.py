@@ -0,0 +1,224 @@
+"""
+Error fingerprinting and windowed rollups in SQLite.
+
+An error's fingerprint is a hash of its routing key and the "shape" of its message. The
+shape is the nested key structure plus the error text with ids, numbers and hex strings
+masked, so repeats of the same failure for different records collapse into one
+fingerprint. Counts are kept per fingerprint per time window, not per message.
+"""
+
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+
+WINDOW_SECONDS = 60
+TEXT_KEYS = ("error", "message", "event", "status")
+MAX_SAMPLE = 2000
+
+_UUID = re.compile(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+_HEX = re.compile(r"\b[0-9a-fA-F]{8,}\b")
+_NUMBER = re.compile(r"\d+(\.\d+)?")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS error_fingerprint (
+    fingerprint TEXT PRIMARY KEY,
+    routing_key TEXT NOT NULL,
+    service TEXT NOT NULL,
+    shape TEXT NOT NULL,
+    sample TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    total INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS error_rollup (
+    window_start INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    service TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (window_start, fingerprint)
+);
+CREATE INDEX IF NOT EXISTS idx_error_rollup_service ON error_rollup (service, window_start);
+"""
+
+
+def normalise_text(text):
+    text = _UUID.sub("<uuid>", text)
+    text = _HEX.sub("<hex>", text)
+    return _NUMBER.sub("<n>", text)[:200]
+
+
+def message_shape(payload):
+    """Key structure plus masked error text; values that vary per record are dropped."""
+    if isinstance(payload, dict):
+        parts = []
+        for key in sorted(payload):
+            value = payload[key]
+            if key in TEXT_KEYS and isinstance(value, str):
+                parts.append(f"{key}={normalise_text(value)}")
+            else:
+                parts.append(f"{key}:{message_shape(value)}")
+        return "{" + ",".join(parts) + "}"
+    if isinstance(payload, list):
+        return "[" + (message_shape(payload[0]) if payload else "") + "]"
+    if isinstance(payload, str):
+        return "str"
+    return type(payload).__name__
+
+
+def fingerprint(routing_key, payload, text):
+    """Return (fingerprint, shape) for a message; payload is None for non-JSON bodies."""
+    shape = message_shape(payload) if payload is not None else normalise_text(text)
+    digest = hashlib.sha1(f"{routing_key}|{shape}".encode()).hexdigest()[:16]
+    return digest, shape
+
+
+def service_of(routing_key):
+    """match_request.error -> match_request"""
+    return routing_key.rsplit(".", 1)[0] if "." in routing_key else routing_key
+
+
+class ErrorAggregator:
+    """Counts errors per (window, fingerprint) in memory; drained into ErrorStore per batch."""
+
+    def __init__(self, window_seconds=WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        self.rollups = {}  # (window_start, fingerprint) -> count
+        self.fingerprints = {}  # fingerprint -> dict(routing_key, service, shape, sample, first_seen, last_seen, count)
+
+    def add(self, ts, routing_key, payload, text):
+        fp, shape = fingerprint(routing_key, payload, text)
+        window_start = int(ts // self.window_seconds * self.window_seconds)
+        self.rollups[(window_start, fp)] = self.rollups.get((window_start, fp), 0) + 1
+        entry = self.fingerprints.get(fp)
+        if entry is None:
+            entry = self.fingerprints[fp] = {
+                "routing_key": routing_key,
+                "service": service_of(routing_key),
+                "shape": shape,
+                "sample": text[:MAX_SAMPLE],
+                "first_seen": ts,
+                "last_seen": ts,
+                "count": 0,
+            }
+        entry["count"] += 1
+        entry["first_seen"] = min(entry["first_seen"], ts)
+        entry["last_seen"] = max(entry["last_seen"], ts)
+        return fp
+
+    def drain(self):
+        rollups, fingerprints = self.rollups, self.fingerprints
+        self.rollups, self.fingerprints = {}, {}
+        return rollups, fingerprints
+
+
+class ErrorStore:
+    def __init__(self, path, window_seconds=WINDOW_SECONDS):
+        self.path = path
+        self.window_seconds = window_seconds
+        self._local = threading.local()
+
+    def _connection(self):
+        """One connection per thread, opened (and the file created) on first use."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            connection.row_factory = sqlite3.Row
+            self._local.connection = connection
+        return connection
+
+    def save(self, rollups, fingerprints):
+        """Merge drained aggregator state into the rollup tables in one transaction."""
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                """INSERT INTO error_fingerprint
+                       (fingerprint, routing_key, service, shape, sample, first_seen, last_seen, total)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (fingerprint) DO UPDATE SET
+                       last_seen = MAX(last_seen, excluded.last_seen),
+                       total = total + excluded.total""",
+                [
+                    (fp, e["routing_key"], e["service"], e["shape"], e["sample"],
+                     e["first_seen"], e["last_seen"], e["count"])
+                    for fp, e in fingerprints.items()
+                ],
+            )
+            connection.executemany(
+                """INSERT INTO error_rollup (window_start, fingerprint, service, count) VALUES (?, ?, ?, ?)
+                   ON CONFLICT (window_start, fingerprint) DO UPDATE SET count = count + excluded.count""",
+                [
+                    (window_start, fp, fingerprints[fp]["service"], count)
+                    for (window_start, fp), count in rollups.items()
+                ],
+            )
+
+    def rates(self, minutes=15, top=10):
+        """Error counts and per-minute rates per service, plus the hottest fingerprints."""
+        since = time.time() - minutes * 60
+        connection = self._connection()
+        services = [
+            {"service": row["service"], "count": row["total"], "ratePerMinute": round(row["total"] / minutes, 3)}
+            for row in connection.execute(
+                """SELECT service, SUM(count) AS total FROM error_rollup
+                   WHERE window_start >= ? GROUP BY service ORDER BY total DESC""",
+                (int(since // self.window_seconds * self.window_seconds),),
+            )
+        ]
+        hottest = [
+            {
+                "fingerprint": row["fingerprint"],
+                "routingKey": row["routing_key"],
+                "service": row["service"],
+                "count": row["recent"],
+                "total": row["total"],
+                "lastSeen": row["last_seen"],
+                "sample": _load(row["sample"]),
+            }
+            for row in connection.execute(
+                """SELECT f.fingerprint, f.routing_key, f.service, f.total, f.last_seen, f.sample,
+                          SUM(r.count) AS recent
+                   FROM error_rollup r JOIN error_fingerprint f ON f.fingerprint = r.fingerprint
+                   WHERE r.window_start >= ? GROUP BY f.fingerprint ORDER BY recent DESC LIMIT ?""",
+                (int(since // self.window_seconds * self.window_seconds), top),
+            )
+        ]
+        return {"minutes": minutes, "services": services, "fingerprints": hottest}
+
+    def fingerprint_detail(self, fp, minutes=60):
+        connection = self._connection()
+        row = connection.execute("SELECT * FROM error_fingerprint WHERE fingerprint = ?", (fp,)).fetchone()
+        if row is None:
+            return None
+        since = int((time.time() - minutes * 60) // self.window_seconds * self.window_seconds)
+        windows = [
+            {"windowStart": w["window_start"], "count": w["count"]}
+            for w in connection.execute(
+                "SELECT window_start, count FROM error_rollup WHERE fingerprint = ? AND window_start >= ? "
+                "ORDER BY window_start",
+                (fp, since),
+            )
+        ]
+        return {
+            "fingerprint": row["fingerprint"],
+            "routingKey": row["routing_key"],
+            "service": row["service"],
+            "shape": row["shape"],
+            "sample": _load(row["sample"]),
+            "firstSeen": row["first_seen"],
+            "lastSeen": row["last_seen"],
+            "total": row["total"],
+            "windows": windows,
+        }
+
+
+def _load(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
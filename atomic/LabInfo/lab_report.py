@@ -1,24 +1,21 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import firebase_admin
-from firebase_admin import credentials, firestore
 import os
+from common.conditional import etag_response
+from common.export import ndjson_response, wants_ndjson
+from common.models import Model
+from common.pagination import page_args
+from common.repository import AlreadyExists, NotFound, open_repository
+from common.webapp import setup_app
 
 app = Flask(__name__)
 CORS(app)
+setup_app(app)
 
-# Load the Firebase key from an environment variable
-key_path = os.getenv("LABINFO_DB_KEY", "/usr/src/app/Lab_Info_Key.json")
-
-if not key_path or not os.path.isfile(key_path):
-    raise FileNotFoundError(f"Could not find the Firebase JSON at {key_path}")
-
-# Initialize Firestore
-cred = credentials.Certificate(key_path)
-firebase_app = firebase_admin.initialize_app(cred)
-db = firestore.client()
-
-print("Firestore initialized successfully for Lab Reports!")
+# Firebase credentials are only needed when DATA_BACKEND is firestore
+lab_reports = open_repository(
+    "lab_reports", key_path=os.getenv("LABINFO_DB_KEY", "/usr/src/app/Lab_Info_Key.json")
+)
 
 
 """
@@ -39,51 +36,33 @@ LabInfo Class JSON Schema
   }
 }
 """
-class LabInfo:
-    def __init__(self, uuid, test_type, date_of_report, report, hla_typing, comments):
-        self.uuid = uuid
-        self.test_type = test_type
-        self.date_of_report = date_of_report
-        self.report = report
-        self.hla_typing = hla_typing
-        self.comments = comments
-        
+class LabInfo(Model):
+    __slots__ = ("uuid", "test_type", "date_of_report", "report", "hla_typing", "comments")
+    ID = ("uuid", "uuid")
+    FIELDS = (
+        ("testType", "test_type", str, True, None),
+        ("dateOfReport", "date_of_report", None, True, None),
+        ("report", "report", None, True, None),
+        ("hlaTyping", "hla_typing", None, True, None),
+        ("comments", "comments", None, True, None),
+    )
+def lab_info_row(doc_id, lab_info_data):
+    return lab_info_data
 
-    def to_dict(self):
-        """Convert the object to a Firestore-compatible dictionary."""
-        return {
-            "uuid": self.uuid,
-            "testType": self.test_type,
-            "dateOfReport": self.date_of_report,
-            "report": self.report,
-            "hlaTyping": self.hla_typing,
-            "comments": self.comments,
-        }
-
-    @staticmethod
-    def from_dict(uuid, data):
-        """Create a LabInfo object from Firestore document data."""
-        return LabInfo(
-            uuid=uuid,
-            test_type=data["testType"],
-            date_of_report=data["dateOfReport"],
-            report=data["report"],
-            hla_typing=data["hlaTyping"],
-            comments=data["comments"],
-            
-        )
 @app.route("/lab-reports", methods=['GET'])
 def get_all():
+    """All lab reports; accepts limit, startAfter and fields, or streams NDJSON."""
+    try:
+        paging = page_args(request.args)
+    except ValueError as e:
+        return jsonify({"code": 400, "message": str(e)}), 400
+    if wants_ndjson(request):
+        return ndjson_response(lab_reports.stream(**paging), lab_info_row)
     # Read data from firebase
     try:
-        lab_info_ref = db.collection("lab_reports")
-        docs = lab_info_ref.get()
-        labInfo = [];
-
-        for doc in docs:
-            lab_info_data = doc.to_dict()
-            labInfo.append(lab_info_data)
-        return jsonify({"code":200, "data": labInfo}), 200
+        docs, next_start_after = lab_reports.page(**paging)
+        labInfo = [lab_info_data for _, lab_info_data in docs]
+        return jsonify({"code":200, "data": labInfo, "nextStartAfter": next_start_after}), 200
     except Exception as e:
         return jsonify({"code":500, "message": str(e)}), 500
 
@@ -91,11 +70,10 @@ def get_all():
 @app.route("/lab-reports/<string:uuid>")
 def get_lab_info(uuid):
     try:
-        lab_info_ref = db.collection("lab_reports").document(uuid)
-        doc = lab_info_ref.get()
-        if doc.exists:
-            lab_info_obj = LabInfo.from_dict(uuid, doc.to_dict())
-            return {"code":200, "data": lab_info_obj.to_dict()}  # Convert back to JSON-friendly format
+        lab_info_data, version = lab_reports.get_with_version(uuid)
+        if lab_info_data is not None:
+            lab_info_obj = LabInfo.from_dict(uuid, lab_info_data)
+            return etag_response(request, {"code":200, "data": lab_info_obj.to_dict()}, version)
         else:
             return jsonify({"code": 404, "message": "LabInfo does not exist"}), 404
 
@@ -105,18 +83,13 @@ def get_lab_info(uuid):
 @app.route("/lab-reports/recipient/<string:uuid>")
 def get_lab_info_by_recipient(uuid):
     try:
-        lab_info_ref = db.collection("lab_reports")
         # Query for documents where the "uuid" field starts with the provided uuid.
         # This uses Firestore range queries:
         # Any string that is >= uuid and <= uuid + "\uf8ff" will have the provided uuid as its prefix.
-        query = lab_info_ref.where("uuid", ">=", uuid).where("uuid", "<=", uuid + "\uf8ff")
-        docs = query.get()
+        docs = lab_reports.find(("uuid", ">=", uuid), ("uuid", "<=", uuid + "\uf8ff"))
         
         if docs:
-            lab_infos = []
-            for doc in docs:
-                lab_info_obj = LabInfo.from_dict(doc.id, doc.to_dict())
-                lab_infos.append(lab_info_obj.to_dict())
+            lab_infos = [LabInfo.row(doc_id, lab_info_data) for doc_id, lab_info_data in docs]
             return jsonify({"code": 200, "data": lab_infos, "message": f"Found {len(lab_infos)} lab report(s) matching uuid"}), 200
         else:
             return jsonify({"code": 404, "message": "LabInfo does not exist"}), 404
@@ -128,23 +101,10 @@ def get_lab_info_by_recipient(uuid):
 @app.route("/lab-reports/<string:uuid>", methods=['PUT'])
 def update_lab_info(uuid):
     try:
-        lab_info_ref = db.collection("lab_reports").document(uuid)
-        doc = lab_info_ref.get()
-        if not doc.exists:
-            return jsonify(
-                {
-                    "code": 404,
-                    "data": {
-                        "uuid": uuid
-                    },
-                    "message": "LabInfo not found."
-                }
-            ), 404
-
         # update status
         new_data = request.get_json()
         if new_data:
-            db.collection("donors").document(uuid).set(new_data["data"], merge=True)
+            lab_reports.update(uuid, new_data["data"])
             return jsonify(
                 {
                     "code": 200,
@@ -156,6 +116,16 @@ def update_lab_info(uuid):
                 "code": 400,
                 "message": "No data provided for update."
             }), 400
+    except NotFound:
+        return jsonify(
+            {
+                "code": 404,
+                "data": {
+                    "uuid": uuid
+                },
+                "message": "LabInfo not found."
+            }
+        ), 404
     except Exception as e:
         print("Error: {}".format(str(e)))
         return jsonify(
@@ -183,15 +153,6 @@ def create_lab_info():
                 "message": "LabInfo Id is required."
             }), 400
 
-        # Reference to the donor document in Firestore
-        lab_info_ref = db.collection("lab_reports").document(uuid)
-        if lab_info_ref.get().exists:
-            return jsonify({
-                "code": 409,
-                "data": {"uuid": uuid},
-                "message": "LabInfo already exists."
-            }), 409
-
         # Create a new LabInfo object
         new_lab_info = LabInfo(
             uuid=uuid,
@@ -203,7 +164,7 @@ def create_lab_info():
         )
 
         # Save the new donor to Firestore
-        lab_info_ref.set(new_lab_info.to_dict())
+        lab_reports.create(uuid, new_lab_info.to_dict())
 
         # Return success response
         return jsonify({
@@ -212,6 +173,12 @@ def create_lab_info():
             "message": "LabInfo created successfully."
         }), 201
 
+    except AlreadyExists:
+        return jsonify({
+            "code": 409,
+            "data": {"uuid": uuid},
+            "message": "LabInfo already exists."
+        }), 409
     except Exception as e:
         print("Error: {}".format(str(e)))
         return jsonify({
@@ -221,21 +188,81 @@ def create_lab_info():
         }), 500
 
 
+@app.route("/lab-reports/batch", methods=['POST'])
+def create_lab_infos():
+    """
+    Create many lab reports at once: {"data": [<lab report>, ...]}.
+    Existing documents are looked up in one get_many call and new ones are written in
+    batched commits. Returns one result per input record, in order.
+    """
+    try:
+        lab_infos = (request.get_json() or {}).get("data")
+        if not isinstance(lab_infos, list) or not lab_infos:
+            return jsonify({"code": 400, "message": "data must be a non-empty list."}), 400
+
+        results = [None] * len(lab_infos)
+        indexes = {}
+        for index, lab_info_data in enumerate(lab_infos):
+            uuid = lab_info_data.get("uuid") if isinstance(lab_info_data, dict) else None
+            if not uuid:
+                results[index] = {"uuid": uuid, "code": 400, "message": "LabInfo Id is required."}
+            elif uuid in indexes:
+                results[index] = {"uuid": uuid, "code": 409, "message": "Duplicate LabInfo Id in batch."}
+            else:
+                indexes[uuid] = index
+
+        existing = lab_reports.get_many(indexes)
+        writes = []
+        for uuid, index in indexes.items():
+            if uuid in existing:
+                results[index] = {"uuid": uuid, "code": 409, "message": "LabInfo already exists."}
+                continue
+            lab_info_data = lab_infos[index]
+            try:
+                new_lab_info = LabInfo(
+                    uuid=uuid,
+                    test_type=lab_info_data["testType"],
+                    date_of_report=lab_info_data["dateOfReport"],
+                    report=lab_info_data["report"],
+                    hla_typing=lab_info_data.get("hlaTyping", {}), # Optional dict
+                    comments=lab_info_data["comments"],
+                )
+            except KeyError as e:
+                results[index] = {"uuid": uuid, "code": 400, "message": f"Missing field {e}."}
+                continue
+            writes.append((index, new_lab_info))
+
+        lab_reports.set_many((new_lab_info.uuid, new_lab_info.to_dict()) for _, new_lab_info in writes)
+        for index, new_lab_info in writes:
+            results[index] = {"uuid": new_lab_info.uuid, "code": 201, "message": "LabInfo created successfully."}
+
+        code = 201 if all(result["code"] == 201 for result in results) else 207
+        return jsonify({
+            "code": code,
+            "data": results,
+            "message": f"Created {len(writes)} of {len(lab_infos)} LabInfo record(s)."
+        }), code
+
+    except Exception as e:
+        print("Error: {}".format(str(e)))
+        return jsonify({
+            "code": 500,
+            "data": {},
+            "message": "An error occurred while creating the LabInfo records: " + str(e)
+        }), 500
+
+
 @app.route("/lab-reports/<string:uuid>", methods=['DELETE'])
 def delete_lab_info(uuid):
     """Delete an donor from Firestore."""
     try:
-        lab_info_ref = db.collection("lab_reports").document(uuid)
-        doc = lab_info_ref.get()
-
-        if not doc.exists:
-            return jsonify({"code": 404, "message": "LabInfo not found"}), 404
-
         # Delete the organ document from Firestore
-        lab_info_ref.delete()
+        lab_reports.delete(uuid, must_exist=True)
 
         return jsonify({"code": 200, "message": "LabInfo deleted successfully"}), 200
 
+    except NotFound:
+        return jsonify({"code": 404, "message": "LabInfo not found"}), 404
     except Exception as e:
         return jsonify({"code": 500, "message": str(e)}), 500
 
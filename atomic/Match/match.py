@@ -1,90 +1,61 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import firebase_admin
-from firebase_admin import credentials, firestore
 import os
+from common.conditional import etag_response
+from common.export import ndjson_response, wants_ndjson
+from common.models import Model
+from common.pagination import page_args
+from common.repository import AlreadyExists, NotFound, open_repository
+from common.webapp import setup_app
 
 app = Flask(__name__)
 CORS(app)
-
-# Load the Firebase key from an environment variable
-key_path = os.getenv("MATCH_DB_KEY")
-
-if not key_path or not os.path.isfile(key_path):
-    raise FileNotFoundError(f"Could not find the Firebase JSON at {key_path}")
-
-# Initialize Firestore
-cred = credentials.Certificate(key_path)
-firebase_app = firebase_admin.initialize_app(cred)
-db = firestore.client()
-
-print("Firestore initialized successfully for Matches!")
-
-class Match:
-    def __init__(self, match_id, recipient_id, donor_id, organ_id ,test_date_time, 
-                 hla_1, hla_2, hla_3, hla_4, hla_5, hla_6, num_of_HLA):
-        self.match_id = match_id
-        self.recipient_id = recipient_id
-        self.donor_id = donor_id
-        self.organ_id = organ_id
-        self.test_date_time = test_date_time
-        self.hla_1 = hla_1
-        self.hla_2 = hla_2
-        self.hla_3 = hla_3
-        self.hla_4 = hla_4
-        self.hla_5 = hla_5
-        self.hla_6 = hla_6
-        self.num_of_hla = num_of_HLA
-
-    def to_dict(self):
-        """Convert the object to a Firestore-compatible dictionary."""
-        return {
-        "matchId": self.match_id, 
-        "recipientId": self.recipient_id,
-        "donorId": self.donor_id,
-        "organId": self.organ_id,
-        "testDateTime": self.test_date_time,
-        "hla1": self.hla_1,
-        "hla2": self.hla_2,
-        "hla3": self.hla_3,
-        "hla4": self.hla_4,
-        "hla5": self.hla_5,
-        "hla6": self.hla_6,
-        "numOfHLA": self.num_of_hla,
-        }
-
-    @staticmethod
-    def from_dict(match_id, data):
-        """Create a Match object from Firestore document data."""
-        return Match(
-        match_id=match_id, 
-        recipient_id=data["recipientId"],
-        donor_id=data["donorId"],
-        organ_id=data["organId"],
-        test_date_time=data["testDateTime"],
-        hla_1=data["hla1"],
-        hla_2=data["hla2"],
-        hla_3=data["hla3"],
-        hla_4=data["hla4"],
-        hla_5=data["hla5"],
-        hla_6=data["hla6"],
-        num_of_HLA=data["numOfHLA"] 
-        )
+setup_app(app)
+
+# Firebase credentials are only needed when DATA_BACKEND is firestore
+matches_repo = open_repository("matches", key_path=os.getenv("MATCH_DB_KEY"))
+
+class Match(Model):
+    __slots__ = ("match_id", "recipient_id", "donor_id", "organ_id", "test_date_time",
+                 "hla_1", "hla_2", "hla_3", "hla_4", "hla_5", "hla_6", "num_of_hla")
+    ID = ("matchId", "match_id")
+    FIELDS = (
+        ("recipientId", "recipient_id", str, True, None),
+        ("donorId", "donor_id", str, True, None),
+        ("organId", "organ_id", str, True, None),
+        ("testDateTime", "test_date_time", None, True, None),
+        ("hla1", "hla_1", None, True, None),
+        ("hla2", "hla_2", None, True, None),
+        ("hla3", "hla_3", None, True, None),
+        ("hla4", "hla_4", None, True, None),
+        ("hla5", "hla_5", None, True, None),
+        ("hla6", "hla_6", None, True, None),
+        ("numOfHLA", "num_of_hla", None, True, None),
+    )
+
+def match_row(doc_id, match_data):
+    match_data["matchId"] = doc_id  # Add document ID
+    return match_data
 
 @app.route("/matches", methods=['GET'])
 def get_all():
+    """All matches keyed by id; accepts limit, startAfter and fields, or streams NDJSON."""
+    try:
+        paging = page_args(request.args)
+    except ValueError as e:
+        return jsonify({"code": 400, "message": str(e)}), 400
+    if wants_ndjson(request):
+        return ndjson_response(matches_repo.stream(**paging), match_row)
     # Read data from firebase
     try:
-        match_ref = db.collection("matches")
-        # docs = matches_ref.stream()
-        docs = match_ref.get()
-        matches = {};
-
-        for doc in docs:
-            match_data = doc.to_dict()
-            match_data["matchId"] = doc.id  # Add document ID
-            matches[doc.id] = match_data
-        return jsonify({"code":200, "data": matches, "message": "Successfully got all matches"}), 200
+        docs, next_start_after = matches_repo.page(**paging)
+        matches = {doc_id: match_row(doc_id, match_data) for doc_id, match_data in docs}
+        return jsonify({
+            "code":200,
+            "data": matches,
+            "nextStartAfter": next_start_after,
+            "message": "Successfully got all matches"
+        }), 200
     except Exception as e:
         return jsonify({"code":500, "message": str(e)}), 500
 
@@ -92,11 +63,10 @@ def get_all():
 @app.route("/matches/<string:matchId>")
 def get_match(matchId):
     try:
-        match_ref = db.collection("matches").document(matchId)
-        doc = match_ref.get()
-        if doc.exists:
-            match_obj = Match.from_dict(matchId, doc.to_dict())
-            return {"code":200, "data": match_obj.to_dict()}  # Convert back to JSON-friendly format
+        match_data, version = matches_repo.get_with_version(matchId)
+        if match_data is not None:
+            match_obj = Match.from_dict(matchId, match_data)
+            return etag_response(request, {"code":200, "data": match_obj.to_dict()}, version)
         else:
             return jsonify({"code":404, "message": "Match does not exist"}), 404
 
@@ -106,9 +76,7 @@ def get_match(matchId):
 @app.route("/matches/recipient/<string:recipientId>", methods=['GET'])
 def get_matches_by_recipient(recipientId):
     try:
-        match_ref = db.collection("matches")
-        docs = match_ref.where("recipientId", "==", recipientId).get()
-        matches = [doc.to_dict() for doc in docs]
+        matches = [match_data for _, match_data in matches_repo.where("recipientId", "==", recipientId)]
 
         if not matches:
             return jsonify({
@@ -129,23 +97,10 @@ def get_matches_by_recipient(recipientId):
 @app.route("/match/<string:matchId>", methods=['PUT'])
 def update_match(matchId):
     try:
-        match_ref = db.collection("matches").document(matchId)
-        doc = match_ref.get()
-        if not doc.exists:
-            return jsonify(
-                {
-                    "code": 404,
-                    "data": {
-                        "matchId": matchId
-                    },
-                    "message": "Match not found."
-                }
-            ), 404
-
         # update status
         new_data = request.get_json()
         if new_data:
-            db.collection("matches").document(matchId).set(new_data["data"], merge=True)
+            matches_repo.update(matchId, new_data["data"])
             return jsonify(
                 {
                     "code": 200,
@@ -157,6 +112,16 @@ def update_match(matchId):
                 "code": 400,
                 "message": "No data provided for update."
             }), 400
+    except NotFound:
+        return jsonify(
+            {
+                "code": 404,
+                "data": {
+                    "matchId": matchId
+                },
+                "message": "Match not found."
+            }
+        ), 404
     except Exception as e:
         print("Error: {}".format(str(e)))
         return jsonify(
@@ -184,15 +149,6 @@ def create_match():
                 "message": "Match Id is required."
             }), 400
 
-        # Reference to the donor document in Firestore
-        match_ref = db.collection("matches").document(match_id)
-        if match_ref.get().exists:
-            return jsonify({
-                "code": 409,
-                "data": {"matchId": match_id},
-                "message": "Match already exists."
-            }), 409
-
         # Create a new Donor object
         new_match = Match(
         match_id=match_id, 
@@ -206,11 +162,11 @@ def create_match():
         hla_4=match_data["hla4"],
         hla_5=match_data["hla5"],
         hla_6=match_data["hla6"],
-        num_of_HLA=match_data["numOfHLA"] 
+        num_of_hla=match_data["numOfHLA"] 
         )
 
         # Save the new donor to Firestore
-        match_ref.set(new_match.to_dict())
+        matches_repo.create(match_id, new_match.to_dict())
 
         # Return success response
         return jsonify({
@@ -219,6 +175,12 @@ def create_match():
             "message": "Match created successfully."
         }), 201
 
+    except AlreadyExists:
+        return jsonify({
+            "code": 409,
+            "data": {"matchId": match_id},
+            "message": "Match already exists."
+        }), 409
     except Exception as e:
         print("Error: {}".format(str(e)))
         return jsonify({
@@ -231,17 +193,13 @@ def create_match():
 def delete_match(matchId):
     """Delete an match from Firestore."""
     try:
-        match_ref = db.collection("matches").document(matchId)
-        doc = match_ref.get()
-
-        if not doc.exists:
-            return jsonify({"code": 404, "message": "Match not found"}), 404
-
         # Delete the organ document from Firestore
-        match_ref.delete()
+        matches_repo.delete(matchId, must_exist=True)
 
         return jsonify({"code": 200, "message": "Match deleted successfully"}), 200
 
+    except NotFound:
+        return jsonify({"code": 404, "message": "Match not found"}), 404
     except Exception as e:
         return jsonify({"code": 500, "message": str(e)}), 500
 
@@ -1,83 +1,59 @@
 from datetime import datetime
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
 from os import environ
 import os
 import uuid
+from common.conditional import etag_response
+from common.export import ndjson_response, wants_ndjson
+from common.models import Model
+from common.pagination import page_args
+from common.repository import AlreadyExists, NotFound, open_repository
+from common.webapp import setup_app
 app = Flask(__name__)
 
 CORS(app)
-
-# Load the key from an environment variable
-key_path = os.getenv("ORDER_DB_KEY")
-
-if not key_path or not os.path.isfile(key_path):
-    raise FileNotFoundError(f"Could not find the Firebase JSON at {key_path}")
-# Initialize Firestore
-cred = credentials.Certificate(key_path)
-firebase_app = firebase_admin.initialize_app(cred)
-
-print("Firestore initialized successfully for Donor!")
-
-
-db = firestore.client()
-
-class Order:
-    def __init__(self, orderId, organType, doctorId, transplantDateTime, startHospital, endHospital, matchId, remarks):
-        self.orderId = orderId
-        self.organType = organType  # e.g., "heart"
-        self.doctorId = doctorId
-        self.transplantDateTime = transplantDateTime
-        self.startHospital = startHospital  # e.g., "CGH"
-        self.endHospital = endHospital  # e.g., "SGH"
-        self.matchId = matchId
-        self.remarks = remarks  # String of additional info
-
-    def to_dict(self):
-        """Convert the Order object to a Firestore-compatible dictionary."""
-        return {
-            "orderId": self.orderId,
-            "organType": self.organType,
-            "doctorId" : self.doctorId,
-            "transplantDateTime": self.transplantDateTime,
-            "startHospital": self.startHospital,
-            "endHospital": self.endHospital,
-            "matchId": self.matchId,
-            "remarks": self.remarks
-        }
-
-    @staticmethod
-    def from_dict(order_id, data):
-        """Create an Order object from Firestore document data."""
-        return Order(
-            orderId=order_id,
-            organType=data["organType"],
-            doctorId=data.get("doctorId", ""),
-            transplantDateTime=data["transplantDateTime"],
-            startHospital=data["startHospital"],
-            endHospital=data["endHospital"],
-            matchId=data["matchId"],
-            remarks=data.get("remarks", "")  # Default to empty string if not present
-        )
+setup_app(app)
+
+# Firebase credentials are only needed when DATA_BACKEND is firestore
+orders = open_repository("orders", key_path=os.getenv("ORDER_DB_KEY"))
+
+class Order(Model):
+    __slots__ = ("orderId", "organType", "doctorId", "transplantDateTime", "startHospital", "endHospital",
+                 "matchId", "remarks")
+    ID = ("orderId", "orderId")
+    FIELDS = (
+        ("organType", "organType", str, True, None),  # e.g., "heart"
+        ("doctorId", "doctorId", str, False, ""),
+        ("transplantDateTime", "transplantDateTime", None, True, None),
+        ("startHospital", "startHospital", str, True, None),  # e.g., "CGH"
+        ("endHospital", "endHospital", str, True, None),  # e.g., "SGH"
+        ("matchId", "matchId", str, True, None),
+        ("remarks", "remarks", str, False, ""),  # String of additional info
+    )
+
+def order_row(doc_id, order_data):
+    # Add the document ID as orderId
+    order_data["orderId"] = doc_id
+    return order_data
 
 @app.route("/order", methods=['GET'])
 def get_all_orders():
     """
     Retrieve all Order documents from Firestore.
+    Accepts limit, startAfter and fields; see common/pagination.py.
+    Streams NDJSON when the client accepts application/x-ndjson.
     """
     try:
-        orders_ref = db.collection("orders")
-        docs = orders_ref.get()
-        orders = {}
-        for doc in docs:
-            order_data = doc.to_dict()
-            # Add the document ID as orderId
-            order_data["orderId"] = doc.id  
-            orders[doc.id] = order_data
-        return jsonify({"code": 200, "data": orders}), 200
+        paging = page_args(request.args)
+    except ValueError as e:
+        return jsonify({"code": 400, "message": str(e)}), 400
+    if wants_ndjson(request):
+        return ndjson_response(orders.stream(**paging), order_row)
+    try:
+        docs, next_start_after = orders.page(**paging)
+        all_orders = {doc_id: order_row(doc_id, order_data) for doc_id, order_data in docs}
+        return jsonify({"code": 200, "data": all_orders, "nextStartAfter": next_start_after}), 200
     except Exception as e:
         return jsonify({"code": 500, "message": str(e)}), 500
 
@@ -87,11 +63,10 @@ def get_order(orderId):
     Retrieve a specific Order by its orderId.
     """
     try:
-        order_ref = db.collection("orders").document(orderId)
-        doc = order_ref.get()
-        if doc.exists:
-            order_obj = Order.from_dict(orderId, doc.to_dict())
-            return jsonify({"code": 200, "data": order_obj.to_dict()}), 200
+        order_data, version = orders.get_with_version(orderId)
+        if order_data is not None:
+            order_obj = Order.from_dict(orderId, order_data)
+            return etag_response(request, {"code": 200, "data": order_obj.to_dict()}, version)
         else:
             return jsonify({"code": 404, "message": "Order does not exist"}), 404
     except Exception as e:
@@ -104,19 +79,10 @@ def update_order(orderId):
     Example response: { "code": 200, "data": { ...updated fields... }, "message": "Order updated successfully" }
     """
     try:
-        order_ref = db.collection("orders").document(orderId)
-        doc = order_ref.get()
-        if not doc.exists:
-            return jsonify({
-                "code": 404,
-                "data": {"orderId": orderId},
-                "message": "Order not found."
-            }), 404
-
         new_data = request.get_json()
         if new_data and "data" in new_data:
             update_fields = new_data["data"]
-            order_ref.set(update_fields, merge=True)
+            orders.update(orderId, update_fields)
             return jsonify({
                 "code": 200,
                 "data": update_fields,
@@ -127,6 +93,12 @@ def update_order(orderId):
                 "code": 400,
                 "message": "No data provided for update."
             }), 400
+    except NotFound:
+        return jsonify({
+            "code": 404,
+            "data": {"orderId": orderId},
+            "message": "Order not found."
+        }), 404
     except Exception as e:
         return jsonify({
             "code": 500,
@@ -151,15 +123,6 @@ def create_order():
                 "message": "Order ID is required."
             }), 400
 
-        # Reference to the order document in Firestore
-        order_ref = db.collection("orders").document(order_id)
-        if order_ref.get().exists:
-            return jsonify({
-                "code": 409,
-                "data": {"orderId": order_id},
-                "message": "Order already exists."
-            }), 409
-
         # Create a new Order object using the data from the request
         new_order = Order(
             orderId=order_id,
@@ -173,7 +136,7 @@ def create_order():
         )
 
         # Save the new Order to Firestore
-        order_ref.set(new_order.to_dict())
+        orders.create(order_id, new_order.to_dict())
 
         return jsonify({
             "code": 201,
@@ -181,6 +144,12 @@ def create_order():
             "message": "Order created successfully."
         }), 201
 
+    except AlreadyExists:
+        return jsonify({
+            "code": 409,
+            "data": {"orderId": order_id},
+            "message": "Order already exists."
+        }), 409
     except Exception as e:
         return jsonify({
             "code": 500,
@@ -192,17 +161,13 @@ def create_order():
 def delete_match(orderId):
     """Delete an order from Firestore."""
     try:
-        order_ref = db.collection("orders").document(orderId)
-        doc = order_ref.get()
-
-        if not doc.exists:
-            return jsonify({"code": 404, "message": "Order not found"}), 404
-
         # Delete the organ document from Firestore
-        order_ref.delete()
+        orders.delete(orderId, must_exist=True)
 
         return jsonify({"code": 200, "message": "Order deleted successfully"}), 200
 
+    except NotFound:
+        return jsonify({"code": 404, "message": "Order not found"}), 404
     except Exception as e:
         return jsonify({"code": 500, "message": str(e)}), 500
 
@@ -2,91 +2,80 @@ import uuid
 from datetime import datetime
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import firebase_admin
-from firebase_admin import credentials, firestore
 import os
+from common.conditional import etag_response
+from common.export import ndjson_response, wants_ndjson
+from common.models import Model
+from common.pagination import page_args
+from common.replica import ReplicaRepository, replicate
+from common.repository import NotFound, open_repository
+from common.webapp import setup_app
 
 app = Flask(__name__)
 CORS(app)
+setup_app(app)
+
+# Firebase credentials are only needed when DATA_BACKEND is firestore
+organs = open_repository(
+    "organs",
+    key_path=os.getenv("ORGAN_DB_KEY", "/usr/src/app/secrets/organ_Key.json"),
+    project_id="organs-7ede9",
+)
+# READ_REPLICA=1 serves reads from an in-process copy kept current by a snapshot listener
+organs = replicate(organs, indexes=("organType", "bloodType", "status", "donorId", "condition"))
+
+class Organ(Model):
+    __slots__ = ("organ_id", "donor_id", "organ_type", "blood_type", "condition")
+    ID = ("organId", "organ_id")
+    FIELDS = (
+        ("donorId", "donor_id", str, True, None),
+        ("organType", "organ_type", str, True, None),
+        ("bloodType", "blood_type", str, True, None),
+        ("condition", "condition", str, True, None),
+    )
+
+def organ_row(doc_id, organ_data):
+    organ_data["organId"] = doc_id  # Add Firestore document ID
+    return organ_data
+
+def list_organs(message, *filters):
+    """
+    List response for the organs matching filters, paged by the limit/startAfter/fields
+    args, or an NDJSON stream when the client accepts application/x-ndjson.
+    """
+    try:
+        paging = page_args(request.args)
+    except ValueError as e:
+        return jsonify({"code": 400, "message": str(e)}), 400
+    if wants_ndjson(request):
+        return ndjson_response(organs.stream(*filters, **paging), organ_row)
+    try:
+        docs, next_start_after = organs.page(*filters, **paging)
+        organ_list = [organ_row(doc_id, organ_data) for doc_id, organ_data in docs]
 
-# Load Firebase credentials
-key_path = os.getenv("ORGAN_DB_KEY", "/usr/src/app/secrets/organ_Key.json") 
-
-if not key_path or not os.path.isfile(key_path):
-    raise FileNotFoundError(f"Could not find the Firebase JSON at {key_path}")
-
-# Initialize Firestore only if it hasn't been initialized
-if not firebase_admin._apps:
-    cred = credentials.Certificate(key_path)  
-    firebase_app = firebase_admin.initialize_app(cred, {
-        'projectId': 'organs-7ede9'  # Specify the project ID here
-    })
-
-
-print("Firestore initialized successfully for Organ!")
-
-db = firestore.client()
-
-class Organ:
-    def __init__(
-        self, organ_id, donor_id, organ_type, blood_type, condition):
-        self.organ_id = organ_id
-        self.donor_id = donor_id
-        self.organ_type = organ_type
-        self.blood_type = blood_type
-        self.condition = condition
-
-
-    def to_dict(self):
-        """Convert the object to a Firestore-compatible dictionary."""
-        return {
-            "organId": self.organ_id,
-            "donorId": self.donor_id,
-            "organType": self.organ_type,
-            "bloodType": self.blood_type,
-            "condition": self.condition,
-
-        }
-
-    @staticmethod
-    def from_dict(organId, data):
-        """Create an Organ object from Firestore document data."""
-        return Organ(
-            organ_id=organId,
-            donor_id=data["donorId"],
-            organ_type=data["organType"],
-            blood_type=data["bloodType"],
-            condition=data["condition"],
+        return jsonify({
+            "code": 200,
+            "data": organ_list,
+            "nextStartAfter": next_start_after,
+            "message": message
+        }), 200
 
-        )
+    except Exception as e:
+        return jsonify({"code": 500, "message": str(e)}), 500
 
 @app.route("/organ", methods=['GET'])
 def get_all_organs():
     """Retrieve all organs from Firestore."""
-    try:
-        organ_ref = db.collection("organs")
-        docs = organ_ref.get()
-        organ_list = []
-
-        for doc in docs:
-            organ_data = doc.to_dict()
-            organ_data["organId"] = doc.id  # Add Firestore document ID
-            organ_list.append(organ_data)
-
-        return jsonify({"code": 200, "data": organ_list,"message": "Successfully get all organs"}), 200
-
-    except Exception as e:
-        return jsonify({"code": 500, "message": str(e)}), 500
+    return list_organs("Successfully get all organs")
 
 @app.route("/organ/<string:organId>", methods=['GET'])
 def get_organ(organId):
     """Retrieve a specific organ by organId."""
     try:
-        organ_ref = db.collection("organs").document(organId)
-        doc = organ_ref.get()
-        if doc.exists:
-            organ_obj = Organ.from_dict(organId, doc.to_dict())
-            return {"code":200, "data": organ_obj.to_dict(), "message": "Successfully get organs by Id"}  # Convert back to JSON-friendly format
+        organ_data, version = organs.get_with_version(organId)
+        if organ_data is not None:
+            organ_obj = Organ.from_dict(organId, organ_data)
+            return etag_response(request, {"code":200, "data": organ_obj.to_dict(), "message": "Successfully get organs by Id"}, version)
         else:
             return jsonify({"code":404, "message": "Organ does not exist"}), 404
 
@@ -96,74 +85,29 @@ def get_organ(organId):
 @app.route("/organ/donor/<string:donorId>", methods=['GET'])
 def get_organs_for_donor(donorId):
     """Retrieve all organs for a specific donor."""
-    try:
-        organ_ref = db.collection("organs")
-        docs = organ_ref.where('donorId', '==', donorId).get()
-        organ_list = []
-
-        for doc in docs:
-            organ_data = doc.to_dict()
-            organ_data["organId"] = doc.id  # Add Firestore document ID
-            organ_list.append(organ_data)
-
-        return jsonify({"code": 200, "data": organ_list, "message": "Successfully get organs by donor"}), 200
-
-    except Exception as e:
-        return jsonify({"code": 500, "message": str(e)}), 500
+    return list_organs("Successfully get organs by donor", ('donorId', '==', donorId))
 
 @app.route("/organ/type/<string:organType>", methods=['GET'])
 def get_organs_by_type(organType):
     """Retrieve all organs of a specific type."""
-    try:
-        organ_ref = db.collection("organs")
-        docs = organ_ref.where('organType', '==', organType).get()
-        organ_list = []
-
-        for doc in docs:
-            organ_data = doc.to_dict()
-            organ_data["organId"] = doc.id  # Add Firestore document ID
-            organ_list.append(organ_data)
-
-        return jsonify({"code": 200, "data": organ_list, "message": "Successfully get organs by type"}), 200
-
-    except Exception as e:
-        return jsonify({"code": 500, "message": str(e)}), 500
+    return list_organs("Successfully get organs by type", ('organType', '==', organType))
 
 @app.route("/organ/status/<string:status>", methods=['GET'])
 def get_organs_by_status(status):
     """Retrieve all organs of a specific status."""
-    try:
-        organ_ref = db.collection("organs")
-        docs = organ_ref.where('status', '==', status).get()
-        organ_list = []
-
-        for doc in docs:
-            organ_data = doc.to_dict()
-            organ_data["organId"] = doc.id  # Add Firestore document ID
-            organ_list.append(organ_data)
-
-        return jsonify({"code": 200, "data": organ_list, "message": "Successfully get organs by status"}), 200
-
-    except Exception as e:
-        return jsonify({"code": 500, "message": str(e)}), 500
+    return list_organs("Successfully get organs by status", ('status', '==', status))
 
 @app.route("/organ/condition/<string:condition>", methods=['GET'])
 def get_organs_by_condition(condition):
     """Retrieve all organs of a specific condition."""
-    try:
-        organ_ref = db.collection("organs")
-        docs = organ_ref.where('condition', '==', condition).get()
-        organ_list = []
-
-        for doc in docs:
-            organ_data = doc.to_dict()
-            organ_data["organId"] = doc.id  # Add Firestore document ID
-            organ_list.append(organ_data)
+    return list_organs("Successfully get organs by condition", ('condition', '==', condition))
 
-        return jsonify({"code": 200, "data": organ_list, "message": "Successfully get organs by condition"}), 200
-
-    except Exception as e:
-        return jsonify({"code": 500, "message": str(e)}), 500
+@app.route("/replica", methods=['GET'])
+def get_replica_stats():
+    """Readiness, lag and hit counts of the read replica, if enabled."""
+    if not isinstance(organs, ReplicaRepository):
+        return jsonify({"code": 200, "data": {"enabled": False}}), 200
+    return jsonify({"code": 200, "data": {"enabled": True, **organs.stats()}}), 200
 
 @app.route("/organ", methods=['POST'])
 def create_organ():
@@ -184,7 +128,7 @@ def create_organ():
             condition=data["condition"],
         )
 
-        db.collection("organs").document(data["organId"]).set(organ.to_dict())
+        organs.set(data["organId"], organ.to_dict())
 
         return jsonify({
             "code": 201,
@@ -202,23 +146,10 @@ def create_organ():
 def update_organ(organId):
     """Update an existing organ in Firestore."""
     try:
-        organ_ref = db.collection("organs").document(organId)
-        doc = organ_ref.get()
-        if not doc.exists:
-            return jsonify(
-                {
-                    "code": 404,
-                    "data": {
-                        "organId": organId
-                    },
-                    "message": "Organ not found."
-                }
-            ), 404
-
         # update status
         new_data = request.get_json()
         if new_data:
-            db.collection("organs").document(organId).set(new_data["data"], merge=True)
+            organs.update(organId, new_data["data"])
             return jsonify(
                 {
                     "code": 200,
@@ -230,6 +161,16 @@ def update_organ(organId):
                 "code": 400,
                 "message": "No data provided for update."
             }), 400
+    except NotFound:
+        return jsonify(
+            {
+                "code": 404,
+                "data": {
+                    "organId": organId
+                },
+                "message": "Organ not found."
+            }
+        ), 404
     except Exception as e:
         print("Error: {}".format(str(e)))
         return jsonify(
@@ -246,17 +187,13 @@ def update_organ(organId):
 def delete_organ(organId):
     """Delete an organ from Firestore."""
     try:
-        organ_ref = db.collection("organs").document(organId)
-        doc = organ_ref.get()
-
-        if not doc.exists:
-            return jsonify({"code": 404, "message": "Organ not found"}), 404
-
         # Delete the organ document from Firestore
-        organ_ref.delete()
+        organs.delete(organId, must_exist=True)
 
         return jsonify({"code": 200, "message": "Organ deleted successfully"}), 200
 
+    except NotFound:
+        return jsonify({"code": 404, "message": "Organ not found"}), 404
     except Exception as e:
         return jsonify({"code": 500, "message": str(e)}), 500
 
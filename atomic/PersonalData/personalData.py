@@ -1,79 +1,55 @@
 from datetime import datetime
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import firebase_admin
-from firebase_admin import credentials, firestore
 from os import environ
 import os
+from common.conditional import etag_response
+from common.export import ndjson_response, wants_ndjson
+from common.models import Model
+from common.pagination import page_args
+from common.repository import AlreadyExists, NotFound, open_repository
+from common.webapp import setup_app
 
 app = Flask(__name__)
 CORS(app)
+setup_app(app)
 
-# Load the key from an environment variable
-key_path = os.getenv("PERSONAL_DATA_DB_KEY")
-
-if not key_path or not os.path.isfile(key_path):
-    raise FileNotFoundError(f"Could not find the Firebase JSON at {key_path}")
-
-# Initialize Firestore
-cred = credentials.Certificate(key_path)
-firebase_app = firebase_admin.initialize_app(cred)
-print("Firestore initialized successfully for Person!")
-
-db = firestore.client()
-
-
-class Person:
-    def __init__(self, uuid, first_name, last_name, date_of_birth, nric, email, address, nok_contact):
-        self.uuid = uuid
-        self.first_name = first_name
-        self.last_name = last_name
-        self.date_of_birth = date_of_birth
-        self.nric = nric
-        self.email = email
-        self.address = address
-        self.nok_contact = nok_contact  # Next of kin contact details
-
-    def to_dict(self):
-        """Convert the object to a Firestore-compatible dictionary."""
-        return {
-            "firstName": self.first_name,
-            "lastName": self.last_name,
-            "dateOfBirth": self.date_of_birth,
-            "nric": self.nric,
-            "email": self.email,
-            "address": self.address,
-            "nokContact": self.nok_contact
-        }
-
-    @staticmethod
-    def from_dict(uuid, data):
-        """Create a Person object from Firestore document data."""
-        return Person(
-            uuid=uuid,
-            first_name=data.get("firstName"),
-            last_name=data.get("lastName"),
-            date_of_birth=data.get("dateOfBirth"),
-            nric=data.get("nric"),
-            email=data.get("email"),
-            address=data.get("address"),
-            nok_contact=data.get("nokContact")
-        )
+# Firebase credentials are only needed when DATA_BACKEND is firestore
+personal_data = open_repository("PersonalData", key_path=os.getenv("PERSONAL_DATA_DB_KEY"))
+
+
+class Person(Model):
+    __slots__ = ("uuid", "first_name", "last_name", "date_of_birth", "nric", "email", "address", "nok_contact")
+    ID = (None, "uuid")
+    FIELDS = (
+        ("firstName", "first_name", str, False, None),
+        ("lastName", "last_name", str, False, None),
+        ("dateOfBirth", "date_of_birth", None, False, None),
+        ("nric", "nric", str, False, None),
+        ("email", "email", str, False, None),
+        ("address", "address", str, False, None),
+        ("nokContact", "nok_contact", dict, False, None),  # Next of kin contact details
+    )
 
 
+def person_row(doc_id, person_data):
+    person_data["uuid"] = doc_id  # Include the document ID
+    return person_data
+
 @app.route("/person", methods=['GET'])
 def get_all():
+    """All persons keyed by uuid; accepts limit, startAfter and fields, or streams NDJSON."""
+    try:
+        paging = page_args(request.args)
+    except ValueError as e:
+        return jsonify({"code": 400, "message": str(e)}), 400
+    if wants_ndjson(request):
+        return ndjson_response(personal_data.stream(**paging), person_row)
     # Read data from Firestore
     try:
-        persons_ref = db.collection("PersonalData")
-        docs = persons_ref.get()
-        persons = {}
-
-        for doc in docs:
-            person_data = doc.to_dict()
-            person_data["uuid"] = doc.id  # Include the document ID
-            persons[doc.id] = person_data
-        return jsonify({"code": 200, "data": persons}), 200
+        docs, next_start_after = personal_data.page(**paging)
+        persons = {doc_id: person_row(doc_id, person_data) for doc_id, person_data in docs}
+        return jsonify({"code": 200, "data": persons, "nextStartAfter": next_start_after}), 200
     except Exception as e:
         return jsonify({"code": 500, "message": str(e)}), 500
 
@@ -81,11 +57,10 @@ def get_all():
 @app.route("/person/<string:uuid>")
 def get_person(uuid):
     try:
-        person_ref = db.collection("PersonalData").document(uuid)
-        doc = person_ref.get()
-        if doc.exists:
-            person_obj = Person.from_dict(uuid, doc.to_dict())
-            return jsonify({"code": 200, "data": person_obj.to_dict()})
+        person_data, version = personal_data.get_with_version(uuid)
+        if person_data is not None:
+            person_obj = Person.from_dict(uuid, person_data)
+            return etag_response(request, {"code": 200, "data": person_obj.to_dict()}, version)
         else:
             return jsonify({"code": 404, "message": "Person does not exist"}), 404
 
@@ -96,25 +71,22 @@ def get_person(uuid):
 @app.route("/person/<string:uuid>", methods=['PUT'])
 def update_person(uuid):
     try:
-        person_ref = db.collection("PersonalData").document(uuid)
-        doc = person_ref.get()
-        if not doc.exists:
-            return jsonify({
-                "code": 404,
-                "data": {"uuid": uuid},
-                "message": "Person not found."
-            }), 404
-
         new_data = request.get_json()
         if new_data:
             # Merge update into Firestore document.
-            db.collection("PersonalData").document(uuid).set(new_data["data"], merge=True)
+            personal_data.update(uuid, new_data["data"])
             return jsonify({"code": 200, "data": new_data["data"]}), 200
         else:
             return jsonify({
                 "code": 400,
                 "message": "No data provided for update."
             }), 400
+    except NotFound:
+        return jsonify({
+            "code": 404,
+            "data": {"uuid": uuid},
+            "message": "Person not found."
+        }), 404
     except Exception as e:
         return jsonify({
             "code": 500,
@@ -138,15 +110,6 @@ def create_person():
                 "message": "uuid is required."
             }), 400
 
-        # Reference to the person document in Firestore
-        person_ref = db.collection("PersonalData").document(uuid)
-        if person_ref.get().exists:
-            return jsonify({
-                "code": 409,
-                "data": {"uuid": uuid},
-                "message": "Person already exists."
-            }), 409
-
         # Create a new Person object from the provided data.
         new_person = Person(
             uuid=uuid,
@@ -160,7 +123,7 @@ def create_person():
         )
 
         # Save the new person to Firestore.
-        person_ref.set(new_person.to_dict())
+        personal_data.create(uuid, new_person.to_dict())
 
         return jsonify({
             "code": 201,
@@ -168,6 +131,12 @@ def create_person():
             "message": "Person created successfully."
         }), 201
 
+    except AlreadyExists:
+        return jsonify({
+            "code": 409,
+            "data": {"uuid": uuid},
+            "message": "Person already exists."
+        }), 409
     except Exception as e:
         return jsonify({
             "code": 500,
@@ -175,21 +144,81 @@ def create_person():
             "message": "An error occurred while creating the person: " + str(e)
         }), 500
 
+@app.route("/person/batch", methods=['POST'])
+def create_people():
+    """
+    Create many persons at once: {"data": [<person>, ...]}.
+    Existing documents are looked up in one get_many call and new ones are written in
+    batched commits. Returns one result per input record, in order.
+    """
+    try:
+        people = (request.get_json() or {}).get("data")
+        if not isinstance(people, list) or not people:
+            return jsonify({"code": 400, "message": "data must be a non-empty list."}), 400
+
+        results = [None] * len(people)
+        indexes = {}
+        for index, person_data in enumerate(people):
+            uuid = person_data.get("uuid") if isinstance(person_data, dict) else None
+            if not uuid:
+                results[index] = {"uuid": uuid, "code": 400, "message": "uuid is required."}
+            elif uuid in indexes:
+                results[index] = {"uuid": uuid, "code": 409, "message": "Duplicate uuid in batch."}
+            else:
+                indexes[uuid] = index
+
+        existing = personal_data.get_many(indexes)
+        writes = []
+        for uuid, index in indexes.items():
+            if uuid in existing:
+                results[index] = {"uuid": uuid, "code": 409, "message": "Person already exists."}
+                continue
+            person_data = people[index]
+            try:
+                new_person = Person(
+                    uuid=uuid,
+                    first_name=person_data["firstName"],
+                    last_name=person_data["lastName"],
+                    date_of_birth=person_data["dateOfBirth"],
+                    nric=person_data["nric"],
+                    email=person_data["email"],
+                    address=person_data["address"],
+                    nok_contact=person_data["nokContact"]
+                )
+            except KeyError as e:
+                results[index] = {"uuid": uuid, "code": 400, "message": f"Missing field {e}."}
+                continue
+            writes.append((index, new_person))
+
+        personal_data.set_many((new_person.uuid, new_person.to_dict()) for _, new_person in writes)
+        for index, new_person in writes:
+            results[index] = {"uuid": new_person.uuid, "code": 201, "message": "Person created successfully."}
+
+        code = 201 if all(result["code"] == 201 for result in results) else 207
+        return jsonify({
+            "code": code,
+            "data": results,
+            "message": f"Created {len(writes)} of {len(people)} person(s)."
+        }), code
+
+    except Exception as e:
+        return jsonify({
+            "code": 500,
+            "data": {},
+            "message": "An error occurred while creating the persons: " + str(e)
+        }), 500
+
 @app.route("/person/<string:uuid>", methods=['DELETE'])
 def delete_match(uuid):
     """Delete a PersonalData from Firestore."""
     try:
-        personal_data_ref = db.collection("PersonalData").document(uuid)
-        doc = personal_data_ref.get()
-
-        if not doc.exists:
-            return jsonify({"code": 404, "message": "PersonalData not found"}), 404
-
         # Delete the organ document from Firestore
-        personal_data_ref.delete()
+        personal_data.delete(uuid, must_exist=True)
 
         return jsonify({"code": 200, "message": "PersonalData deleted successfully"}), 200
 
+    except NotFound:
+        return jsonify({"code": 404, "message": "PersonalData not found"}), 404
     except Exception as e:
         return jsonify({"code": 500, "message": str(e)}), 500
 
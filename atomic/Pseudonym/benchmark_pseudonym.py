@@ -0,0 +1,103 @@
+"""
+Throughput of pii.process_pii on nested recipient-like records, against the previous
+implementation that re-classified every key (lower() plus substring scans) per value
+and rebuilt the colour list on every name.
+
+Run from atomic/Pseudonym:
+    python benchmark_pseudonym.py [records]
+"""
+
+import random
+import sys
+import time
+
+import pii
+
+
+def old_pseudonymise_value(key, value):
+    lkey = key.lower()
+    if isinstance(value, str):
+        if "email" in lkey:
+            return pii.masked_email(value)
+        elif "nric" in lkey:
+            return pii.masked_nric(value)
+        elif "dob" in lkey or "birth" in lkey:
+            return pii.masked_birth(value)
+        elif "phone" in lkey or "mobile" in lkey:
+            return pii.masked_phone_number(value)
+        elif "age" in lkey:
+            return pii.pseudo_age(value)
+        elif "name" in lkey:
+            return random.choice(list(pii.COLORS))
+        elif "address" in lkey:
+            return pii.pseudonymise_address(value)
+    return value
+
+
+def old_process_pii(data):
+    if isinstance(data, dict):
+        new_dict = {}
+        for key, value in data.items():
+            if isinstance(value, dict):
+                if key.lower() == "nokcontact":
+                    new_dict[key] = {
+                        "firstName": random.choice(list(pii.COLORS)),
+                        "lastName": random.choice(list(pii.COLORS)),
+                        "relationship": value.get("relationship", ""),
+                        "phone": pii.masked_phone_number(value.get("phone", "")) if value.get("phone") else ""
+                    }
+                else:
+                    new_dict[key] = old_process_pii(value)
+            elif isinstance(value, list):
+                new_dict[key] = [old_process_pii(item) if isinstance(item, (dict, list)) else item for item in value]
+            else:
+                new_dict[key] = old_pseudonymise_value(key, value)
+        return new_dict
+    elif isinstance(data, list):
+        return [old_process_pii(item) for item in data]
+    return data
+
+
+def make_record(i):
+    return {
+        "uuid": f"recipient-{i}",
+        "firstName": "Isaiah",
+        "lastName": "Chia",
+        "dateOfBirth": "1953-01-08",
+        "age": "71",
+        "nric": "S1234567A",
+        "email": "isaiah.chia@example.com",
+        "address": "11 Jln Tan Tock Seng, Singapore 308433",
+        "gender": "Male",
+        "bloodType": "O+",
+        "organsNeeded": ["heart", "kidney"],
+        "allergies": ["nuts", "aspirin"],
+        "medicalHistory": [
+            {"condition": "Hypertension", "diagnosedDate": "2001-02-03", "treatingDoctorName": "Tan", "notes": "stable"},
+            {"condition": "Diabetes", "diagnosedDate": "2010-04-05", "treatingDoctorName": "Lim", "notes": "type 2"},
+        ],
+        "nokContact": {"firstName": "Mary", "lastName": "Chia", "relationship": "Spouse", "phone": "91234567"},
+    }
+
+
+def rate(fn, records):
+    start = time.perf_counter()
+    for record in records:
+        fn(record)
+    return len(records) / (time.perf_counter() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    records = [make_record(i) for i in range(count)]
+
+    new_rate = rate(pii.process_pii, records)
+    old_rate = rate(old_process_pii, records)
+    print(f"{count} nested records")
+    print(f"{'uncached key scan':<28} {old_rate:>10,.0f} records/s  1.0x")
+    print(f"{'cached masking_function':<28} {new_rate:>10,.0f} records/s  {new_rate / old_rate:.1f}x")
+    print(f"distinct keys classified: {pii.masking_function.cache_info().currsize}")
+
+
+if __name__ == "__main__":
+    main()
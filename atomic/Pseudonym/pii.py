@@ -0,0 +1,181 @@
+"""
+PII masking shared by the Pseudonym service and the pseudonymise CLI.
+
+Which masker applies to a key is decided by substring rules on the lower-cased key;
+masking_function caches that decision per distinct key, so a large batch pays for the
+key scan once per key rather than once per value.
+"""
+
+import json
+import random
+from functools import lru_cache
+
+# Replacement names, picked at random
+COLORS = (
+    "red", "blue", "green", "yellow", "orange", "purple", "pink", "brown", "black", "white", "gray", "cyan", "magenta",
+    "lime", "maroon", "navy", "olive", "teal", "silver", "gold", "beige", "ivory", "tan", "coral", "salmon", "indigo",
+    "violet", "turquoise", "azure", "lavender", "chartreuse", "crimson", "scarlet", "amber", "burgundy", "plum",
+    "peach", "apricot", "rose", "ruby", "sapphire", "emerald", "jade", "topaz", "amethyst", "periwinkle", "mint",
+    "aqua", "fuchsia", "charcoal", "slate", "gunmetal", "copper", "bronze", "mahogany", "chestnut", "mauve", "cerulean",
+    "vermilion", "saffron", "khaki", "sepia", "taupe", "mustard", "sand", "wheat", "denim", "skyblue", "royalblue",
+    "midnightblue", "dodgerblue", "steelblue", "cornflowerblue", "cadetblue", "powderblue", "lightblue", "deepskyblue",
+    "lightskyblue", "darkblue", "mediumblue", "aquamarine", "springgreen", "mediumseagreen", "seagreen", "darkgreen",
+    "forestgreen", "limegreen", "palegreen", "lightgreen", "darkolivegreen", "olivedrab", "lawngreen", "greenyellow",
+    "yellowgreen", "darkkhaki", "palegoldenrod", "lightgoldenrodyellow", "lemonchiffon", "lightyellow", "goldenrod",
+    "darkgoldenrod", "orangered", "tomato", "darkorange", "chocolate", "saddlebrown", "rosybrown", "firebrick",
+    "indianred", "lightcoral", "darkred", "hotpink", "deeppink", "lightpink", "palevioletred", "mediumvioletred",
+    "orchid", "darkorchid", "mediumorchid", "thistle", "lightsteelblue", "ghostwhite", "aliceblue", "honeydew",
+    "floralwhite", "linen", "oldlace", "antiquewhite", "bisque", "blanchedalmond", "papayawhip", "moccasin",
+    "navajowhite", "mistyrose", "seashell", "snow", "whitesmoke", "gainsboro", "lightgray", "darkgray", "dimgray"
+)
+
+def pseudonymise_name(name):
+    # Return a random color from a predefined list.
+    return random.choice(COLORS)
+
+def pseudonymise_nok(nok):
+    # For a next-of-kin dictionary, pseudonymise the name fields and mask the phone.
+    return {
+        "firstName": pseudonymise_name(nok.get("firstName", "")),
+        "lastName": pseudonymise_name(nok.get("lastName", "")),
+        "relationship": nok.get("relationship", ""),
+        "phone": masked_phone_number(nok.get("phone", "")) if nok.get("phone") else ""
+    }
+
+def masked_phone_number(number):
+    if number and isinstance(number, str) and len(number) >= 3:
+        return "XXXXX" + number[-3:]
+    return number
+
+def masked_email(email):
+    # Turns example@gmail.com into exa****@gmail.com
+    if "@" in email:
+        symbol = "*"
+        parts = email.split("@")
+        hidden = parts[0][:3] + (symbol * (len(parts[0]) - 3))
+        return hidden + "@" + parts[1]
+    return email
+
+def pseudo_age(age):
+    try:
+        age_int = int(age)
+        rounded = 5 * round(age_int / 5)
+        return str(rounded)
+    except Exception:
+        return age
+
+def masked_nric(nric):
+    symbol = "X"
+    if nric and len(nric) > 5:
+        return nric[0] + symbol*4 + nric[5:]
+    return nric
+
+def masked_birth(dateOfBirth):
+    # For a date string "YYYY-MM-DD", mask parts of it, e.g. "1953-01-08" becomes "19XX-X1-X8"
+    symbol = "X"
+    try:
+        parts = dateOfBirth.split("-")
+        if len(parts) == 3:
+            return parts[0][:2] + symbol*2 + "-" + symbol + parts[1][1] + "-" + symbol + parts[2][1]
+        return dateOfBirth
+    except Exception:
+        return dateOfBirth
+
+def pseudonymise_address(address):
+    return "masked-address"
+
+@lru_cache(maxsize=4096)
+def masking_function(key):
+    """
+    Resolve the masker for a key once; records share a handful of distinct keys.
+    Personally Identifiable Info Keywords: [
+        "email", "nric", "dob",
+        "birth", "phone", "mobile",
+        "age", "first", "last" 
+        "name", "address"
+    ]
+    """
+    lkey = key.lower()
+    if "email" in lkey:
+        return masked_email
+    elif "nric" in lkey:
+        return masked_nric
+    elif "dob" in lkey or "birth" in lkey:
+        return masked_birth
+    elif "phone" in lkey or "mobile" in lkey:
+        return masked_phone_number
+    elif "age" in lkey:
+        return pseudo_age
+    elif "name" in lkey:
+        return pseudonymise_name
+    elif "address" in lkey:
+        return pseudonymise_address
+    return None
+
+def pseudonymise_value(key, value):
+    if isinstance(value, str):
+        mask = masking_function(key)
+        if mask is not None:
+            return mask(value)
+    return value
+
+def process_pii(data):
+    """
+    Recursively process a dict or list. If a key contains any PII substring, its value is masked.
+    Special handling is provided for nested structures such as nokContact.
+    """
+    if isinstance(data, dict):
+        new_dict = {}
+        for key, value in data.items():
+            if isinstance(value, str):
+                # Strings are the common case; skip the call through pseudonymise_value
+                mask = masking_function(key)
+                new_dict[key] = value if mask is None else mask(value)
+            elif isinstance(value, dict):
+                if key.lower() == "nokcontact":
+                    new_dict[key] = pseudonymise_nok(value)
+                else:
+                    new_dict[key] = process_pii(value)
+            elif isinstance(value, list):
+                new_dict[key] = [process_pii(item) if isinstance(item, (dict, list)) else item for item in value]
+            else:
+                new_dict[key] = value
+        return new_dict
+    elif isinstance(data, list):
+        return [process_pii(item) for item in data]
+    else:
+        return data
+
+def pseudonymise_record(record_id, record_data, id_field='uuid'):
+    """Return (masked_data, personal_data) for one record."""
+    # Process the data to pseudonymise/mask PII fields.
+    masked_data = process_pii(record_data)
+    masked_data[id_field] = record_id
+
+    # Build the personal data block.
+    personal_data = {
+        id_field: record_id,
+        "firstName": record_data.get("firstName", ""),
+        "lastName": record_data.get("lastName", ""),
+        "dateOfBirth": record_data.get("dateOfBirth", ""),
+        "nric": record_data.get("nric", ""),
+        "email": record_data.get("email", ""),
+        "address": record_data.get("address", ""),
+        "nokContact": record_data.get("nokContact", {})
+    }
+    return masked_data, personal_data
+
+
+def mask_ndjson_line(line, line_number=None):
+    """
+    Mask one NDJSON line and return the output line (without a newline).
+    Lines that are not JSON objects come back as an {"error", "line"} object so the
+    output stays one line per input line.
+    """
+    try:
+        record = json.loads(line)
+        if not isinstance(record, dict):
+            raise ValueError("expected a JSON object")
+        return json.dumps(process_pii(record), separators=(",", ":"))
+    except ValueError as e:
+        return json.dumps({"error": str(e), "line": line_number})
@@ -1,133 +1,56 @@
 from datetime import datetime
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 import os
-import random 
+from pii import mask_ndjson_line, pseudonymise_record
 
 app = Flask(__name__)
 CORS(app)
 
-def pseudonymise_name(name):
-    # Return a random color from a predefined list.
-    colors = [
-        "red", "blue", "green", "yellow", "orange", "purple", "pink", "brown", "black", "white", "gray", "cyan", "magenta",
-        "lime", "maroon", "navy", "olive", "teal", "silver", "gold", "beige", "ivory", "tan", "coral", "salmon", "indigo",
-        "violet", "turquoise", "azure", "lavender", "chartreuse", "crimson", "scarlet", "amber", "burgundy", "plum",
-        "peach", "apricot", "rose", "ruby", "sapphire", "emerald", "jade", "topaz", "amethyst", "periwinkle", "mint",
-        "aqua", "fuchsia", "charcoal", "slate", "gunmetal", "copper", "bronze", "mahogany", "chestnut", "mauve", "cerulean",
-        "vermilion", "saffron", "khaki", "sepia", "taupe", "mustard", "sand", "wheat", "denim", "skyblue", "royalblue",
-        "midnightblue", "dodgerblue", "steelblue", "cornflowerblue", "cadetblue", "powderblue", "lightblue", "deepskyblue",
-        "lightskyblue", "darkblue", "mediumblue", "aquamarine", "springgreen", "mediumseagreen", "seagreen", "darkgreen",
-        "forestgreen", "limegreen", "palegreen", "lightgreen", "darkolivegreen", "olivedrab", "lawngreen", "greenyellow",
-        "yellowgreen", "darkkhaki", "palegoldenrod", "lightgoldenrodyellow", "lemonchiffon", "lightyellow", "goldenrod",
-        "darkgoldenrod", "orangered", "tomato", "darkorange", "chocolate", "saddlebrown", "rosybrown", "firebrick",
-        "indianred", "lightcoral", "darkred", "hotpink", "deeppink", "lightpink", "palevioletred", "mediumvioletred",
-        "orchid", "darkorchid", "mediumorchid", "thistle", "lightsteelblue", "ghostwhite", "aliceblue", "honeydew",
-        "floralwhite", "linen", "oldlace", "antiquewhite", "bisque", "blanchedalmond", "papayawhip", "moccasin",
-        "navajowhite", "mistyrose", "seashell", "snow", "whitesmoke", "gainsboro", "lightgray", "darkgray", "dimgray"
-    ]
-    return random.choice(colors)
+MAX_BATCH_RECORDS = int(os.environ.get("PSEUDONYM_MAX_BATCH") or 10000)
 
-def pseudonymise_nok(nok):
-    # For a next-of-kin dictionary, pseudonymise the name fields and mask the phone.
-    return {
-        "firstName": pseudonymise_name(nok.get("firstName", "")),
-        "lastName": pseudonymise_name(nok.get("lastName", "")),
-        "relationship": nok.get("relationship", ""),
-        "phone": masked_phone_number(nok.get("phone", "")) if nok.get("phone") else ""
-    }
-
-def masked_phone_number(number):
-    if number and isinstance(number, str) and len(number) >= 3:
-        return "XXXXX" + number[-3:]
-    return number
-
-def masked_email(email):
-    # Turns example@gmail.com into exa****@gmail.com
-    if "@" in email:
-        symbol = "*"
-        parts = email.split("@")
-        hidden = parts[0][:3] + (symbol * (len(parts[0]) - 3))
-        return hidden + "@" + parts[1]
-    return email
-
-def pseudo_age(age):
+@app.route('/pseudonymise/batch', methods=['POST'])
+def pseudonymise_batch():
+    """
+    Pseudonymise many records in one call. Input is keyed by ID like /pseudonymise,
+    with any number of records; personalData is keyed by ID as well.
+    """
     try:
-        age_int = int(age)
-        rounded = 5 * round(age_int / 5)
-        return str(rounded)
-    except Exception:
-        return age
-
-def masked_nric(nric):
-    symbol = "X"
-    if nric and len(nric) > 5:
-        return nric[0] + symbol*4 + nric[5:]
-    return nric
+        data = request.get_json()
+        if not data or not isinstance(data, dict):
+            return jsonify({"code": 400, "message": "No data provided"}), 400
+        if len(data) > MAX_BATCH_RECORDS:
+            return jsonify({"code": 413, "message": f"At most {MAX_BATCH_RECORDS} records per batch"}), 413
 
-def masked_birth(dateOfBirth):
-    # For a date string "YYYY-MM-DD", mask parts of it, e.g. "1953-01-08" becomes "19XX-X1-X8"
-    symbol = "X"
-    try:
-        parts = dateOfBirth.split("-")
-        if len(parts) == 3:
-            return parts[0][:2] + symbol*2 + "-" + symbol + parts[1][1] + "-" + symbol + parts[2][1]
-        return dateOfBirth
-    except Exception:
-        return dateOfBirth
+        masked, personal = {}, {}
+        for record_id, record_data in data.items():
+            masked[record_id], personal[record_id] = pseudonymise_record(record_id, record_data)
 
-def pseudonymise_address(address):
-    return "masked-address"
+        return jsonify({
+            "code": 200,
+            "data": {"maskedData": masked, "personalData": personal},
+            "message": f"Successfully Pseudonymised {len(masked)} record(s)!"
+        }), 200
+    except Exception as e:
+        print("Error: {}".format(str(e)))
+        return jsonify({
+            "code": 500,
+            "message": "An error occurred while pseudonymising the batch. " + str(e)
+        }), 500
 
-def pseudonymise_value(key, value):
+@app.route('/pseudonymise/stream', methods=['POST'])
+def pseudonymise_stream():
     """
-    Personally Identifiable Info Keywords: [
-        "email", "nric", "dob",
-        "birth", "phone", "mobile",
-        "age", "first", "last" 
-        "name", "address"
-    ]
+    Mask an NDJSON body (one record per line) and stream NDJSON back, line for line.
+    The body is read incrementally, so memory use does not grow with the dataset.
     """
-    lkey = key.lower()
-    if isinstance(value, str):
-        if "email" in lkey:
-            return masked_email(value)
-        elif "nric" in lkey:
-            return masked_nric(value)
-        elif "dob" in lkey or "birth" in lkey:
-            return masked_birth(value)
-        elif "phone" in lkey or "mobile" in lkey:
-            return masked_phone_number(value)
-        elif "age" in lkey:
-            return pseudo_age(value)
-        elif "name" in lkey:
-            return pseudonymise_name(value)
-        elif "address" in lkey:
-            return pseudonymise_address(value)
-    return value
+    def generate():
+        for line_number, line in enumerate(request.stream, start=1):
+            line = line.strip()
+            if line:
+                yield mask_ndjson_line(line, line_number) + "\n"
 
-def process_pii(data):
-    """
-    Recursively process a dict or list. If a key contains any PII substring, its value is masked.
-    Special handling is provided for nested structures such as nokContact.
-    """
-    if isinstance(data, dict):
-        new_dict = {}
-        for key, value in data.items():
-            if isinstance(value, dict):
-                if key.lower() == "nokcontact":
-                    new_dict[key] = pseudonymise_nok(value)
-                else:
-                    new_dict[key] = process_pii(value)
-            elif isinstance(value, list):
-                new_dict[key] = [process_pii(item) if isinstance(item, (dict, list)) else item for item in value]
-            else:
-                new_dict[key] = pseudonymise_value(key, value)
-        return new_dict
-    elif isinstance(data, list):
-        return [process_pii(item) for item in data]
-    else:
-        return data
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
 
 @app.route('/pseudonymise', methods=['POST'])
 def pseudonymise_service():
@@ -142,23 +65,7 @@ def pseudonymise_service():
         # Assume the JSON contains a single record keyed by an ID.
         record_id, record_data = list(data.items())[0]
 
-        id_field = 'uuid'
-
-       # Process the data to pseudonymise/mask PII fields.
-        masked_data = process_pii(record_data)
-        masked_data[id_field] = record_id
-
-        # Build the personal data block.
-        personal_data = {
-            id_field: record_id,
-            "firstName": record_data.get("firstName", ""),
-            "lastName": record_data.get("lastName", ""),
-            "dateOfBirth": record_data.get("dateOfBirth", ""),
-            "nric": record_data.get("nric", ""),
-            "email": record_data.get("email", ""),
-            "address": record_data.get("address", ""),
-            "nokContact": record_data.get("nokContact", {})
-        }
+        masked_data, personal_data = pseudonymise_record(record_id, record_data)
 
         response = {
             "maskedData": { record_id: masked_data },
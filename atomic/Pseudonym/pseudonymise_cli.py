@@ -0,0 +1,116 @@
+"""
+Mask an NDJSON dataset (one record per line) with the same rules as the Pseudonym service.
+
+Input is read in chunks of --chunk-size lines and masked by --workers processes; at most
+two chunks per worker are in flight, so memory stays flat however large the file is.
+Output keeps the input order.
+
+    python pseudonymise_cli.py donors.ndjson -o donors.masked.ndjson --workers 4
+    cat donors.ndjson | python pseudonymise_cli.py > masked.ndjson
+    python pseudonymise_cli.py --from-export ../Organ/getAllDonors.json -o donors.masked.ndjson
+
+--from-export reads a service export ({"data": {id: record, ...}}) instead of NDJSON.
+It loads that file whole, so use it for conversions, not for large dumps.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from itertools import islice
+
+from pii import mask_ndjson_line
+
+
+def mask_chunk(chunk):
+    """Worker: mask a list of (line_number, line) pairs."""
+    return [mask_ndjson_line(line, line_number) for line_number, line in chunk]
+
+
+def read_lines(stream):
+    for line_number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if line:
+            yield line_number, line
+
+
+def read_export(path):
+    with open(path) as f:
+        export = json.load(f)
+    records = export.get("data", export) if isinstance(export, dict) else export
+    if isinstance(records, dict):
+        records = records.values()
+    for line_number, record in enumerate(records, start=1):
+        yield line_number, json.dumps(record)
+
+
+def chunks(items, size):
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def run(lines, out, workers, chunk_size):
+    """Mask lines into out; returns the number of records written."""
+    written = 0
+    if workers <= 1:
+        for chunk in chunks(lines, chunk_size):
+            for masked in mask_chunk(chunk):
+                out.write(masked + "\n")
+            written += len(chunk)
+        return written
+
+    with multiprocessing.get_context("spawn").Pool(workers) as pool:
+        in_flight = deque()
+        for chunk in chunks(lines, chunk_size):
+            in_flight.append(pool.apply_async(mask_chunk, (chunk,)))
+            # Bound memory: wait for the oldest chunk before reading further ahead
+            while len(in_flight) >= workers * 2:
+                written += write_chunk(in_flight.popleft().get(), out)
+        while in_flight:
+            written += write_chunk(in_flight.popleft().get(), out)
+    return written
+
+
+def write_chunk(masked_lines, out):
+    for masked in masked_lines:
+        out.write(masked + "\n")
+    return len(masked_lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mask PII in an NDJSON dataset.")
+    parser.add_argument("input", nargs="?", help="NDJSON file (default: stdin)")
+    parser.add_argument("-o", "--output", help="output file (default: stdout)")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", type=int, default=1000, help="lines per worker task")
+    parser.add_argument("--from-export", metavar="PATH", help="read a JSON service export instead of NDJSON")
+    args = parser.parse_args()
+
+    if args.from_export:
+        lines, source = read_export(args.from_export), None
+    else:
+        source = open(args.input) if args.input else sys.stdin
+        lines = read_lines(source)
+    out = open(args.output, "w") if args.output else sys.stdout
+
+    start = time.perf_counter()
+    try:
+        written = run(lines, out, args.workers, args.chunk_size)
+    finally:
+        if source not in (None, sys.stdin):
+            source.close()
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.perf_counter() - start
+    print(f"Masked {written} record(s) in {elapsed:.2f}s with {args.workers} worker(s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,98 +2,65 @@ from datetime import datetime
 import uuid
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import firebase_admin
-from firebase_admin import credentials, firestore
 import os
+from common.conditional import etag_response
+from common.export import ndjson_response, wants_ndjson
+from common.models import Model
+from common.pagination import page_args
+from common.repository import AlreadyExists, NotFound, open_repository
+from common.webapp import setup_app
 
 app = Flask(__name__)
 CORS(app)
+setup_app(app)
 
-# Load Firebase credentials
-key_path = os.getenv("RECIPIENT_DB_KEY") 
+# Firebase credentials are only needed when DATA_BACKEND is firestore
+recipients_repo = open_repository(
+    "recipients",
+    key_path=os.getenv("RECIPIENT_DB_KEY"),
+    project_id="esd-recipient",
+)
 
-if not key_path or not os.path.isfile(key_path):
-    raise FileNotFoundError(f"Could not find the Firebase JSON at {key_path}")
+class Recipient(Model):
+    __slots__ = ("recipient_id", "first_name", "last_name", "date_of_birth", "nric", "email", "address",
+                 "gender", "blood_type", "organs_needed", "medical_history", "allergies", "nok_contact")
+    ID = (None, "recipient_id")
+    FIELDS = (
+        ("firstName", "first_name", str, True, None),
+        ("lastName", "last_name", str, True, None),
+        ("dateOfBirth", "date_of_birth", None, True, None),
+        ("nric", "nric", str, True, None),
+        ("email", "email", str, True, None),
+        ("address", "address", str, True, None),
+        ("gender", "gender", str, True, None),
+        ("bloodType", "blood_type", str, True, None),
+        ("organsNeeded", "organs_needed", list, True, None),
+        ("medicalHistory", "medical_history", list, True, None),
+        ("allergies", "allergies", list, True, None),
+        ("nokContact", "nok_contact", dict, True, None),
+    )
 
-# Initialize Firestore only if it hasn't been initialized
-if not firebase_admin._apps:
-    cred = credentials.Certificate(key_path)  
-    firebase_app = firebase_admin.initialize_app(cred, {
-        'projectId': 'esd-recipient'  # Specify the project ID here
-    })
-
-
-print("Firestore initialized successfully for Recipient!")
-
-db = firestore.client()
-
-class Recipient:
-    def __init__(self, recipient_id, first_name, last_name, date_of_birth, nric, email, address,
-                 gender, blood_type, organs_needed, medical_history, allergies, nok_contact):
-        self.recipient_id = recipient_id
-        self.first_name = first_name
-        self.last_name = last_name
-        self.date_of_birth = date_of_birth
-        self.nric = nric
-        self.email = email
-        self.address = address
-        self.gender = gender
-        self.blood_type = blood_type
-        self.organs_needed = organs_needed
-        self.medical_history = medical_history
-        self.allergies = allergies
-        self.nok_contact = nok_contact
-
-    def to_dict(self):
-        """Convert the object to a Firestore-compatible dictionary."""
-        return {
-            "firstName": self.first_name,
-            "lastName": self.last_name,
-            "dateOfBirth": self.date_of_birth,
-            "nric": self.nric,
-            "email": self.email,
-            "address": self.address,
-            "gender": self.gender,
-            "bloodType": self.blood_type,
-            "organsNeeded": self.organs_needed,
-            "medicalHistory": self.medical_history,
-            "allergies": self.allergies,
-            "nokContact": self.nok_contact
-        }
-
-    @staticmethod
-    def from_dict(recipient_id, data):
-        """Create a Recipient object from Firestore document data."""
-        return Recipient(
-            recipient_id=recipient_id,
-            first_name=data["firstName"],
-            last_name=data["lastName"],
-            date_of_birth=data["dateOfBirth"],
-            nric=data["nric"],
-            email=data["email"],
-            address=data["address"],
-            gender=data["gender"],
-            blood_type=data["bloodType"],
-            organs_needed=data["organsNeeded"],
-            medical_history=data["medicalHistory"],
-            allergies=data["allergies"],
-            nok_contact=data["nokContact"]
-        )
+def recipient_row(doc_id, recipient_data):
+    recipient_data["recipientId"] = doc_id  # Add Firestore document ID
+    return recipient_data
 
 @app.route("/recipient", methods=['GET'])
 def get_all():
-    """Retrieve all recipients from Firestore."""
+    """
+    Retrieve all recipients from Firestore; accepts limit, startAfter and fields.
+    Streams NDJSON when the client accepts application/x-ndjson.
+    """
     try:
-        recipient_ref = db.collection("recipients")
-        docs = recipient_ref.get()
-        recipients = {}
-
-        for doc in docs:
-            recipient_data = doc.to_dict()
-            recipient_data["recipientId"] = doc.id  # Add Firestore document ID
-            recipients[doc.id] = recipient_data
+        paging = page_args(request.args)
+    except ValueError as e:
+        return jsonify({"code": 400, "message": str(e)}), 400
+    if wants_ndjson(request):
+        return ndjson_response(recipients_repo.stream(**paging), recipient_row)
+    try:
+        docs, next_start_after = recipients_repo.page(**paging)
+        recipients = {doc_id: recipient_row(doc_id, recipient_data) for doc_id, recipient_data in docs}
 
-        return jsonify({"code": 200, "data": recipients}), 200
+        return jsonify({"code": 200, "data": recipients, "nextStartAfter": next_start_after}), 200
 
     except Exception as e:
         return jsonify({"code": 500, "message": str(e)}), 500
@@ -101,11 +68,10 @@ def get_all():
 @app.route("/recipient/<string:recipientId>", methods=['GET'])
 def get_recipient(recipientId):
     try:
-        recipient_ref = db.collection("recipients").document(recipientId)
-        doc = recipient_ref.get()
-        if doc.exists:
-            recipient_obj = Recipient.from_dict(recipientId, doc.to_dict())
-            return {"code":200, "data": recipient_obj.to_dict()}  # Convert back to JSON-friendly format
+        recipient_data, version = recipients_repo.get_with_version(recipientId)
+        if recipient_data is not None:
+            recipient_obj = Recipient.from_dict(recipientId, recipient_data)
+            return etag_response(request, {"code":200, "data": recipient_obj.to_dict()}, version)
         else:
             return jsonify({"code":404, "message": "Recipient does not exist"}), 404
 
@@ -116,23 +82,10 @@ def get_recipient(recipientId):
 @app.route("/recipient/<string:recipientId>", methods=['PUT'])
 def update_recipient(recipientId):
     try:
-        recipient_ref = db.collection("recipients").document(recipientId)
-        doc = recipient_ref.get()
-        if not doc.exists:
-            return jsonify(
-                {
-                    "code": 404,
-                    "data": {
-                        "recipientId": recipientId
-                    },
-                    "message": "Recipient not found."
-                }
-            ), 404
-
         # update status
         new_data = request.get_json()
         if new_data:
-            db.collection("recipients").document(recipientId).set(new_data["data"], merge=True)
+            recipients_repo.update(recipientId, new_data["data"])
             return jsonify(
                 {
                     "code": 200,
@@ -144,6 +97,16 @@ def update_recipient(recipientId):
                 "code": 400,
                 "message": "No data provided for update."
             }), 400
+    except NotFound:
+        return jsonify(
+            {
+                "code": 404,
+                "data": {
+                    "recipientId": recipientId
+                },
+                "message": "Recipient not found."
+            }
+        ), 404
     except Exception as e:
         print("Error: {}".format(str(e)))
         return jsonify(
@@ -159,22 +122,8 @@ def update_recipient(recipientId):
 @app.route("/recipient/<string:recipientId>", methods=["DELETE"])
 def delete_recipient(recipientId):
     try:
-        recipient_ref = db.collection("recipients").document(recipientId)
-        doc = recipient_ref.get()
-        
-        if not doc.exists:
-            return jsonify(
-                {
-                    "code": 404,
-                    "data": {
-                        "recipientId": recipientId
-                    },
-                    "message": "Recipient not found."
-                }
-            ), 404
-
         # Delete the document
-        recipient_ref.delete()
+        recipients_repo.delete(recipientId, must_exist=True)
 
         return jsonify(
             {
@@ -186,6 +135,16 @@ def delete_recipient(recipientId):
             }
         ), 200
 
+    except NotFound:
+        return jsonify(
+            {
+                "code": 404,
+                "data": {
+                    "recipientId": recipientId
+                },
+                "message": "Recipient not found."
+            }
+        ), 404
     except Exception as e:
         print("Error:", str(e))
         return jsonify(
@@ -213,15 +172,6 @@ def create_recipient():
                 "message": "Recipient ID is required."
             }), 400
 
-        # Reference to the donor document in Firestore
-        recipient_ref = db.collection("recipients").document(recipient_id)
-        if recipient_ref.get().exists:
-            return jsonify({
-                "code": 409,
-                "data": {"recipientId": recipient_id},
-                "message": "Recipient already exists."
-            }), 409
-
         # Create a new recipient object
         new_recipient = Recipient(
             recipient_id=recipient_id,
@@ -241,8 +191,7 @@ def create_recipient():
         
 
         # Store the recipient data in Firestore
-        recipient_ref = db.collection("recipients").document(recipient_id)
-        recipient_ref.set(new_recipient.to_dict())
+        recipients_repo.create(recipient_id, new_recipient.to_dict())
 
         return jsonify(
             {
@@ -252,6 +201,12 @@ def create_recipient():
             }
         ), 201
 
+    except AlreadyExists:
+        return jsonify({
+            "code": 409,
+            "data": {"recipientId": recipient_id},
+            "message": "Recipient already exists."
+        }), 409
     except Exception as e:
         print("Error:", str(e))
         return jsonify(
@@ -261,6 +216,84 @@ def create_recipient():
             }
         ), 500
 
+@app.route("/recipient/batch", methods=["POST"])
+def create_recipients():
+    """
+    Create many recipients at once: {"data": [<recipient>, ...]}.
+    Existing documents are looked up in one get_many call and new ones are written in
+    batched commits. Returns one result per input record, in order.
+    """
+    try:
+        recipients = (request.get_json() or {}).get("data")
+        if not isinstance(recipients, list) or not recipients:
+            return jsonify({"code": 400, "message": "data must be a non-empty list."}), 400
+
+        results = [None] * len(recipients)
+        indexes = {}
+        for index, data in enumerate(recipients):
+            recipient_id = data.get("recipientId") if isinstance(data, dict) else None
+            if not recipient_id:
+                results[index] = {"recipientId": recipient_id, "code": 400, "message": "Recipient ID is required."}
+            elif recipient_id in indexes:
+                results[index] = {"recipientId": recipient_id, "code": 409, "message": "Duplicate recipient ID in batch."}
+            else:
+                indexes[recipient_id] = index
+
+        existing = recipients_repo.get_many(indexes)
+        writes = []
+        for recipient_id, index in indexes.items():
+            if recipient_id in existing:
+                results[index] = {"recipientId": recipient_id, "code": 409, "message": "Recipient already exists."}
+                continue
+            data = recipients[index]
+            try:
+                new_recipient = Recipient(
+                    recipient_id=recipient_id,
+                    first_name=data["firstName"],
+                    last_name=data["lastName"],
+                    date_of_birth=data["dateOfBirth"],
+                    nric=data["nric"],
+                    email=data["email"],
+                    address=data["address"],
+                    gender=data["gender"],
+                    blood_type=data["bloodType"],
+                    medical_history=data["medicalHistory"],
+                    organs_needed=data["organsNeeded"],
+                    allergies=data["allergies"],
+                    nok_contact=data["nokContact"],
+                )
+            except KeyError as e:
+                results[index] = {"recipientId": recipient_id, "code": 400, "message": f"Missing field {e}."}
+                continue
+            writes.append((index, new_recipient))
+
+        recipients_repo.set_many(
+            (new_recipient.recipient_id, new_recipient.to_dict()) for _, new_recipient in writes
+        )
+        for index, new_recipient in writes:
+            results[index] = {
+                "recipientId": new_recipient.recipient_id,
+                "code": 201,
+                "message": "Recipient successfully created."
+            }
+
+        code = 201 if all(result["code"] == 201 for result in results) else 207
+        return jsonify({
+            "code": code,
+            "data": results,
+            "message": f"Created {len(writes)} of {len(recipients)} recipient(s)."
+        }), code
+
+    except Exception as e:
+        print("Error:", str(e))
+        return jsonify(
+            {
+                "code": 500,
+                "message": "An error occurred while creating the recipients. " + str(e)
+            }
+        ), 500
+
+
 if __name__ == '__main__':
     print("Starting Flask server for recipient management...")
     app.run(host='0.0.0.0', port=5013, debug=True)
@@ -5,6 +5,10 @@ References:
 https://pika.readthedocs.io/en/stable/_modules/pika/exceptions.html#ConnectionClosed
 """
 
+import collections
+import json
+import os
+import threading
 import time
 import pika
 
@@ -83,9 +87,11 @@ def start_consuming(
                      exchange_type=exchange_type,
                 )
 
-                # Actively declare the queue (this will create it if it doesn't exist)
+                # Actively declare the queue (this will create it if it doesn't exist),
+                # with the same arguments as the topology manifest so the declarations agree
                 print(f"Declaring queue: {queue_name}")
-                channel.queue_declare(queue=queue_name, durable=True, passive=False)
+                spec = load_topology()["queues"].get(queue_name, {})
+                channel.queue_declare(queue=queue_name, durable=True, passive=False, arguments=spec.get("arguments"))
 
                 print(f"Consuming from queue: {queue_name}")
                 channel.basic_consume(
@@ -108,3 +114,657 @@ def start_consuming(
 
           # Other types of exception are passed on to caller to handle.
           # Most likely, system issue - RabbitMQ host overload.
+
+
+def consume_batches(hostname, port, queue_name, handle_batch, batch_size=500, flush_interval=1.0,
+                    topology=None, retry_interval=5, stop=None, max_retries=None):
+    """
+    Consume queue_name in batches over a blocking connection, reconnecting on failure.
+
+    handle_batch(messages) gets a list of (method, properties, body) tuples once batch_size
+    messages have arrived or flush_interval seconds have passed since the first one. The whole
+    batch is acked with a single multiple=True ack after handle_batch returns. If it raises,
+    each message is handled on its own; the ones that still fail go through the broker-side
+    retry queues and end up in the DLQ after max_retries attempts (see retry_or_dead_letter),
+    so a message that can never be stored does not block the queue.
+
+    Setting the optional stop event ends consumption within flush_interval: the current
+    batch is handled and acked, and prefetched messages go back to the queue on close.
+    """
+    if max_retries is None:
+        max_retries = (topology or {}).get("retry", {}).get("max_retries", MAX_RETRIES)
+    while stop is None or not stop.is_set():
+        connection = None
+        try:
+            if topology is not None:
+                ensure_topology(hostname, port, topology)
+            print(f"Connecting to AMQP broker {hostname}:{port}...")
+            connection = pika.BlockingConnection(
+                pika.ConnectionParameters(host=hostname, port=int(port), heartbeat=300, blocked_connection_timeout=300)
+            )
+            channel = connection.channel()
+            if topology is None:
+                declare_retry_queues(channel, queue_name, max_retries)
+            channel.basic_qos(prefetch_count=batch_size * 2)
+            print(f"Consuming from queue: {queue_name} in batches of up to {batch_size}")
+
+            batch = []
+            deadline = None
+            for method, properties, body in channel.consume(queue_name, inactivity_timeout=flush_interval):
+                stopping = stop is not None and stop.is_set()
+                if method is not None:
+                    headers = properties.headers or {}
+                    if "x-original-routing-key" in headers:  # back from a retry queue
+                        method.exchange = headers.get("x-original-exchange", method.exchange)
+                        method.routing_key = headers["x-original-routing-key"]
+                    batch.append((method, properties, body))
+                    if deadline is None:
+                        deadline = time.monotonic() + flush_interval
+                if not batch:
+                    if stopping:
+                        break
+                    continue
+                if len(batch) < batch_size and method is not None and time.monotonic() < deadline and not stopping:
+                    continue
+                last_tag = batch[-1][0].delivery_tag
+                try:
+                    handle_batch(batch)
+                except Exception as e:
+                    print(f"Batch of {len(batch)} failed, handling its messages one by one: {e}")
+                    _handle_singly(channel, queue_name, handle_batch, batch, max_retries)
+                else:
+                    channel.basic_ack(delivery_tag=last_tag, multiple=True)
+                batch = []
+                deadline = None
+                if stopping:
+                    break
+
+        except pika.exceptions.AMQPError as e:
+            print(f"AMQP error: {e}. Reconnecting in {retry_interval} seconds...")
+        except KeyboardInterrupt:
+            break
+        finally:
+            if connection is not None and connection.is_open:
+                try:
+                    connection.close()
+                except pika.exceptions.AMQPError:
+                    pass
+        if stop is not None:
+            stop.wait(retry_interval)
+        else:
+            time.sleep(retry_interval)
+
+
+def _handle_singly(channel, queue_name, handle_batch, batch, max_retries):
+    """Ack the messages of a failed batch that succeed alone; retry or dead-letter the rest."""
+    for message in batch:
+        method, properties, body = message
+        try:
+            handle_batch([message])
+        except Exception as e:
+            retry_or_dead_letter(channel, method, properties, body, queue_name, e, max_retries)
+        else:
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+
+
+class BatchConsumer:
+    """consume_batches() on a daemon thread, with start() and a draining stop()."""
+
+    def __init__(self, hostname, port, queue_name, handle_batch, **kwargs):
+        self.args = (hostname, port, queue_name, handle_batch)
+        self.kwargs = kwargs
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the consumer thread (idempotent)."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name="amqp-batch-consumer", daemon=True)
+            self._thread.start()
+        return self
+
+    def run(self):
+        consume_batches(*self.args, stop=self._stop, **self.kwargs)
+
+    def stop(self, timeout=10):
+        """Handle and ack the batch in progress, then disconnect."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+class Publisher:
+    """
+    Background AMQP publisher shared by the request and consumer threads of a service.
+
+    The publisher owns its own connection and IOLoop thread, so publish() only appends
+    to a bounded local buffer and never blocks on broker I/O. Buffered messages are
+    flushed in batches on the IOLoop thread and kept until the broker confirms them;
+    nacked or unconfirmed messages go back to the front of the buffer and are resent
+    after a reconnect. If the broker stays down long enough for the buffer to fill up,
+    the oldest messages are dropped.
+    """
+
+    def __init__(self, hostname, port, batch_size=100, flush_interval=0.01,
+                 buffer_size=10000, retry_interval=5):
+        self.hostname = hostname
+        self.port = int(port)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.retry_interval = retry_interval
+        self.stats = {"published": 0, "confirmed": 0, "nacked": 0, "dropped": 0}
+
+        self._buffer = collections.deque()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._channel = None
+        self._unconfirmed = {}  # delivery_tag -> message, only touched on the IOLoop thread
+        self._delivery_tag = 0
+        self._flush_scheduled = False
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        """Start the publisher thread (idempotent)."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="amqp-publisher", daemon=True)
+            self._thread.start()
+        return self
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        """Queue a message for publishing. Dicts and lists are sent as JSON."""
+        self.publish_many([(exchange, routing_key, body, properties)])
+
+    def publish_many(self, messages):
+        """Queue several (exchange, routing_key, body[, properties]) messages at once."""
+        batch = [self._make_message(*message) for message in messages]
+        with self._lock:
+            for message in batch:
+                if len(self._buffer) >= self.buffer_size:
+                    self._buffer.popleft()
+                    self.stats["dropped"] += 1
+                    print("Publisher buffer full, dropping oldest message")
+                self._buffer.append(message)
+        self._schedule_flush()
+
+    def pending(self):
+        """Number of messages that are buffered or awaiting a broker confirm."""
+        with self._lock:
+            return len(self._buffer) + len(self._unconfirmed)
+
+    def close(self, timeout=5):
+        """Wait up to timeout seconds for buffered messages to be confirmed, then disconnect."""
+        deadline = time.time() + timeout
+        while self.pending() and self._channel is not None and time.time() < deadline:
+            time.sleep(0.05)
+        self._stopping = True
+        connection = self._connection
+        if connection is not None:
+            try:
+                connection.ioloop.add_callback_threadsafe(self._close_connection)
+            except Exception as e:
+                print(f"Publisher close failed: {e}")
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @staticmethod
+    def _make_message(exchange, routing_key, body, properties=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+        elif not isinstance(body, (str, bytes)):
+            body = str(body)
+        if properties is None:
+            properties = pika.BasicProperties(delivery_mode=2)  # make message persistent
+        return (exchange, routing_key, body, properties)
+
+    def _schedule_flush(self):
+        with self._lock:
+            if self._flush_scheduled or self._channel is None:
+                # Either a flush is already pending or we are (re)connecting;
+                # the buffer is flushed as soon as the channel opens.
+                return
+            self._flush_scheduled = True
+            connection = self._connection
+        try:
+            connection.ioloop.add_callback_threadsafe(
+                lambda: connection.ioloop.call_later(self.flush_interval, self._flush)
+            )
+        except Exception as e:
+            print(f"Publisher unable to schedule flush: {e}")
+            with self._lock:
+                self._flush_scheduled = False
+
+    def _flush(self):
+        with self._lock:
+            self._flush_scheduled = False
+            count = min(self.batch_size, len(self._buffer))
+            batch = [self._buffer.popleft() for _ in range(count)]
+        channel = self._channel
+        for index, message in enumerate(batch):
+            if channel is None or not channel.is_open:
+                self._requeue(batch[index:])
+                return
+            exchange, routing_key, body, properties = message
+            try:
+                channel.basic_publish(
+                    exchange=exchange, routing_key=routing_key, body=body, properties=properties
+                )
+            except Exception as e:
+                print(f"Publisher failed to publish to {exchange} ({routing_key}): {e}")
+                self._requeue(batch[index:])
+                return
+            self._delivery_tag += 1
+            self._unconfirmed[self._delivery_tag] = message
+            self.stats["published"] += 1
+        with self._lock:
+            more = bool(self._buffer)
+        if more:
+            self._schedule_flush()
+
+    def _requeue(self, messages):
+        with self._lock:
+            self._buffer.extendleft(reversed(messages))
+            while len(self._buffer) > self.buffer_size:
+                self._buffer.pop()
+                self.stats["dropped"] += 1
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        if method.multiple:
+            tags = [tag for tag in self._unconfirmed if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        messages = [self._unconfirmed.pop(tag) for tag in sorted(tags) if tag in self._unconfirmed]
+        if isinstance(method, pika.spec.Basic.Ack):
+            self.stats["confirmed"] += len(messages)
+        else:
+            print(f"Broker nacked {len(messages)} message(s), requeueing")
+            self.stats["nacked"] += len(messages)
+            self._requeue(messages)
+            self._schedule_flush()
+
+    def _run(self):
+        parameters = pika.ConnectionParameters(
+            host=self.hostname,
+            port=self.port,
+            heartbeat=300,
+            blocked_connection_timeout=300,
+        )
+        while not self._stopping:
+            try:
+                print(f"Publisher connecting to AMQP broker {self.hostname}:{self.port}...")
+                connection = pika.SelectConnection(
+                    parameters=parameters,
+                    on_open_callback=self._on_connection_open,
+                    on_open_error_callback=self._on_connection_open_error,
+                    on_close_callback=self._on_connection_closed,
+                )
+                connection.ioloop.start()
+            except Exception as e:
+                print(f"Publisher connection error: {e}")
+            if not self._stopping:
+                print(f"Publisher reconnecting in {self.retry_interval} seconds...")
+                time.sleep(self.retry_interval)
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=lambda channel: self._on_channel_open(connection, channel))
+
+    def _on_connection_open_error(self, connection, error):
+        print(f"Publisher failed to connect: {error}")
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, connection, channel):
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(self._on_confirm)
+        self._delivery_tag = 0
+        with self._lock:
+            self._connection = connection
+            self._channel = channel
+            self._flush_scheduled = False
+        print("Publisher channel opened")
+        self._schedule_flush()
+
+    def _on_channel_closed(self, channel, reason):
+        print(f"Publisher channel closed: {reason}")
+        connection = self._connection
+        if connection is not None and connection.is_open:
+            connection.close()
+
+    def _on_connection_closed(self, connection, reason):
+        print(f"Publisher connection closed: {reason}")
+        with self._lock:
+            self._connection = None
+            self._channel = None
+        unconfirmed = [self._unconfirmed[tag] for tag in sorted(self._unconfirmed)]
+        self._unconfirmed.clear()
+        if unconfirmed:
+            self._requeue(unconfirmed)
+        connection.ioloop.stop()
+
+    def _close_connection(self):
+        connection = self._connection
+        if connection is not None and connection.is_open:
+            connection.close()
+
+
+# Failed messages are parked in per-queue retry queues instead of being republished
+# straight back to their queue. Each retry queue holds messages for a fixed TTL and then
+# dead-letters them to the default exchange, i.e. back onto the original queue.
+# Once MAX_RETRIES is exhausted the message ends up in the queue's DLQ.
+RETRY_EXCHANGE = "retry_exchange"
+DEAD_LETTER_EXCHANGE = "dead_letter_exchange"
+MAX_RETRIES = 3
+RETRY_BASE_DELAY_MS = 5000  # 5s, 20s, 80s
+RETRY_BACKOFF = 4
+
+
+def retry_queue_name(queue_name, attempt):
+    return f"{queue_name}.retry.{attempt}"
+
+
+def dead_letter_queue_name(queue_name):
+    return f"{queue_name}.dlq"
+
+
+def retry_delay_ms(attempt, base_delay_ms=RETRY_BASE_DELAY_MS, backoff=RETRY_BACKOFF):
+    return base_delay_ms * backoff ** (attempt - 1)
+
+
+def declare_retry_queues(channel, queue_name, max_retries=MAX_RETRIES,
+                         base_delay_ms=RETRY_BASE_DELAY_MS, backoff=RETRY_BACKOFF):
+    """Declare the retry queues and DLQ for queue_name. Works on blocking and async channels."""
+    channel.exchange_declare(exchange=RETRY_EXCHANGE, exchange_type="direct", durable=True)
+    channel.exchange_declare(exchange=DEAD_LETTER_EXCHANGE, exchange_type="direct", durable=True)
+    for attempt in range(1, max_retries + 1):
+        name = retry_queue_name(queue_name, attempt)
+        channel.queue_declare(
+            queue=name,
+            durable=True,
+            arguments={
+                "x-message-ttl": retry_delay_ms(attempt, base_delay_ms, backoff),
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": queue_name,
+            },
+        )
+        channel.queue_bind(exchange=RETRY_EXCHANGE, queue=name, routing_key=name)
+    dlq = dead_letter_queue_name(queue_name)
+    channel.queue_declare(queue=dlq, durable=True)
+    channel.queue_bind(exchange=DEAD_LETTER_EXCHANGE, queue=dlq, routing_key=queue_name)
+
+
+def retry_or_dead_letter(channel, method, properties, body, queue_name, error=None,
+                         max_retries=MAX_RETRIES):
+    """
+    Route a failed delivery to its next retry queue, or to the DLQ once retries are
+    exhausted, then ack the original. The original exchange and routing key are kept in
+    the headers so the consumer sees the same routing key when the message comes back.
+    """
+    headers = dict(properties.headers or {})
+    retry_count = headers.get("x-retry-count", 0)
+    headers.setdefault("x-original-exchange", method.exchange)
+    headers.setdefault("x-original-routing-key", method.routing_key)
+    if error is not None:
+        headers["x-last-error"] = str(error)[:500]
+
+    if retry_count < max_retries:
+        headers["x-retry-count"] = retry_count + 1
+        exchange = RETRY_EXCHANGE
+        routing_key = retry_queue_name(queue_name, retry_count + 1)
+        print(f"Scheduling retry {retry_count + 1}/{max_retries} via {routing_key}")
+    else:
+        exchange = DEAD_LETTER_EXCHANGE
+        routing_key = queue_name
+        print(f"Max retries reached, moving message to {dead_letter_queue_name(queue_name)}")
+
+    channel.basic_publish(
+        exchange=exchange,
+        routing_key=routing_key,
+        body=body,
+        properties=pika.BasicProperties(
+            headers=headers,
+            content_type=properties.content_type,
+            timestamp=properties.timestamp,
+            delivery_mode=2,
+        ),
+    )
+    channel.basic_ack(delivery_tag=method.delivery_tag)
+
+
+# Exchanges, queues, bindings, queue arguments and retry settings live in one manifest
+TOPOLOGY_PATH = os.environ.get("AMQP_TOPOLOGY") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "rabbitmq", "topology.json"
+)
+_topology = None
+
+
+def load_topology(path=None):
+    """Load the topology manifest (cached for the default path)."""
+    global _topology
+    if path is not None:
+        with open(path) as f:
+            return json.load(f)
+    if _topology is None:
+        with open(TOPOLOGY_PATH) as f:
+            _topology = json.load(f)
+    return _topology
+
+
+def consumer_queues(service, topology=None):
+    """Queue names a service consumes from, as listed under "consumers" in the manifest."""
+    topology = topology or load_topology()
+    return list(topology["consumers"][service])
+
+
+def declare_queue(channel, queue_name, spec, retry=None):
+    """Declare one manifest queue with its arguments, bindings and retry queues."""
+    channel.queue_declare(queue=queue_name, durable=spec.get("durable", True), arguments=spec.get("arguments"))
+    bind_queue(channel, queue_name, spec)
+    if spec.get("retry"):
+        declare_retry_queues(channel, queue_name, **(retry or {}))
+
+
+def bind_queue(channel, queue_name, spec):
+    for binding in spec.get("bindings", []):
+        channel.queue_bind(exchange=binding["exchange"], queue=queue_name, routing_key=binding["routing_key"])
+    for binding in spec.get("unbind", []):  # bindings that were moved elsewhere; unbinding twice is harmless
+        channel.queue_unbind(exchange=binding["exchange"], queue=queue_name, routing_key=binding["routing_key"])
+
+
+def ensure_topology(hostname, port, topology=None, recreate=False):
+    """
+    Apply the manifest over a short-lived blocking connection. Declarations are
+    idempotent. A queue that already exists with different arguments is kept as it
+    is, with a warning. With recreate=True, the queue is deleted and declared again
+    from the manifest if it is empty; a queue that still holds messages is kept.
+    """
+    topology = topology or load_topology()
+    retry = topology.get("retry", {})
+    connection = pika.BlockingConnection(
+        pika.ConnectionParameters(host=hostname, port=int(port), heartbeat=300, blocked_connection_timeout=300)
+    )
+    channel = connection.channel()
+    try:
+        for exchange_name, spec in topology["exchanges"].items():
+            print(f"Declaring exchange: {exchange_name} ({spec['type']})")
+            channel.exchange_declare(
+                exchange=exchange_name,
+                exchange_type=spec["type"],
+                durable=spec.get("durable", True),
+                arguments=spec.get("arguments"),
+            )
+        for binding in topology.get("exchange_bindings", []):
+            print(f"Binding exchange {binding['destination']} to {binding['source']} ({binding['routing_key']})")
+            channel.exchange_bind(
+                destination=binding["destination"], source=binding["source"], routing_key=binding["routing_key"]
+            )
+
+        for queue_name, spec in topology["queues"].items():
+            print(f"Declaring queue: {queue_name}")
+            try:
+                declare_queue(channel, queue_name, spec, retry)
+            except pika.exceptions.ChannelClosedByBroker as e:
+                if e.reply_code != 406:  # PRECONDITION_FAILED: arguments differ from the existing queue
+                    raise
+                channel = connection.channel()
+                reason = e.reply_text
+                if recreate:
+                    print(f"Recreating queue {queue_name} with the manifest arguments")
+                    try:
+                        channel.queue_delete(queue=queue_name, if_empty=True)
+                        declare_queue(channel, queue_name, spec, retry)
+                        continue
+                    except pika.exceptions.ChannelClosedByBroker as e:
+                        if e.reply_code != 406:  # PRECONDITION_FAILED: the queue still holds messages
+                            raise
+                        channel = connection.channel()
+                        reason = f"{reason}; not recreated: {e.reply_text}"
+                print(f"Queue {queue_name} exists with different arguments ({reason}); "
+                      f"keeping it. Run amqp_setup.py --recreate to apply topology.json.")
+                bind_queue(channel, queue_name, spec)
+                if spec.get("retry"):
+                    declare_retry_queues(channel, queue_name, **retry)
+    finally:
+        if connection.is_open:
+            connection.close()
+
+
+class AsyncConsumer:
+    """
+    SelectConnection consumer for one or more queues, run on a background thread.
+
+    callback(channel, method, properties, body) only has to process the message: it is
+    acked when the callback returns, and if it raises the message is sent through
+    the broker-side retry queues (see retry_or_dead_letter), or straight to the DLQ if
+    the exception has retryable = False.
+    Retried messages are handed to the callback with their original exchange and
+    routing key restored.
+
+    When a topology manifest is given it is applied with ensure_topology before every
+    connect, and the retry settings come from it.
+    """
+
+    def __init__(self, hostname, port, queues, callback, max_retries=None,
+                 prefetch_count=10, retry_interval=5, topology=None):
+        self.hostname = hostname
+        self.port = int(port)
+        self.queues = list(queues)
+        self.callback = callback
+        self.topology = topology
+        if max_retries is None:
+            max_retries = (topology or {}).get("retry", {}).get("max_retries", MAX_RETRIES)
+        self.max_retries = max_retries
+        self.prefetch_count = prefetch_count
+        self.retry_interval = retry_interval
+        self._connection = None
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        """Run the consumer on a daemon thread (idempotent)."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._thread = threading.Thread(target=self.run, name="amqp-consumer", daemon=True)
+            self._thread.start()
+        return self
+
+    def run(self):
+        """Connect and consume, reconnecting until stop() is called."""
+        parameters = pika.ConnectionParameters(
+            host=self.hostname,
+            port=self.port,
+            heartbeat=300,
+            blocked_connection_timeout=300,
+        )
+        while not self._stopping:
+            try:
+                if self.topology is not None:
+                    ensure_topology(self.hostname, self.port, self.topology)
+                print(f"Attempting to connect to RabbitMQ at {self.hostname}:{self.port} ...")
+                connection = pika.SelectConnection(
+                    parameters=parameters,
+                    on_open_callback=self._on_connection_open,
+                    on_open_error_callback=self._on_connection_open_error,
+                    on_close_callback=self._on_connection_closed,
+                )
+                self._connection = connection
+                print("Starting IOLoop")
+                connection.ioloop.start()
+            except Exception as e:
+                print(f"Consumer connection error: {e}")
+            if not self._stopping:
+                print(f"Reconnecting in {self.retry_interval} seconds...")
+                time.sleep(self.retry_interval)
+
+    def stop(self, timeout=10):
+        """
+        Close the connection after the message being handled, if any, is acked; unacked
+        prefetched messages go back to the queue. Waits up to timeout for the thread.
+        """
+        self._stopping = True
+        connection = self._connection
+        if connection is not None:
+            try:
+                connection.ioloop.add_callback_threadsafe(self._close_connection)
+            except Exception as e:
+                print(f"Consumer stop failed: {e}")
+        if timeout is not None and self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def _on_connection_open(self, connection):
+        print("Connection opened")
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection, error):
+        print(f"Consumer failed to connect: {error}")
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        print(f"Connection closed: {reason}")
+        self._connection = None
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        print("Channel opened, setting up consumers...")
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.basic_qos(prefetch_count=self.prefetch_count)
+        for queue_name in self.queues:
+            if self.topology is None:
+                declare_retry_queues(channel, queue_name, self.max_retries)
+            print(f"Subscribing to queue: {queue_name}")
+            channel.basic_consume(
+                queue=queue_name,
+                on_message_callback=self._make_handler(queue_name),
+                auto_ack=False,
+            )
+        print("Consumers are set up. Waiting for messages...")
+
+    def _on_channel_closed(self, channel, reason):
+        print(f"Channel closed: {reason}")
+        connection = self._connection
+        if connection is not None and connection.is_open:
+            connection.close()
+
+    def _make_handler(self, queue_name):
+        def handler(channel, method, properties, body):
+            headers = properties.headers or {}
+            if "x-original-routing-key" in headers:
+                method.exchange = headers.get("x-original-exchange", method.exchange)
+                method.routing_key = headers["x-original-routing-key"]
+            try:
+                self.callback(channel, method, properties, body)
+            except Exception as e:
+                print(f"Error while handling message from {queue_name}: {e}")
+                # Errors flagged retryable = False (e.g. undecodable bodies) go straight to the DLQ
+                max_retries = self.max_retries if getattr(e, "retryable", True) else 0
+                retry_or_dead_letter(channel, method, properties, body, queue_name, e, max_retries)
+            else:
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+        return handler
+
+    def _close_connection(self):
+        connection = self._connection
+        if connection is not None and connection.is_open:
+            connection.close()
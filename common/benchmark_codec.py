@@ -0,0 +1,69 @@
+"""
+Decode throughput of the shared message codec versus the old ast.literal_eval path.
+
+Run from the repository root:
+    python -m common.benchmark_codec [iterations]
+"""
+
+import ast
+import json
+import sys
+import time
+
+from common import codec
+
+SAMPLES = {
+    "match.request": {"recipientId": "7417a1c7-572a-4782-85b4-28cab93e86c9"},
+    "test.compatibility": {
+        "recipientId": "7417a1c7-572a-4782-85b4-28cab93e86c9",
+        "listOfOrganId": [f"015051e7-{i:04d}-heart" for i in range(20)],
+    },
+    "test.result": {"listOfMatchId": [f"015051e7-{i:04d}-heart" for i in range(20)]},
+    "driver.request": {
+        "deliveryId": "a9c4b1f2-6e0f-4e5a-9a51-0e8b8cf7d8a1",
+        "origin_address": "Outram Rd, Singapore 169608",
+        "destination_address": "11 Jln Tan Tock Seng, Singapore 308433",
+    },
+    "order.organ": {"orderId": "5b1b7e64-8c1f-4d3c-9a6e-2f0b7b8f1c11"},
+    "on_the_way.status": {"driverId": "146789", "email": "doctor@example.com"},
+}
+
+
+def rate(fn, bodies, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for routing_key, body in bodies:
+            fn(body, routing_key)
+    elapsed = time.perf_counter() - start
+    return iterations * len(bodies) / elapsed
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    bodies = [(key, json.dumps(payload).encode()) for key, payload in SAMPLES.items()]
+
+    cases = [
+        ("ast.literal_eval", lambda body, key: ast.literal_eval(body.decode())),
+        ("json.loads", lambda body, key: json.loads(body)),
+        ("codec.decode", lambda body, key: codec.decode(body)),
+        ("codec.decode_message", lambda body, key: codec.decode_message(body, key)),
+    ]
+    if codec.msgpack is not None:
+        packed = [(key, codec.encode(payload, codec.MSGPACK)[0]) for key, payload in SAMPLES.items()]
+        cases.append(("codec.decode_message (msgpack)",
+                      lambda body, key: codec.decode_message(body, key, codec.MSGPACK)))
+    else:
+        packed = None
+
+    print(f"orjson: {'yes' if codec.orjson else 'no'}, msgpack: {'yes' if codec.msgpack else 'no'}")
+    print(f"{len(bodies)} message types x {iterations} iterations")
+    baseline = None
+    for name, fn in cases:
+        data = packed if "msgpack" in name else bodies
+        per_second = rate(fn, data, iterations)
+        baseline = baseline or per_second
+        print(f"{name:<32} {per_second:>12,.0f} msg/s  {per_second / baseline:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Cost of turning stored documents into list rows, on delivery-shaped documents: the
+old hand-written class (per-instance __dict__, from_dict + to_dict per document)
+against common.models (slots and generated converters), and row(), which validates
+the stored dict and returns it as is. Also reports the memory held per object and
+the time to serialise the whole list.
+
+Run from the repository root:
+    python -m common.benchmark_models [documents]
+"""
+
+import json
+import sys
+import time
+import tracemalloc
+
+from common.models import Model
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class LegacyDeliveryInfo:
+    """The delivery model as it was written before common.models."""
+
+    def __init__(self, order_id, status, pickup, pickup_time, destination, destination_time, polyline, driverCoord, driverId, organType, doctorId, matchId):
+        self.order_id = order_id
+        self.status = status
+        self.pickup = pickup
+        self.pickup_time = pickup_time
+        self.destination = destination
+        self.destination_time = destination_time
+        self.polyline = polyline
+        self.driverCoord = driverCoord
+        self.driverId = driverId
+        self.organType = organType
+        self.doctorId = doctorId
+        self.matchId = matchId
+
+    def to_dict(self):
+        return {
+            "orderID": self.order_id,
+            "status": self.status,
+            "pickup": self.pickup,
+            "pickup_time": self.pickup_time,
+            "destination": self.destination,
+            "destination_time": self.destination_time,
+            "polyline": self.polyline,
+            "driverCoord": self.driverCoord,
+            "driverId": self.driverId,
+            "organType": self.organType,
+            "doctorId": self.doctorId,
+            "matchId": self.matchId,
+        }
+
+    @staticmethod
+    def from_dict(order_id, data):
+        return LegacyDeliveryInfo(
+            order_id=order_id,
+            status=data["status"],
+            pickup=data["pickup"],
+            pickup_time=data["pickup_time"],
+            destination=data["destination"],
+            destination_time=data["destination_time"],
+            polyline=data["polyline"],
+            driverCoord=data["driverCoord"],
+            driverId=data.get("driverId", ""),
+            organType=data["organType"],
+            doctorId=data.get("doctorId", ""),
+            matchId=data.get("matchId", ""),
+        )
+
+
+class DeliveryInfo(Model):
+    """Same fields as atomic/Delivery/deliveryinfo.py."""
+    __slots__ = ("order_id", "status", "pickup", "pickup_time", "destination", "destination_time", "polyline",
+                 "driverCoord", "driverId", "organType", "doctorId", "matchId")
+    ID = ("orderID", "order_id")
+    FIELDS = (
+        ("status", "status", str, True, None),
+        ("pickup", "pickup", None, True, None),
+        ("pickup_time", "pickup_time", None, True, None),
+        ("destination", "destination", None, True, None),
+        ("destination_time", "destination_time", None, True, None),
+        ("polyline", "polyline", None, True, None),
+        ("driverCoord", "driverCoord", None, True, None),
+        ("driverId", "driverId", str, False, ""),
+        ("organType", "organType", str, True, None),
+        ("doctorId", "doctorId", str, False, ""),
+        ("matchId", "matchId", str, False, ""),
+    )
+
+
+def make_delivery(i):
+    return {
+        "status": ("Awaiting pickup", "In progress", "Completed")[i % 3],
+        "pickup": "Outram Rd, Singapore 169608",
+        "pickup_time": "20250315 10:30:00 AM",
+        "destination": "11 Jln Tan Tock Seng, Singapore 308433",
+        "destination_time": None,
+        "polyline": "k~gFqfhxR" * 20,
+        "driverCoord": "1.2789,103.8358",
+        "driverId": f"{146789 + i % 50}",
+        "organType": ("heart", "kidney", "liver")[i % 3],
+        "doctorId": f"doctor-{i % 20:03d}",
+        "matchId": f"match-{i:07d}",
+    }
+
+
+def timed(label, count, fn):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<34} {count / elapsed:>12,.0f} docs/s")
+    return result
+
+
+def held_bytes(build):
+    """Bytes still allocated after build() returns its objects."""
+    tracemalloc.start()
+    objects = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return size
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    stored = [(f"delivery-{i:07d}", make_delivery(i)) for i in range(count)]
+
+    def fresh():
+        # Repositories hand out a new dict per read
+        return [(doc_id, dict(data)) for doc_id, data in stored]
+
+    print(f"{count} delivery documents, orjson: {'yes' if orjson else 'no'}")
+    print("list rows:")
+    docs = fresh()
+    timed("legacy from_dict().to_dict()", count,
+          lambda: [LegacyDeliveryInfo.from_dict(doc_id, data).to_dict() for doc_id, data in docs])
+    docs = fresh()
+    timed("Model from_dict().to_dict()", count,
+          lambda: [DeliveryInfo.from_dict(doc_id, data).to_dict() for doc_id, data in docs])
+    docs = fresh()
+    rows = timed("Model.row (passthrough)", count, lambda: [DeliveryInfo.row(doc_id, data) for doc_id, data in docs])
+
+    print("memory held per object:")
+    legacy = held_bytes(lambda: [LegacyDeliveryInfo.from_dict(doc_id, data) for doc_id, data in stored])
+    slotted = held_bytes(lambda: [DeliveryInfo.from_dict(doc_id, data) for doc_id, data in stored])
+    print(f"  {'legacy class':<34} {legacy / count:>12,.0f} bytes")
+    print(f"  {'Model (slots)':<34} {slotted / count:>12,.0f} bytes")
+
+    print("serialising the list:")
+    timed("json.dumps", count, lambda: json.dumps(rows))
+    if orjson is not None:
+        timed("orjson.dumps", count, lambda: orjson.dumps(rows))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Throughput of the local repository backends on organ-shaped documents: batched
+writes, point reads, get_many and a filtered query over the whole collection,
+plus the same reads through a read replica with an organType index.
+
+Run from the repository root:
+    python -m common.benchmark_repository [documents]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from common.replica import ReplicaRepository
+from common.repository import MemoryRepository, SQLiteRepository
+
+ORGAN_TYPES = ("heart", "kidney", "liver", "lungs", "pancreas")
+
+
+def make_organ(i):
+    return {
+        "organId": f"organ-{i:07d}",
+        "donorId": f"donor-{i // 5:07d}",
+        "organType": ORGAN_TYPES[i % len(ORGAN_TYPES)],
+        "bloodType": ("O+", "A+", "B+", "AB+")[i % 4],
+        "condition": "Good",
+    }
+
+
+def timed(label, count, fn):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<22} {count / elapsed:>12,.0f} docs/s")
+
+
+def run(repository, organs):
+    ids = [organ["organId"] for organ in organs]
+    sample = ids[:: max(1, len(ids) // 1000)]
+    timed("set_many", len(organs), lambda: repository.set_many((organ["organId"], organ) for organ in organs))
+    timed("get", len(sample), lambda: [repository.get(doc_id) for doc_id in sample])
+    timed("get_many", len(sample), lambda: repository.get_many(sample))
+    timed("where organType", len(organs), lambda: repository.where("organType", "==", "heart"))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    organs = [make_organ(i) for i in range(count)]
+    print(f"{count} organ documents")
+
+    print("memory")
+    run(MemoryRepository("organs"), organs)
+
+    with tempfile.TemporaryDirectory() as directory:
+        print("sqlite")
+        run(SQLiteRepository("organs", os.path.join(directory, "benchmark.db")), organs)
+
+    print("replica over memory")
+    source = MemoryRepository("organs")
+    source.set_many((organ["organId"], organ) for organ in organs)
+    replica = ReplicaRepository(source, indexes=("organType",))
+    timed("where organType", len(organs), lambda: replica.where("organType", "==", "heart"))
+    sample = [organ["organId"] for organ in organs[:: max(1, count // 1000)]]
+    timed("get", len(sample), lambda: [replica.get(doc_id) for doc_id in sample])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Import-time budget for the Flask services, measured with python -X importtime.
+
+Every service module (a file under atomic/ or composite/ that creates a Flask app) is
+imported in a fresh interpreter, as gunicorn does before the service can answer its
+health check. The check fails when an import takes longer than IMPORT_BUDGET_MS
+(default 1500) or loads a module that should wait for the first request: Firebase,
+the Firestore client and gRPC are only needed once a document is read.
+
+Needs Python 3.12 or later, like the python:3-slim images: some services use f-string
+syntax that older interpreters cannot parse. Settings that services read without a
+default (see SERVICE_ENV) are filled in with the compose.yaml values unless already set.
+
+Run from the repository root (exit status 1 on failure):
+    python -m common.check_import_time [service.py ...]
+"""
+
+import glob
+import os
+import subprocess
+import sys
+
+BUDGET_MS = float(os.environ.get("IMPORT_BUDGET_MS") or 1500)
+LAZY_MODULES = ("firebase_admin", "google.cloud.firestore", "grpc")
+MIN_PYTHON = (3, 12)
+# Read with int(environ.get(...)) and no fallback by some services
+SERVICE_ENV = {"RABBITMQ_PORT": "5672", "rabbit_port": "5672"}
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def services():
+    paths = []
+    for pattern in ("atomic/*/*.py", "composite/*/*.py"):
+        for path in sorted(glob.glob(os.path.join(ROOT, pattern))):
+            with open(path, encoding="utf-8", errors="replace") as f:
+                if "app = Flask(" in f.read():
+                    paths.append(os.path.relpath(path, ROOT))
+    return paths
+
+
+def measure(path):
+    """(total ms, {module: cumulative ms}, error) for importing the service at path."""
+    directory, filename = os.path.split(os.path.join(ROOT, path))
+    module = os.path.splitext(filename)[0]
+    code = f"import sys; sys.path[:0] = [{ROOT!r}, {directory!r}]; import {module}"
+    env = dict(SERVICE_ENV)
+    env.update(os.environ)
+    env["DATA_BACKEND"] = os.environ.get("DATA_BACKEND") or "firestore"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=directory, env=env, capture_output=True, text=True,
+    )
+    modules = {}
+    total_us = 0
+    errors = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            errors.append(line)
+            continue
+        fields = line[len("import time:"):].split("|")
+        if not fields[0].strip().isdigit():
+            continue  # the header line
+        total_us += int(fields[0])
+        modules[fields[2].strip()] = int(fields[1]) / 1000
+    error = errors[-1] if result.returncode != 0 and errors else None
+    return total_us / 1000, modules, error
+
+
+def main():
+    if sys.version_info < MIN_PYTHON:
+        print(f"Python {'.'.join(map(str, MIN_PYTHON))}+ is required (running {sys.version.split()[0]})")
+        sys.exit(2)
+    paths = sys.argv[1:] or services()
+    failed = False
+    print(f"budget {BUDGET_MS:.0f} ms, DATA_BACKEND={os.environ.get('DATA_BACKEND') or 'firestore'}")
+    for path in paths:
+        total, modules, error = measure(path)
+        if error:
+            failed = True
+            print(f"  FAIL {path}: import failed: {error}")
+            continue
+        eager = [lazy for lazy in LAZY_MODULES if any(name == lazy or name.startswith(lazy + ".") for name in modules)]
+        slowest = sorted(((ms, name) for name, ms in modules.items() if "." not in name), reverse=True)[:3]
+        status = "ok"
+        if total > BUDGET_MS or eager:
+            failed = True
+            status = "FAIL"
+        print(f"  {status:<4} {path:<52} {total:>8.0f} ms   " + ", ".join(f"{name} {ms:.0f}" for ms, name in slowest))
+        if eager:
+            print(f"       imported at startup: {', '.join(eager)}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
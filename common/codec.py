@@ -0,0 +1,187 @@
+"""
+Shared AMQP message codec.
+
+Bodies are decoded as JSON (with orjson when it is installed) or msgpack when the
+message carries a msgpack content type, then validated into a small typed message
+class picked by routing key. Bodies published before the services switched to JSON
+(Python dict reprs) are still accepted through a literal_eval fallback.
+"""
+
+import ast
+import json
+
+try:
+    import orjson
+except ImportError:  # optional speed-up
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional, only needed for msgpack bodies
+    msgpack = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+MSGPACK_TYPES = {MSGPACK, "application/x-msgpack"}
+
+
+class MessageError(ValueError):
+    """Raised for bodies that can never be processed; retrying them will not help."""
+    retryable = False
+
+
+def loads(data):
+    """Parse JSON from str or bytes."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(payload):
+    """Serialise payload to a JSON str."""
+    if orjson is not None:
+        return orjson.dumps(payload).decode()
+    return json.dumps(payload)
+
+
+def decode(body, content_type=None):
+    """Decode an AMQP body into a dict according to its content type."""
+    if content_type in MSGPACK_TYPES:
+        if msgpack is None:
+            raise MessageError("msgpack body received but msgpack is not installed")
+        try:
+            return msgpack.unpackb(body, raw=False)
+        except Exception as e:
+            raise MessageError(f"Invalid msgpack body: {e}") from e
+    try:
+        return loads(body)
+    except ValueError:
+        pass
+    # Legacy publishers sent str(dict); keep accepting them until they are all gone.
+    try:
+        text = body.decode() if isinstance(body, bytes) else body
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError, UnicodeDecodeError) as e:
+        raise MessageError(f"Undecodable message body: {body[:100]!r}") from e
+
+
+def encode(payload, content_type=JSON):
+    """Encode a dict (or message) for publishing; returns (body, content_type)."""
+    if isinstance(payload, Message):
+        payload = payload.to_dict()
+    if content_type in MSGPACK_TYPES and msgpack is not None:
+        return msgpack.packb(payload, use_bin_type=True), MSGPACK
+    return dumps(payload), JSON
+
+
+class Message:
+    """Base class for typed messages; subclasses list their fields in FIELDS."""
+    __slots__ = ()
+    # (wire name, attribute name, type, required)
+    FIELDS = ()
+
+    def __init__(self, **kwargs):
+        for _, attr, _, _ in self.FIELDS:
+            setattr(self, attr, kwargs.get(attr))
+
+    def to_dict(self):
+        """Convert the message back to its wire dictionary."""
+        return {key: getattr(self, attr) for key, attr, _, _ in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Validate a decoded body and build the message."""
+        if not isinstance(data, dict):
+            raise MessageError(f"{cls.__name__} expects an object, got {type(data).__name__}")
+        values = {}
+        for key, attr, kind, required in cls.FIELDS:
+            value = data.get(key)
+            if value is None:
+                if required:
+                    raise MessageError(f"{cls.__name__} is missing '{key}'")
+            elif not isinstance(value, kind):
+                raise MessageError(f"{cls.__name__}.{key} should be {kind.__name__}, got {type(value).__name__}")
+            values[attr] = value
+        return cls(**values)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()})"
+
+
+class MatchRequest(Message):
+    """match.request: request_organ -> MatchOrgan"""
+    __slots__ = ("recipient_id",)
+    FIELDS = (("recipientId", "recipient_id", str, True),)
+
+
+class CompatibilityRequest(Message):
+    """test.compatibility: MatchOrgan -> TestCompatibility"""
+    __slots__ = ("recipient_id", "organ_ids")
+    FIELDS = (
+        ("recipientId", "recipient_id", str, True),
+        ("listOfOrganId", "organ_ids", list, True),
+    )
+
+
+class TestResult(Message):
+    """test.result: TestCompatibility -> MatchOrgan"""
+    __slots__ = ("match_ids",)
+    FIELDS = (("listOfMatchId", "match_ids", list, True),)
+
+
+class DriverRequest(Message):
+    """driver.request: createDelivery -> selectDriver"""
+    __slots__ = ("delivery_id", "origin_address", "destination_address")
+    FIELDS = (
+        ("deliveryId", "delivery_id", str, True),
+        ("origin_address", "origin_address", str, False),
+        ("destination_address", "destination_address", str, False),
+    )
+
+
+class OrderMessage(Message):
+    """order.organ: MatchOrgan -> createDelivery"""
+    __slots__ = ("order_id",)
+    FIELDS = (("orderId", "order_id", str, True),)
+
+
+class DriverNotification(Message):
+    """*.status and *.acknowledge: delivery services -> SendNotification"""
+    __slots__ = ("driver_id", "email", "locale")
+    FIELDS = (
+        ("driverId", "driver_id", str, False),
+        ("email", "email", str, False),
+        ("locale", "locale", str, False),
+    )
+
+
+MESSAGE_TYPES = {
+    "match.request": MatchRequest,
+    "test.compatibility": CompatibilityRequest,
+    "test.result": TestResult,
+    "driver.request": DriverRequest,
+    "order.organ": OrderMessage,
+}
+
+# Topic bindings matched on the last routing key segment ("*.status", "*.acknowledge")
+SUFFIX_TYPES = {
+    "status": DriverNotification,
+    "acknowledge": DriverNotification,
+}
+
+
+def message_type(routing_key):
+    """Return the message class for a routing key, or None if it is unknown."""
+    cls = MESSAGE_TYPES.get(routing_key)
+    if cls is None:
+        cls = SUFFIX_TYPES.get(routing_key.rsplit(".", 1)[-1])
+    return cls
+
+
+def decode_message(body, routing_key, content_type=None):
+    """Decode and validate a body; unknown routing keys give back the plain dict."""
+    data = decode(body, content_type)
+    cls = message_type(routing_key)
+    if cls is None:
+        return data
+    return cls.from_dict(data)
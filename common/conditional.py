@@ -0,0 +1,21 @@
+"""
+Conditional GETs for the atomic services' single-document endpoints.
+
+The ETag is the repository's document version (Firestore's update_time), so it changes
+whenever the document is written. A client that sends the ETag back in If-None-Match
+gets an empty 304 instead of the document while it is unchanged; common.invokes keeps
+those ETags for the composites.
+"""
+
+from flask import Response, jsonify
+
+
+def etag_response(request, body, version):
+    """jsonify(body) tagged with the version's ETag, or a 304 when the client's copy is current."""
+    if version is not None and request.if_none_match.contains_weak(version):
+        response = Response(status=304)
+    else:
+        response = jsonify(body)
+    if version is not None:
+        response.set_etag(version)
+    return response
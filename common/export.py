@@ -0,0 +1,73 @@
+"""
+Streaming NDJSON exports for the atomic services' list endpoints.
+
+A client that sends Accept: application/x-ndjson gets one JSON document per line,
+written while the repository is still reading, so a full dump starts immediately and
+uses constant memory however large the collection is. Lines are sent in chunks of
+about EXPORT_CHUNK_BYTES. An error part way through cannot change the status any more,
+so it is reported as a final {"error": ...} line.
+"""
+
+import json
+import os
+
+from flask import Response, stream_with_context
+
+try:
+    import orjson
+except ImportError:  # optional speed-up
+    orjson = None
+
+try:
+    from flask.json.provider import DefaultJSONProvider
+    _flask_default = DefaultJSONProvider.default
+except ImportError:  # Flask < 2.2 has no JSON providers
+    from flask.json import JSONEncoder
+    _flask_default = JSONEncoder().default
+
+NDJSON = "application/x-ndjson"
+CHUNK_BYTES = int(os.environ.get("EXPORT_CHUNK_BYTES") or 65536)
+
+
+def wants_ndjson(request):
+    return request.accept_mimetypes.best_match(["application/json", NDJSON]) == NDJSON
+
+
+def _line(record):
+    """
+    One NDJSON line. Values JSON has no type for go through Flask's default(), so
+    Firestore timestamps are written as HTTP dates, as in the JSON list response.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                record,
+                default=_flask_default,
+                option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS,
+            )
+        except TypeError:
+            pass  # e.g. integers over 64 bits; the json module handles those
+    return (json.dumps(record, default=_flask_default, separators=(",", ":")) + "\n").encode()
+
+
+def ndjson_chunks(docs, row):
+    """Encode (id, data) pairs as NDJSON lines via row(id, data), batched into chunks."""
+    buffer = []
+    size = 0
+    try:
+        for doc_id, data in docs:
+            line = _line(row(doc_id, data))
+            buffer.append(line)
+            size += len(line)
+            if size >= CHUNK_BYTES:
+                yield b"".join(buffer)
+                buffer, size = [], 0
+    except Exception as e:
+        print(f"Export failed: {e}")
+        buffer.append(_line({"error": str(e)}))
+    if buffer:
+        yield b"".join(buffer)
+
+
+def ndjson_response(docs, row):
+    return Response(stream_with_context(ndjson_chunks(docs, row)), mimetype=NDJSON)
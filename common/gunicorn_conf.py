@@ -0,0 +1,39 @@
+"""
+gunicorn settings shared by the Flask services (compose.prod.yaml):
+
+    gunicorn -c common/gunicorn_conf.py --bind 0.0.0.0:5010 organ:app
+
+    WEB_WORKERS            worker processes (default: one per CPU)
+    WEB_THREADS            request threads per worker (default 4)
+    WEB_TIMEOUT            seconds before a silent worker is restarted (default 120)
+    WEB_GRACEFUL_TIMEOUT   seconds a stopping worker gets to finish (default 30)
+    WEB_PRELOAD            import the app once in the master before forking (default 1)
+
+Workers are threaded (gthread) rather than gevent: pika's IOLoop threads and the
+Firestore gRPC client do not work under gevent's monkey-patching.
+"""
+
+import multiprocessing
+import os
+
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_WORKERS") or multiprocessing.cpu_count())
+threads = int(os.environ.get("WEB_THREADS") or 4)
+timeout = int(os.environ.get("WEB_TIMEOUT") or 120)
+graceful_timeout = int(os.environ.get("WEB_GRACEFUL_TIMEOUT") or 30)
+# Credentials, templates and repositories are loaded once and shared copy-on-write;
+# nothing that holds a connection is opened until a worker starts
+preload_app = (os.environ.get("WEB_PRELOAD") or "1").lower() in ("1", "true", "yes")
+accesslog = "-"
+
+
+def post_worker_init(worker):
+    from common import serving
+
+    serving.start_background()
+
+
+def worker_exit(server, worker):
+    from common import serving
+
+    serving.stop_background()
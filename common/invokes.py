@@ -1,9 +1,37 @@
+import copy
+import os
+import threading
+from collections import OrderedDict
+
 import requests
 
 SUPPORTED_HTTP_METHODS = set([
      "GET", "OPTIONS", "HEAD", "POST", "PUT", "PATCH", "DELETE"
 ])
 
+# GET replies that carried an ETag, by url: (etag, reply). Every GET is still sent,
+# with If-None-Match, so a cached reply is only reused after the service answers 304.
+CACHE_SIZE = int(os.environ.get("INVOKE_CACHE_SIZE") or 1024)
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def _cached(url):
+     with _cache_lock:
+          entry = _cache.get(url)
+          if entry is not None:
+               _cache.move_to_end(url)
+          return entry
+
+def _remember(url, etag, result):
+     with _cache_lock:
+          if etag:
+               _cache[url] = (etag, result)
+               _cache.move_to_end(url)
+               while len(_cache) > CACHE_SIZE:
+                    _cache.popitem(last=False)
+          else:
+               _cache.pop(url, None)
+
 def invoke_http(url, method='GET', json=None, **kwargs):
      """A simple wrapper for requests methods.
          url: the url of the http service;
@@ -11,12 +39,18 @@ def invoke_http(url, method='GET', json=None, **kwargs):
          data: the JSON input when needed by the http method;
          return: the JSON reply content from the http service if the call succeeds;
                 otherwise, return a JSON object with a "code" name-value pair.
+         Plain GETs are conditional: an unchanged document comes back as a 304 and
+         the reply cached from the last 200 is returned instead.
      """
      code = 200
      result = {}
+     cacheable = method.upper() == "GET" and CACHE_SIZE > 0 and "params" not in kwargs
+     cached = _cached(url) if cacheable else None
 
      try:
           if method.upper() in SUPPORTED_HTTP_METHODS:
+                if cached is not None:
+                     kwargs["headers"] = dict(kwargs.get("headers") or {}, **{"If-None-Match": cached[0]})
                 r = requests.request(method, url, json = json, **kwargs)
           else:
                 raise Exception("HTTP method {} unsupported.".format(method))
@@ -26,6 +60,10 @@ def invoke_http(url, method='GET', json=None, **kwargs):
      if code not in range(200,300):
           return result
 
+     if cached is not None and r.status_code == requests.codes.not_modified:
+          # Callers may modify the reply they get, so never hand out the cached object
+          return copy.deepcopy(cached[1])
+
      ## Check http call result
      if r.status_code != requests.codes.ok:
           code = r.status_code
@@ -35,5 +73,7 @@ def invoke_http(url, method='GET', json=None, **kwargs):
           code = 500
           result = {"code": code, "message": "Invalid JSON output from service: " + url + ". " + str(e)}
 
+     if cacheable:
+          etag = r.headers.get("ETag") if code == requests.codes.ok else None
+          _remember(url, etag, copy.deepcopy(result) if etag else None)
      return result
-
@@ -0,0 +1,126 @@
+"""
+Compact document models for the atomic services.
+
+A model lists its fields once and gets __init__, to_dict(), from_dict() and row()
+generated for it when the class is created:
+
+    class Organ(Model):
+        __slots__ = ("organ_id", "donor_id", "organ_type")
+        ID = ("organId", "organ_id")
+        FIELDS = (
+            ("donorId", "donor_id", str, True, None),
+            ("organType", "organ_type", str, True, None),
+        )
+
+ID is (wire name, attribute) for the document id; the wire name is None when the id
+is not part of the document body. FIELDS are (wire name, attribute, type or None,
+required, default), in constructor order; defaults must be immutable.
+
+from_dict() raises ModelError when a required field is missing or a value has the
+wrong type (None is accepted for any field, as before). row() is for list endpoints:
+it runs the same checks on a stored document and, when the document already holds
+exactly the model's fields, returns it as is instead of building an object and a new
+dict; otherwise it returns from_dict(...).to_dict().
+"""
+
+_MISSING = object()
+
+
+class ModelError(ValueError):
+    """A document that does not fit its model."""
+
+
+class Model:
+    """Base class for documents; subclasses declare __slots__, ID and FIELDS."""
+    __slots__ = ()
+    ID = None
+    FIELDS = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.ID is None:
+            raise TypeError(f"{cls.__name__} must declare ID")
+        slots = set()
+        for klass in cls.__mro__:
+            slots.update(klass.__dict__.get("__slots__", ()))
+        attrs = [cls.ID[1]] + [attr for _, attr, _, _, _ in cls.FIELDS]
+        missing = [attr for attr in attrs if attr not in slots]
+        if missing:
+            raise TypeError(f"{cls.__name__}.__slots__ is missing {missing}")
+        for name, fn in _generate(cls).items():
+            setattr(cls, name, fn)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({getattr(self, self.ID[1])!r}, {self.to_dict()})"
+
+
+def _generate(cls):
+    """Compile __init__, to_dict, from_dict and row for cls."""
+    name = cls.__name__
+    id_key, id_attr = cls.ID
+    params = [id_attr] + [attr for _, attr, _, _, _ in cls.FIELDS]
+    namespace = {"_MISSING": _MISSING, "ModelError": ModelError, "_new": object.__new__}
+
+    init = [f"def __init__(self, {', '.join(params)}):"]
+    init += [f"    self.{attr} = {attr}" for attr in params]
+
+    items = [f"{id_key!r}: self.{id_attr}"] if id_key is not None else []
+    items += [f"{key!r}: self.{attr}" for key, attr, _, _, _ in cls.FIELDS]
+    to_dict = [
+        "def to_dict(self):",
+        '    """Convert the object to a Firestore-compatible dictionary."""',
+        "    return {" + ", ".join(items) + "}",
+    ]
+
+    def check(i, key, kind, required, lines, track):
+        """Lines that load data[key] into value and validate it."""
+        lines.append(f"    value = data.get({key!r}, _MISSING)")
+        lines.append("    if value is _MISSING:")
+        if required:
+            lines.append(f"        raise ModelError({name + ' is missing ' + repr(key)!r})")
+        else:
+            lines.append(f"        value = _default_{i}")
+            if track:
+                lines.append("        complete = False")
+        if kind is not None:
+            namespace[f"_kind_{i}"] = kind
+            kinds = kind if isinstance(kind, tuple) else (kind,)
+            expected = " or ".join(k.__name__ for k in kinds)
+            lines.append(f"    elif value is not None and not isinstance(value, _kind_{i}):")
+            lines.append(f"        raise ModelError({name + '.' + key + ' should be ' + expected + ', got '!r} + type(value).__name__)")
+
+    guard = [
+        "    if not isinstance(data, dict):",
+        f"        raise ModelError({name + ' expects an object, got '!r} + type(data).__name__)",
+    ]
+
+    from_dict = ["def from_dict(cls, doc_id, data):", '    """Validate a stored document and build the object."""']
+    from_dict += guard
+    from_dict += ["    self = _new(cls)", f"    self.{id_attr} = doc_id"]
+    row = ["def row(cls, doc_id, data):", '    """Validated wire dict for a stored document, reusing data when it fits."""']
+    row += guard + ["    complete = True"]
+    for i, (key, attr, kind, required, default) in enumerate(cls.FIELDS):
+        namespace[f"_default_{i}"] = default
+        check(i, key, kind, required, from_dict, False)
+        from_dict.append(f"    self.{attr} = value")
+        check(i, key, kind, required, row, True)
+    from_dict.append("    return self")
+
+    size = len(cls.FIELDS)
+    if id_key is None:
+        row.append(f"    if complete and len(data) == {size}:")
+        row.append("        return data")
+    else:
+        row.append(f"    if complete and len(data) == {size} + ({id_key!r} in data):")
+        row.append(f"        data[{id_key!r}] = doc_id")
+        row.append("        return data")
+    row.append("    return cls.from_dict(doc_id, data).to_dict()")
+
+    source = "\n".join(init + [""] + to_dict + [""] + from_dict + [""] + row) + "\n"
+    exec(compile(source, f"<model {name}>", "exec"), namespace)
+    return {
+        "__init__": namespace["__init__"],
+        "to_dict": namespace["to_dict"],
+        "from_dict": classmethod(namespace["from_dict"]),
+        "row": classmethod(namespace["row"]),
+    }
@@ -0,0 +1,34 @@
+"""
+Query parameters shared by the atomic services' list endpoints.
+
+    limit=50          at most this many documents (capped at PAGE_MAX_LIMIT)
+    startAfter=<id>   continue after this document id; the previous page returns it
+                      as nextStartAfter
+    fields=a,b.c      only return these (dotted) fields
+
+Without limit a list endpoint still returns the whole collection, so existing
+callers are unaffected.
+"""
+
+import os
+
+MAX_LIMIT = int(os.environ.get("PAGE_MAX_LIMIT") or 1000)
+
+
+def page_args(args):
+    """Repository.page() keyword arguments from request args; ValueError on bad input."""
+    limit = args.get("limit")
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValueError("limit must be a positive integer.")
+        if limit < 1:
+            raise ValueError("limit must be a positive integer.")
+        limit = min(limit, MAX_LIMIT)
+    fields = [field.strip() for field in (args.get("fields") or "").split(",") if field.strip()]
+    return {
+        "limit": limit,
+        "start_after": args.get("startAfter") or None,
+        "fields": fields or None,
+    }
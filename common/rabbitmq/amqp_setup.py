@@ -1,81 +1,33 @@
 #!/usr/bin/env python3
 
 """
-A standalone script to create multiple exchanges and queues on RabbitMQ.
+A standalone script to create the exchanges and queues described in topology.json on RabbitMQ.
+
+Usage: python amqp_setup.py [--recreate]
+  --recreate  delete and redeclare (empty) queues whose arguments differ from the manifest
 """
 
-import pika
+import os
+import sys
 from os import environ
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import amqp_lib  # noqa: E402  (common/amqp_lib.py, shared with the services)
+
 # RabbitMQ connection details
 amqp_host = environ.get("rabbitmq_host") or "localhost"
 # amqp_host = "rabbitmq"
 amqp_port = environ.get("rabbitmq_port") or 5672
 
-# Define exchanges and their types
-EXCHANGES = {
-    "request_organ_exchange": "direct",
-    "test_compatibility_exchange": "direct",
-    "test_result_exchange": "direct",
-    "activity_log_exchange": "topic",
-    "error_handling_exchange": "topic",
-    "order_exchange": "direct",
-    "notification_status_exchange": "topic",
-    "notification_acknowledge_exchange": "topic",
-    "driver_match_exchange": "direct",
-}
-
-# Define queues and their respective exchange bindings
-QUEUES = [
-    {"name": "match_request_queue", "exchange": "request_organ_exchange", "routing_key": "match.request"},
-    {"name": "test_compatibility_queue", "exchange": "test_compatibility_exchange", "routing_key": "test.compatibility"},
-    {"name": "match_test_result_queue", "exchange": "test_result_exchange", "routing_key": "test.result"},
-    {"name": "order_queue", "exchange": "order_exchange", "routing_key": "order.organ"},
-    {"name": "activity_log_queue", "exchange": "activity_log_exchange", "routing_key": "*.info"},  # Topic exchange wildcard
-    {"name": "error_queue", "exchange": "error_handling_exchange", "routing_key": "*.error"},  # Topic exchange pattern
-    {"name": "noti_delivery_status_queue", "exchange": "notification_status_exchange", "routing_key": "*.status", "type": "topic"},
-    {"name": "noti_acknowledgement_queue","exchange":"notification_acknowledge_exchange", "routing_key": "*.acknowledge", "type": "topic"},
-    {"name": "driver_match_request_queue", "exchange": "driver_match_exchange", "routing_key": "driver.request", "type": "direct"},
-]
-
-
-def create_exchange(channel, exchange_name, exchange_type):
-    """Create an exchange if it does not exist."""
-    print(f"Declaring exchange: {exchange_name} ({exchange_type})")
-    channel.exchange_declare(exchange=exchange_name, exchange_type=exchange_type, durable=True)
-
 
-def create_queue(channel, queue_name, exchange_name, routing_key):
-    """Create a queue and bind it to an exchange."""
-    print(f"Creating queue: {queue_name}")
-    channel.queue_declare(queue=queue_name, durable=True)
-    print(f"Binding queue: {queue_name} to exchange: {exchange_name} with routing key: {routing_key}")
-    channel.queue_bind(exchange=exchange_name, queue=queue_name, routing_key=routing_key)
-
-
-def setup_amqp():
-    """Setup AMQP exchanges and queues."""
+def setup_amqp(recreate=False):
+    """Setup AMQP exchanges, queues, retry queues and DLQs from the topology manifest."""
     print(f"Connecting to AMQP broker at {amqp_host}:{amqp_port}...")
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(host=amqp_host, port=amqp_port, heartbeat=300, blocked_connection_timeout=300)
-    )
-    print("Connected")
-
-    print("Open channel")
-    channel = connection.channel()
-
-    # Create exchanges
-    for exchange_name, exchange_type in EXCHANGES.items():
-        create_exchange(channel, exchange_name, exchange_type)
-
-    # Create queues and bind them to exchanges
-    for queue in QUEUES:
-        create_queue(channel, queue["name"], queue["exchange"], queue["routing_key"])
-
+    print(f"Applying topology from {amqp_lib.TOPOLOGY_PATH}")
+    amqp_lib.ensure_topology(amqp_host, amqp_port, recreate=recreate)
     print("✅ AMQP Setup Complete!")
-    connection.close()
 
 
 if __name__ == "__main__":
     print("Setting up AMQP...")
-    setup_amqp()
\ No newline at end of file
+    setup_amqp(recreate="--recreate" in sys.argv[1:])
\ No newline at end of file
@@ -0,0 +1,348 @@
+"""
+In-process read replica for read-heavy collections (organs, drivers).
+
+With READ_REPLICA=1 a service wraps its repository in a ReplicaRepository. The replica
+subscribes to the collection through Repository.watch() (Firestore on_snapshot), keeps
+every document in a dict plus secondary indexes on the fields the service filters by,
+and answers get(), get_many() and list queries from memory. Writes still go straight to
+the source repository. The listener is started by the first read in each process, so an
+app preloaded by gunicorn subscribes in every worker rather than in the master.
+
+Reads fall back to the source repository while the replica cannot be trusted:
+
+    - before the first snapshot has arrived, or after the listener has stopped
+      (it is re-subscribed at most every REPLICA_RETRY_SECONDS)
+    - when the last snapshot reached us more than REPLICA_MAX_LAG_SECONDS after
+      Firestore's read_time
+    - for a document this process wrote until its change comes back through the
+      listener (or REPLICA_MAX_LAG_SECONDS pass), so a PUT is followed by a fresh GET
+
+Filtered queries are only eventually consistent with writes made elsewhere. stats()
+reports readiness, lag, snapshot age and how many reads were served or fell back.
+"""
+
+import bisect
+import copy
+import os
+import threading
+import time
+
+from common.repository import Repository, _stream_rows, _take_page, _field, _MISSING, matches
+
+ENABLED = (os.environ.get("READ_REPLICA") or "0").lower() in ("1", "true", "yes")
+MAX_LAG_SECONDS = float(os.environ.get("REPLICA_MAX_LAG_SECONDS") or 30)
+RETRY_SECONDS = float(os.environ.get("REPLICA_RETRY_SECONDS") or 30)
+
+
+def replicate(repository, indexes=()):
+    """The repository wrapped in a ReplicaRepository when READ_REPLICA is set, else unchanged."""
+    if not ENABLED:
+        return repository
+    return ReplicaRepository(repository, indexes)
+
+
+class ReplicaRepository(Repository):
+    def __init__(self, source, indexes=()):
+        super().__init__(source.collection)
+        self.source = source
+        self.lock = threading.RLock()
+        self.indexes = {field: {} for field in indexes}
+        self.docs = {}
+        self.versions = {}
+        self.ids = []
+        self.pending = {}
+        self.ready = False
+        self.handle = None
+        self.pid = None
+        self.subscribing = False
+        self.failed_at = None
+        self.last_snapshot = None
+        self.lag = None
+        self.counts = {"snapshots": 0, "changes": 0, "served": 0, "fallbacks": 0}
+
+    # -- listener -----------------------------------------------------------
+
+    def _subscribe(self):
+        """Start the listener; called without self.lock, once _listen() has set subscribing."""
+        with self.lock:
+            self.ready = False
+            self.docs, self.versions, self.ids = {}, {}, []
+            for index in self.indexes.values():
+                index.clear()
+        handle, failed_at = None, None
+        try:
+            # The source takes its own lock and may deliver the first snapshot, which
+            # takes self.lock, so it must not be called with self.lock held
+            handle = self.source.watch(self._apply)
+            print(f"Replica for {self.collection} subscribed")
+        except NotImplementedError as e:
+            # Nothing to listen to; every read goes to the source
+            print(f"Replica for {self.collection} disabled: {e}")
+        except Exception as e:
+            print(f"Replica for {self.collection} could not subscribe: {e}")
+            failed_at = time.time()
+        with self.lock:
+            self.handle = handle
+            self.failed_at = failed_at
+            self.subscribing = False
+
+    def _apply(self, changes, read_time):
+        now = time.time()
+        with self.lock:
+            for kind, doc_id, data, version in changes:
+                self._remove(doc_id)
+                if kind != "removed":
+                    self._insert(doc_id, data, version)
+                # Only a snapshot read after our write can contain it
+                if self.pending.get(doc_id, read_time) <= read_time:
+                    self.pending.pop(doc_id, None)
+            self.ready = True
+            self.last_snapshot = now
+            self.lag = max(0.0, now - read_time)
+            self.counts["snapshots"] += 1
+            self.counts["changes"] += len(changes)
+
+    def _insert(self, doc_id, data, version):
+        self.docs[doc_id] = data
+        self.versions[doc_id] = version
+        bisect.insort(self.ids, doc_id)
+        for field, index in self.indexes.items():
+            value = _field(data, field)
+            if value is not _MISSING and _hashable(value):
+                index.setdefault(value, set()).add(doc_id)
+
+    def _remove(self, doc_id):
+        data = self.docs.pop(doc_id, None)
+        if data is None:
+            return
+        self.versions.pop(doc_id, None)
+        del self.ids[bisect.bisect_left(self.ids, doc_id)]
+        for field, index in self.indexes.items():
+            value = _field(data, field)
+            if value is not _MISSING and _hashable(value):
+                ids = index.get(value)
+                ids.discard(doc_id)
+                if not ids:
+                    del index[value]
+
+    def _listen(self):
+        """
+        Start, drop or restart the listener as needed. Called by every read before it
+        takes self.lock: only the decision is made under the lock, so the source's lock
+        is never taken while self.lock is held.
+        """
+        subscribe, lost = False, None
+        with self.lock:
+            if self.pid != os.getpid():
+                # First read in this process; a listener inherited through a fork is dead
+                self.pid = os.getpid()
+                self.handle = None
+                self.subscribing = subscribe = True
+            elif self.subscribing:
+                return
+            elif self.handle is not None and not getattr(self.handle, "is_active", True):
+                print(f"Replica for {self.collection} lost its listener")
+                lost, self.handle = self.handle, None
+                self.failed_at = time.time()
+                self.ready = False
+            elif self.handle is None and self.failed_at is not None and time.time() - self.failed_at >= RETRY_SECONDS:
+                self.subscribing = subscribe = True
+        if lost is not None:
+            _unsubscribe(lost)
+        if subscribe:
+            self._subscribe()
+
+    def _serving(self):
+        """Whether reads may use the replica right now; called with self.lock held."""
+        return self.handle is not None and self.ready and self.lag <= MAX_LAG_SECONDS
+
+    def _fresh(self, doc_id):
+        written = self.pending.get(doc_id)
+        if written is None:
+            return True
+        if time.time() - written > MAX_LAG_SECONDS:
+            del self.pending[doc_id]
+            return True
+        return False
+
+    def _count(self, served):
+        self.counts["served" if served else "fallbacks"] += 1
+
+    def stats(self):
+        self._listen()
+        with self.lock:
+            serving = self._serving()
+            now = time.time()
+            return {
+                "collection": self.collection,
+                "ready": self.ready,
+                "serving": serving,
+                "documents": len(self.docs),
+                "pendingWrites": len(self.pending),
+                "lagSeconds": self.lag,
+                "lastSnapshotAgeSeconds": now - self.last_snapshot if self.last_snapshot else None,
+                "indexes": {field: len(index) for field, index in self.indexes.items()},
+                **self.counts,
+            }
+
+    def close(self):
+        with self.lock:
+            handle, self.handle = self.handle, None
+        if handle is not None:
+            _unsubscribe(handle)
+
+    # -- reads --------------------------------------------------------------
+
+    def get(self, doc_id):
+        return self.get_with_version(doc_id)[0]
+
+    def get_with_version(self, doc_id):
+        self._listen()
+        with self.lock:
+            served = self._serving() and self._fresh(doc_id)
+            self._count(served)
+            if served:
+                data = self.docs.get(doc_id)
+                if data is None:
+                    return None, None
+                return copy.deepcopy(data), self.versions[doc_id]
+        return self.source.get_with_version(doc_id)
+
+    def get_many(self, doc_ids):
+        doc_ids = list(doc_ids)
+        self._listen()
+        with self.lock:
+            served = self._serving()
+            self._count(served)
+            if served:
+                found = {}
+                stale = []
+                for doc_id in doc_ids:
+                    if not self._fresh(doc_id):
+                        stale.append(doc_id)
+                    elif doc_id in self.docs:
+                        found[doc_id] = copy.deepcopy(self.docs[doc_id])
+        if not served:
+            return self.source.get_many(doc_ids)
+        if stale:
+            found.update(self.source.get_many(stale))
+        return found
+
+    def _candidates(self, filters):
+        """Sorted ids that can match filters, narrowed by the indexes on == and in filters."""
+        candidates = None
+        for field, op, value in filters:
+            index = self.indexes.get(field)
+            if index is None:
+                continue
+            if op == "==" and _hashable(value):
+                ids = index.get(value, set())
+            elif op == "in" and all(_hashable(item) for item in value):
+                ids = set().union(*(index.get(item, set()) for item in value))
+            else:
+                continue
+            candidates = ids if candidates is None else candidates & ids
+        if candidates is None:
+            return list(self.ids)
+        return sorted(candidates)
+
+    def find(self, *filters):
+        self._listen()
+        with self.lock:
+            served = self._serving()
+            self._count(served)
+            if served:
+                return [
+                    (doc_id, copy.deepcopy(self.docs[doc_id]))
+                    for doc_id in self._candidates(filters)
+                    if matches(self.docs[doc_id], filters)
+                ]
+        return self.source.find(*filters)
+
+    def page(self, *filters, limit=None, start_after=None, fields=None):
+        self._listen()
+        with self.lock:
+            served = self._serving()
+            self._count(served)
+            if served:
+                ids = self._candidates(filters)
+                if start_after:
+                    ids = ids[bisect.bisect_right(ids, start_after):]
+                page, next_start_after = _take_page(((doc_id, self.docs[doc_id]) for doc_id in ids), filters, limit, fields)
+                return [(doc_id, copy.deepcopy(data)) for doc_id, data in page], next_start_after
+        return self.source.page(*filters, limit=limit, start_after=start_after, fields=fields)
+
+    def stream(self, *filters, limit=None, start_after=None, fields=None):
+        self._listen()
+        with self.lock:
+            served = self._serving()
+            self._count(served)
+            if served:
+                ids = self._candidates(filters)
+        if not served:
+            yield from self.source.stream(*filters, limit=limit, start_after=start_after, fields=fields)
+            return
+        if start_after:
+            ids = ids[bisect.bisect_right(ids, start_after):]
+        for doc_id, data in _stream_rows(self._snapshots(ids), filters, limit, fields):
+            yield doc_id, copy.deepcopy(data)
+
+    def _snapshots(self, ids):
+        for doc_id in ids:
+            with self.lock:
+                data = self.docs.get(doc_id)
+            if data is not None:
+                yield doc_id, data
+
+    # -- writes go to the source ---------------------------------------------
+
+    def _writing(self, doc_ids):
+        """Mark documents as written; reads of them go to the source until the listener catches up."""
+        now = time.time()
+        with self.lock:
+            for doc_id in doc_ids:
+                self.pending[doc_id] = now
+
+    def add(self, data):
+        doc_id = self.source.add(data)
+        self._writing([doc_id])
+        return doc_id
+
+    def create(self, doc_id, data):
+        self._writing([doc_id])
+        self.source.create(doc_id, data)
+
+    def set(self, doc_id, data, merge=False):
+        self._writing([doc_id])
+        self.source.set(doc_id, data, merge=merge)
+
+    def set_many(self, items):
+        items = list(items)
+        self._writing(doc_id for doc_id, _ in items)
+        self.source.set_many(items)
+
+    def update(self, doc_id, data):
+        self._writing([doc_id])
+        self.source.update(doc_id, data)
+
+    def delete(self, doc_id, must_exist=False):
+        self._writing([doc_id])
+        self.source.delete(doc_id, must_exist=must_exist)
+
+    def watch(self, on_changes):
+        return self.source.watch(on_changes)
+
+
+def _unsubscribe(handle):
+    try:
+        handle.unsubscribe()
+    except Exception as e:
+        print(f"Unsubscribing a replica listener failed: {e}")
+
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
@@ -0,0 +1,726 @@
+"""
+Document repository shared by the atomic services.
+
+Services talk to a Repository instead of hand-rolling db.collection(...).document(...)
+calls. The backend is picked by DATA_BACKEND:
+
+    firestore  (default) the service's Firestore project, as before
+    sqlite     one JSON document table in DATA_SQLITE_PATH; survives restarts
+    memory     a dict in the process; for load tests and offline runs
+
+Documents are plain dicts keyed by a string id. Lists and queries return (id, data)
+pairs ordered by id, which is what Firestore returns for an unordered query, so a
+service behaves the same on every backend. page() reads the same results a slice at
+a time, using the last id of one page as the cursor for the next; stream() yields them
+one by one for exports that should not hold a collection in memory.
+
+get_with_version() also returns an opaque version string that changes on every write
+to the document (Firestore's update_time), for ETags and conditional requests.
+watch() pushes every change to a listener, which common.replica uses to keep a copy
+of a collection in memory.
+"""
+
+import bisect
+import copy
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+
+BACKEND = os.environ.get("DATA_BACKEND") or "firestore"
+SQLITE_PATH = os.environ.get("DATA_SQLITE_PATH") or "graborgan_data.db"
+
+# Firestore accepts at most 500 writes per batch
+BATCH_LIMIT = 500
+
+
+class RepositoryError(Exception):
+    pass
+
+
+class NotFound(RepositoryError):
+    """The document an update or delete needs does not exist."""
+
+
+class AlreadyExists(RepositoryError):
+    """create() found a document with that id."""
+
+
+class Repository:
+    """Interface shared by the backends; collection is the Firestore collection name."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def get(self, doc_id):
+        """The document as a dict, or None when it does not exist."""
+        raise NotImplementedError
+
+    def get_with_version(self, doc_id):
+        """(data, version) where version changes on every write, or (None, None)."""
+        raise NotImplementedError
+
+    def get_many(self, doc_ids):
+        """{id: data} for the ids that exist, in one round trip."""
+        raise NotImplementedError
+
+    def all(self):
+        return self.find()
+
+    def where(self, field, op, value):
+        return self.find((field, op, value))
+
+    def find(self, *filters):
+        """(id, data) pairs matching every (field, op, value) filter."""
+        raise NotImplementedError
+
+    def page(self, *filters, limit=None, start_after=None, fields=None):
+        """
+        Up to limit (id, data) pairs with ids after start_after, holding only the given
+        fields, plus the cursor for the next page (None on the last page).
+        """
+        raise NotImplementedError
+
+    def stream(self, *filters, limit=None, start_after=None, fields=None):
+        """Like page(), but a generator over every matching (id, data) pair."""
+        raise NotImplementedError
+
+    def add(self, data):
+        """Store data under a generated id and return the id."""
+        raise NotImplementedError
+
+    def create(self, doc_id, data):
+        """Store a new document in one write; AlreadyExists if the id is taken."""
+        raise NotImplementedError
+
+    def set(self, doc_id, data, merge=False):
+        raise NotImplementedError
+
+    def set_many(self, items):
+        """Write (id, data) pairs in as few commits as the backend allows."""
+        raise NotImplementedError
+
+    def update(self, doc_id, data):
+        """
+        Merge data into an existing document in one write, with set(merge=True)
+        semantics for nested maps; NotFound if there is no such document.
+        """
+        raise NotImplementedError
+
+    def delete(self, doc_id, must_exist=False):
+        """Delete a document; with must_exist, NotFound instead of a silent no-op."""
+        raise NotImplementedError
+
+    def watch(self, on_changes):
+        """
+        Call on_changes(changes, read_time) with every document first and then with each
+        batch of changes, where changes are (kind, id, data, version) tuples and kind is
+        added, modified or removed. Returns a handle with unsubscribe() and is_active.
+        """
+        raise NotImplementedError(f"The {type(self).__name__} backend cannot push changes")
+
+
+# ---------------------------------------------------------------------------
+# Query evaluation for the local backends
+# ---------------------------------------------------------------------------
+
+_MISSING = object()
+
+
+def _field(data, path):
+    """Value at a dotted field path, or _MISSING."""
+    for part in path.split("."):
+        if not isinstance(data, dict) or part not in data:
+            return _MISSING
+        data = data[part]
+    return data
+
+
+def _compare(value, op, target):
+    try:
+        if op == "==":
+            return value == target
+        if op == "!=":
+            return value != target
+        if op == "<":
+            return value < target
+        if op == "<=":
+            return value <= target
+        if op == ">":
+            return value > target
+        if op == ">=":
+            return value >= target
+    except TypeError:  # Firestore never matches across types
+        return False
+    if op == "in":
+        return value in target
+    if op == "not-in":
+        return value not in target
+    if op == "array_contains":
+        return isinstance(value, list) and target in value
+    if op == "array_contains_any":
+        return isinstance(value, list) and any(item in value for item in target)
+    raise RepositoryError(f"Unsupported query operator {op!r}")
+
+
+def matches(data, filters):
+    for field, op, target in filters:
+        value = _field(data, field)
+        if value is _MISSING or not _compare(value, op, target):
+            return False
+    return True
+
+
+def project(data, fields):
+    """Copy of data holding only the given (dotted) field paths."""
+    if not fields:
+        return data
+    projected = {}
+    for path in fields:
+        value = _field(data, path)
+        if value is _MISSING:
+            continue
+        parts = path.split(".")
+        target = projected
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return projected
+
+
+def _stream_rows(rows, filters, limit, fields):
+    count = 0
+    for doc_id, data in rows:
+        if limit is not None and count == limit:
+            return
+        if matches(data, filters):
+            count += 1
+            yield doc_id, project(data, fields)
+
+
+def _take_page(rows, filters, limit, fields):
+    """Filter sorted (id, data) rows into one page; reads at most one row past the page."""
+    page = []
+    for doc_id, data in rows:
+        if not matches(data, filters):
+            continue
+        if limit is not None and len(page) == limit:
+            return page, page[-1][0]
+        page.append((doc_id, project(data, fields)))
+    return page, None
+
+
+_SIMPLE_FIELD = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def _quote(name):
+    if _SIMPLE_FIELD.match(name):
+        return name
+    return "`" + name.replace("\\", "\\\\").replace("`", "\\`") + "`"
+
+
+def field_paths(data, prefix=""):
+    """
+    Flatten nested maps into Firestore field paths, so update() merges into nested
+    maps the way set(merge=True) does instead of replacing them.
+    """
+    paths = {}
+    for key, value in data.items():
+        path = prefix + _quote(key)
+        if isinstance(value, dict) and value:
+            paths.update(field_paths(value, path + "."))
+        else:
+            paths[path] = value
+    return paths
+
+
+def _merge(existing, data):
+    """Firestore merge semantics: nested maps are merged, everything else replaced."""
+    merged = dict(existing)
+    for key, value in data.items():
+        if isinstance(value, dict) and value and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+# ---------------------------------------------------------------------------
+# Backends
+# ---------------------------------------------------------------------------
+
+class FirestoreRepository(Repository):
+    def __init__(self, collection, client=None, connect=None):
+        """Pass a Firestore client, or connect(), which is called for one on first use."""
+        super().__init__(collection)
+        self._client = client
+        self._connect = connect
+        self._ref = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        with self._lock:
+            if self._client is None:
+                self._client = self._connect()
+            if self._ref is None:
+                self._ref = self._client.collection(self.collection)
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._open()
+        return self._client
+
+    @property
+    def ref(self):
+        if self._ref is None:
+            self._open()
+        return self._ref
+
+    def get(self, doc_id):
+        snapshot = self.ref.document(doc_id).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def get_with_version(self, doc_id):
+        snapshot = self.ref.document(doc_id).get()
+        if not snapshot.exists:
+            return None, None
+        return snapshot.to_dict(), snapshot.update_time.rfc3339()
+
+    def get_many(self, doc_ids):
+        refs = [self.ref.document(doc_id) for doc_id in doc_ids]
+        return {snapshot.id: snapshot.to_dict() for snapshot in self.client.get_all(refs) if snapshot.exists}
+
+    def find(self, *filters):
+        query = self.ref
+        for field, op, value in filters:
+            query = query.where(field, op, value)
+        return [(snapshot.id, snapshot.to_dict()) for snapshot in query.get()]
+
+    def _query(self, filters, start_after, fields):
+        query = self.ref
+        for field, op, value in filters:
+            query = query.where(field, op, value)
+        if fields:
+            query = query.select(list(fields))
+        # Cursors are document ids, so page in document id order
+        query = query.order_by("__name__")
+        if start_after:
+            query = query.start_after({"__name__": self.ref.document(start_after)})
+        return query
+
+    def page(self, *filters, limit=None, start_after=None, fields=None):
+        query = self._query(filters, start_after, fields)
+        if limit is not None:
+            # One extra document tells us whether there is a next page
+            query = query.limit(limit + 1)
+        docs = [(snapshot.id, snapshot.to_dict()) for snapshot in query.stream()]
+        if limit is not None and len(docs) > limit:
+            return docs[:limit], docs[limit - 1][0]
+        return docs, None
+
+    def stream(self, *filters, limit=None, start_after=None, fields=None):
+        query = self._query(filters, start_after, fields)
+        if limit is not None:
+            query = query.limit(limit)
+        for snapshot in query.stream():
+            yield snapshot.id, snapshot.to_dict()
+
+    def add(self, data):
+        _, doc_ref = self.ref.add(data)
+        return doc_ref.id
+
+    def create(self, doc_id, data):
+        from google.api_core.exceptions import AlreadyExists as DocumentExists
+
+        try:
+            self.ref.document(doc_id).create(data)
+        except DocumentExists:
+            raise AlreadyExists(f"Document already exists: {self.collection}/{doc_id}")
+
+    def set(self, doc_id, data, merge=False):
+        self.ref.document(doc_id).set(data, merge=merge)
+
+    def set_many(self, items):
+        items = list(items)
+        for start in range(0, len(items), BATCH_LIMIT):
+            batch = self.client.batch()
+            for doc_id, data in items[start:start + BATCH_LIMIT]:
+                batch.set(self.ref.document(doc_id), data)
+            batch.commit()
+
+    def update(self, doc_id, data):
+        from google.api_core.exceptions import NotFound as MissingDocument
+
+        if not data:
+            # Firestore rejects an empty update; all that is left to do is the existence check
+            if not self.ref.document(doc_id).get(field_paths=[]).exists:
+                raise NotFound(f"No document to update: {self.collection}/{doc_id}")
+            return
+        try:
+            # update() carries an exists precondition, so this is a single round trip
+            self.ref.document(doc_id).update(field_paths(data))
+        except MissingDocument:
+            raise NotFound(f"No document to update: {self.collection}/{doc_id}")
+
+    def delete(self, doc_id, must_exist=False):
+        from google.api_core.exceptions import NotFound as MissingDocument
+
+        option = self.client.write_option(exists=True) if must_exist else None
+        try:
+            self.ref.document(doc_id).delete(option=option)
+        except MissingDocument:
+            raise NotFound(f"No document to delete: {self.collection}/{doc_id}")
+
+    def watch(self, on_changes):
+        def callback(snapshots, changes, read_time):
+            on_changes(
+                [
+                    (
+                        change.type.name.lower(),
+                        change.document.id,
+                        change.document.to_dict(),
+                        change.document.update_time.rfc3339() if change.document.update_time else None,
+                    )
+                    for change in changes
+                ],
+                read_time.timestamp(),
+            )
+
+        # The listener runs on the client's own thread and reconnects by itself
+        return self.ref.on_snapshot(callback)
+
+
+class MemoryRepository(Repository):
+    """Documents in a dict; values are copied in and out so callers cannot alias them."""
+
+    def __init__(self, collection):
+        super().__init__(collection)
+        self.docs = {}
+        self.versions = {}
+        self.clock = 0
+        self.listeners = []
+        self.lock = threading.RLock()
+
+    def get(self, doc_id):
+        with self.lock:
+            data = self.docs.get(doc_id)
+            return copy.deepcopy(data) if data is not None else None
+
+    def get_with_version(self, doc_id):
+        with self.lock:
+            data = self.docs.get(doc_id)
+            if data is None:
+                return None, None
+            return copy.deepcopy(data), str(self.versions[doc_id])
+
+    def _stamp(self, doc_id):
+        # Nanosecond clock, bumped so two writes in the same tick still differ
+        self.clock = max(time.time_ns(), self.clock + 1)
+        self.versions[doc_id] = self.clock
+        if self.listeners:
+            self._notify([("modified", doc_id, copy.deepcopy(self.docs[doc_id]), str(self.clock))])
+
+    def _notify(self, changes):
+        # Called with the lock held, so listeners see changes in write order
+        for listener in list(self.listeners):
+            listener.callback(changes, time.time())
+
+    def watch(self, on_changes):
+        with self.lock:
+            listener = _MemoryListener(self, on_changes)
+            on_changes(
+                [("added", doc_id, copy.deepcopy(data), str(self.versions[doc_id])) for doc_id, data in sorted(self.docs.items())],
+                time.time(),
+            )
+            self.listeners.append(listener)
+            return listener
+
+    def get_many(self, doc_ids):
+        with self.lock:
+            return {doc_id: copy.deepcopy(self.docs[doc_id]) for doc_id in doc_ids if doc_id in self.docs}
+
+    def find(self, *filters):
+        with self.lock:
+            return [
+                (doc_id, copy.deepcopy(data))
+                for doc_id, data in sorted(self.docs.items())
+                if matches(data, filters)
+            ]
+
+    def page(self, *filters, limit=None, start_after=None, fields=None):
+        with self.lock:
+            ids = sorted(self.docs)
+            if start_after:
+                ids = ids[bisect.bisect_right(ids, start_after):]
+            page, next_start_after = _take_page(((doc_id, self.docs[doc_id]) for doc_id in ids), filters, limit, fields)
+            return [(doc_id, copy.deepcopy(data)) for doc_id, data in page], next_start_after
+
+    def stream(self, *filters, limit=None, start_after=None, fields=None):
+        with self.lock:
+            ids = sorted(self.docs)
+        if start_after:
+            ids = ids[bisect.bisect_right(ids, start_after):]
+        for doc_id, data in _stream_rows(self._snapshots(ids), filters, limit, fields):
+            yield doc_id, copy.deepcopy(data)
+
+    def _snapshots(self, ids):
+        # Hold the lock per document, not for the whole export
+        for doc_id in ids:
+            with self.lock:
+                data = self.docs.get(doc_id)
+            if data is not None:
+                yield doc_id, data
+
+    def add(self, data):
+        doc_id = uuid.uuid4().hex
+        self.set(doc_id, data)
+        return doc_id
+
+    def create(self, doc_id, data):
+        with self.lock:
+            if doc_id in self.docs:
+                raise AlreadyExists(f"Document already exists: {self.collection}/{doc_id}")
+            self.docs[doc_id] = copy.deepcopy(data)
+            self._stamp(doc_id)
+
+    def set(self, doc_id, data, merge=False):
+        with self.lock:
+            if merge and doc_id in self.docs:
+                self.docs[doc_id] = _merge(self.docs[doc_id], copy.deepcopy(data))
+            else:
+                self.docs[doc_id] = copy.deepcopy(data)
+            self._stamp(doc_id)
+
+    def set_many(self, items):
+        with self.lock:
+            for doc_id, data in items:
+                self.docs[doc_id] = copy.deepcopy(data)
+                self._stamp(doc_id)
+
+    def update(self, doc_id, data):
+        with self.lock:
+            if doc_id not in self.docs:
+                raise NotFound(f"No document to update: {self.collection}/{doc_id}")
+            self.docs[doc_id] = _merge(self.docs[doc_id], copy.deepcopy(data))
+            self._stamp(doc_id)
+
+    def delete(self, doc_id, must_exist=False):
+        with self.lock:
+            self.versions.pop(doc_id, None)
+            if self.docs.pop(doc_id, None) is None:
+                if must_exist:
+                    raise NotFound(f"No document to delete: {self.collection}/{doc_id}")
+            elif self.listeners:
+                self._notify([("removed", doc_id, None, None)])
+
+
+class _MemoryListener:
+    def __init__(self, repository, callback):
+        self.repository = repository
+        self.callback = callback
+        self.is_active = True
+
+    def unsubscribe(self):
+        with self.repository.lock:
+            if self in self.repository.listeners:
+                self.repository.listeners.remove(self)
+        self.is_active = False
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    collection  TEXT NOT NULL,
+    id          TEXT NOT NULL,
+    data        TEXT NOT NULL,
+    update_time REAL NOT NULL,
+    PRIMARY KEY (collection, id)
+) WITHOUT ROWID;
+"""
+
+
+class SQLiteRepository(Repository):
+    """Documents as JSON text in one SQLite table shared by every collection."""
+
+    def __init__(self, collection, path=SQLITE_PATH):
+        super().__init__(collection)
+        self.path = path
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        # A connection opened before a fork (gunicorn preload) must not be used after it
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, doc_id):
+        row = self._connection().execute(
+            "SELECT data FROM documents WHERE collection = ? AND id = ?", (self.collection, doc_id)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_with_version(self, doc_id):
+        row = self._connection().execute(
+            "SELECT data, update_time FROM documents WHERE collection = ? AND id = ?", (self.collection, doc_id)
+        ).fetchone()
+        if row is None:
+            return None, None
+        return json.loads(row[0]), repr(row[1])
+
+    def get_many(self, doc_ids):
+        doc_ids = list(doc_ids)
+        found = {}
+        # SQLite caps bound parameters per statement, so look ids up in slices
+        for start in range(0, len(doc_ids), BATCH_LIMIT):
+            chunk = doc_ids[start:start + BATCH_LIMIT]
+            rows = self._connection().execute(
+                f"SELECT id, data FROM documents WHERE collection = ? AND id IN ({','.join('?' * len(chunk))})",
+                (self.collection, *chunk),
+            )
+            found.update((doc_id, json.loads(data)) for doc_id, data in rows)
+        return found
+
+    def find(self, *filters):
+        rows = self._connection().execute(
+            "SELECT id, data FROM documents WHERE collection = ? ORDER BY id", (self.collection,)
+        )
+        results = []
+        for doc_id, text in rows:
+            data = json.loads(text)
+            if matches(data, filters):
+                results.append((doc_id, data))
+        return results
+
+    def _rows(self, filters, limit, start_after):
+        query = "SELECT id, data FROM documents WHERE collection = ?"
+        params = [self.collection]
+        if start_after:
+            query += " AND id > ?"
+            params.append(start_after)
+        query += " ORDER BY id"
+        if limit is not None and not filters:
+            query += " LIMIT ?"
+            params.append(limit)
+        # The cursor is consumed lazily, so readers stop fetching rows once they have enough
+        for doc_id, text in self._connection().execute(query, params):
+            yield doc_id, json.loads(text)
+
+    def page(self, *filters, limit=None, start_after=None, fields=None):
+        rows = self._rows(filters, None if limit is None else limit + 1, start_after)
+        return _take_page(rows, filters, limit, fields)
+
+    def stream(self, *filters, limit=None, start_after=None, fields=None):
+        return _stream_rows(self._rows(filters, limit, start_after), filters, limit, fields)
+
+    def add(self, data):
+        doc_id = uuid.uuid4().hex
+        self.set(doc_id, data)
+        return doc_id
+
+    def create(self, doc_id, data):
+        connection = self._connection()
+        try:
+            with connection:
+                connection.execute(
+                    "INSERT INTO documents (collection, id, data, update_time) VALUES (?, ?, ?, ?)",
+                    (self.collection, doc_id, json.dumps(data), time.time()),
+                )
+        except sqlite3.IntegrityError:
+            raise AlreadyExists(f"Document already exists: {self.collection}/{doc_id}")
+
+    def set(self, doc_id, data, merge=False):
+        connection = self._connection()
+        with connection:
+            if merge:
+                connection.execute("BEGIN IMMEDIATE")
+                existing = self.get(doc_id)
+                if existing is not None:
+                    data = _merge(existing, data)
+            self._write(connection, [(doc_id, data)])
+
+    def set_many(self, items):
+        connection = self._connection()
+        with connection:
+            self._write(connection, items)
+
+    def update(self, doc_id, data):
+        connection = self._connection()
+        with connection:
+            # Take the write lock before reading so concurrent merges cannot interleave
+            connection.execute("BEGIN IMMEDIATE")
+            existing = self.get(doc_id)
+            if existing is None:
+                raise NotFound(f"No document to update: {self.collection}/{doc_id}")
+            self._write(connection, [(doc_id, _merge(existing, data))])
+
+    def delete(self, doc_id, must_exist=False):
+        connection = self._connection()
+        with connection:
+            deleted = connection.execute(
+                "DELETE FROM documents WHERE collection = ? AND id = ?", (self.collection, doc_id)
+            ).rowcount
+        if must_exist and not deleted:
+            raise NotFound(f"No document to delete: {self.collection}/{doc_id}")
+
+    def _write(self, connection, items):
+        now = time.time()
+        connection.executemany(
+            "INSERT OR REPLACE INTO documents (collection, id, data, update_time) VALUES (?, ?, ?, ?)",
+            [(self.collection, doc_id, json.dumps(data), now) for doc_id, data in items],
+        )
+
+
+# ---------------------------------------------------------------------------
+# Factory
+# ---------------------------------------------------------------------------
+
+_memory = {}
+_memory_lock = threading.Lock()
+_firebase_lock = threading.Lock()
+
+
+def firestore_client(key_path, project_id=None):
+    """Initialise the default Firebase app once per process and return its Firestore client."""
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    with _firebase_lock:
+        if not firebase_admin._apps:
+            if not key_path or not os.path.isfile(key_path):
+                raise FileNotFoundError(f"Could not find the Firebase JSON at {key_path}")
+            options = {"projectId": project_id} if project_id else None
+            firebase_admin.initialize_app(credentials.Certificate(key_path), options)
+        return firestore.client()
+
+
+def open_repository(collection, key_path=None, project_id=None, backend=None):
+    """
+    Repository for a collection on the configured backend. key_path and project_id are
+    only used by the Firestore backend, so offline runs need no credentials.
+
+    Firestore is not touched until the first query: firebase_admin is imported and the
+    app initialised then, so services start quickly and a gunicorn master that preloads
+    the app never opens a gRPC channel that its forked workers would inherit.
+    """
+    backend = backend or BACKEND
+    if backend == "firestore":
+        repository = FirestoreRepository(collection, connect=lambda: firestore_client(key_path, project_id))
+    elif backend == "sqlite":
+        repository = SQLiteRepository(collection, SQLITE_PATH)
+    elif backend == "memory":
+        # One store per collection per process, like a real database would be
+        with _memory_lock:
+            repository = _memory.setdefault(collection, MemoryRepository(collection))
+    else:
+        raise ValueError(f"Unknown DATA_BACKEND {backend!r}; use firestore, sqlite or memory")
+    print(f"Repository for {collection} using the {backend} backend")
+    return repository
@@ -0,0 +1,48 @@
+"""
+Background work (AMQP publishers and consumers, worker pools) that a Flask service runs
+next to its HTTP server.
+
+Services register each component at import time with background(start, stop) and call
+start_background() in their __main__ block before app.run(). Under gunicorn
+(common/gunicorn_conf.py) the app is imported once in the master and the components are
+started in every worker after the fork, so no AMQP connection or thread crosses a fork.
+On shutdown the components are stopped in reverse order: consumers first, so in-flight
+messages finish and the rest are requeued, then publishers flush what is buffered.
+"""
+
+import os
+import threading
+
+_components = []
+_lock = threading.Lock()
+_started_pid = None
+
+
+def background(start, stop=None):
+    """Register a component; start() is called once per serving process, stop() on shutdown."""
+    _components.append((start, stop))
+
+
+def start_background():
+    global _started_pid
+    with _lock:
+        if _started_pid == os.getpid():
+            return
+        _started_pid = os.getpid()
+    for start, _ in _components:
+        start()
+
+
+def stop_background():
+    global _started_pid
+    with _lock:
+        if _started_pid != os.getpid():
+            return
+        _started_pid = None
+    for _, stop in reversed(_components):
+        if stop is None:
+            continue
+        try:
+            stop()
+        except Exception as e:
+            print(f"Stopping {getattr(stop, '__qualname__', stop)} failed: {e}")
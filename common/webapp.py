@@ -0,0 +1,192 @@
+"""
+Shared Flask setup for the services: setup_app(app) right after app = Flask(__name__).
+
+    - jsonify, view dicts and request.get_json() go through orjson (Flask 2.2+ with
+      orjson installed). Output matches Flask's: sorted keys, HTTP dates for datetimes.
+    - Responses of COMPRESS_MIN_BYTES or more are compressed with brotli (if installed)
+      or gzip, whichever the client accepts. Streamed NDJSON exports are gzipped chunk by
+      chunk, so lines still arrive as they are written.
+    - Request and response sizes per endpoint, before and after compression, are served
+      at GET /metrics.
+"""
+
+import gzip
+import os
+import threading
+import zlib
+
+from flask import jsonify, request
+
+try:
+    import orjson
+except ImportError:  # optional speed-up
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+try:
+    from flask.json.provider import DefaultJSONProvider
+except ImportError:  # Flask < 2.2 has no JSON providers
+    DefaultJSONProvider = None
+
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES") or 1024)
+GZIP_LEVEL = int(os.environ.get("COMPRESS_GZIP_LEVEL") or 5)
+BROTLI_QUALITY = int(os.environ.get("COMPRESS_BROTLI_QUALITY") or 4)
+
+COMPRESSIBLE = ("application/json", "application/x-ndjson", "application/javascript", "text/")
+
+
+if DefaultJSONProvider is not None and orjson is not None:
+
+    class OrjsonProvider(DefaultJSONProvider):
+        """
+        DefaultJSONProvider on orjson. Datetimes are passed to Flask's default() so they
+        keep Flask's HTTP date format; anything orjson rejects (such as integers over 64
+        bits) falls back to the json module. Output is always compact.
+        """
+
+        compact = True
+
+        def _option(self):
+            option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+            if self.sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            return option
+
+        def dumps(self, obj, **kwargs):
+            if not kwargs:
+                try:
+                    return orjson.dumps(obj, default=self.default, option=self._option()).decode()
+                except TypeError:
+                    pass
+            return super().dumps(obj, **kwargs)
+
+        def loads(self, s, **kwargs):
+            if kwargs:
+                return super().loads(s, **kwargs)
+            return orjson.loads(s)
+
+        def response(self, *args, **kwargs):
+            obj = self._prepare_response_obj(args, kwargs)
+            try:
+                body = orjson.dumps(obj, default=self.default, option=self._option() | orjson.OPT_APPEND_NEWLINE)
+            except TypeError:
+                return super().response(obj)
+            return self._app.response_class(body, mimetype=self.mimetype)
+
+else:
+    OrjsonProvider = None
+
+
+class HttpMetrics:
+    """Per-endpoint request counts and byte totals."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, endpoint, request_bytes, response_bytes, sent_bytes):
+        with self._lock:
+            entry = self._endpoints.get(endpoint)
+            if entry is None:
+                entry = self._endpoints[endpoint] = {
+                    "requests": 0,
+                    "requestBytes": 0,
+                    "responseBytes": 0,
+                    "sentBytes": 0,
+                    "maxResponseBytes": 0,
+                    "streamed": 0,
+                }
+            entry["requests"] += 1
+            entry["requestBytes"] += request_bytes
+            if response_bytes is None:
+                entry["streamed"] += 1
+                return
+            entry["responseBytes"] += response_bytes
+            entry["sentBytes"] += sent_bytes
+            entry["maxResponseBytes"] = max(entry["maxResponseBytes"], response_bytes)
+
+    def snapshot(self):
+        with self._lock:
+            return {endpoint: dict(entry) for endpoint, entry in self._endpoints.items()}
+
+
+def _encoding(response):
+    """The content coding to use for this response, or None."""
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return None
+    if response.direct_passthrough or "Content-Encoding" in response.headers:
+        return None
+    if not (response.mimetype or "").startswith(COMPRESSIBLE):
+        return None
+    if brotli is not None and not response.is_streamed and request.accept_encodings["br"]:
+        return "br"
+    if request.accept_encodings["gzip"]:
+        return "gzip"
+    return None
+
+
+def _gzip_chunks(chunks):
+    # One gzip stream, flushed after every chunk so clients can decode as it arrives
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _compress(response):
+    """Compress the response in place; returns its size before and after (None if unknown)."""
+    encoding = _encoding(response)
+    if response.is_streamed:
+        # Error pages are iterators too, but with a Content-Length; only unsized bodies are
+        # compressed. calculate_content_length() would buffer the whole stream.
+        size = response.headers.get("Content-Length", type=int)
+        if size is None and encoding == "gzip":
+            response.response = _gzip_chunks(response.response)
+            response.headers["Content-Encoding"] = "gzip"
+            response.vary.add("Accept-Encoding")
+        return size, size
+    size = response.calculate_content_length() or 0
+    if encoding is None or size < COMPRESS_MIN_BYTES:
+        return size, size
+    data = response.get_data()
+    if encoding == "br":
+        data = brotli.compress(data, quality=BROTLI_QUALITY)
+    else:
+        data = gzip.compress(data, compresslevel=GZIP_LEVEL)
+    response.set_data(data)
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    # The compressed bytes are a different representation of the same document
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return size, len(data)
+
+
+def setup_app(app):
+    """Install the JSON provider, compression and size metrics on a Flask app."""
+    if OrjsonProvider is not None:
+        app.json = OrjsonProvider(app)
+    metrics = HttpMetrics()
+    app.extensions["http_metrics"] = metrics
+
+    @app.after_request
+    def compress_and_measure(response):
+        size, sent = _compress(response)
+        rule = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+        metrics.record(f"{request.method} {rule}", request.content_length or 0, size, sent)
+        return response
+
+    def get_http_metrics():
+        return jsonify({"code": 200, "data": metrics.snapshot()}), 200
+
+    app.add_url_rule("/metrics", "http_metrics", get_http_metrics, methods=["GET"])
+    return app
@@ -1,8 +1,5 @@
 import os
-import time
 import json
-import ast
-import threading
 
 from flask import Flask, jsonify, request
 from flask_cors import CORS
@@ -10,10 +7,12 @@ import pika
 import uuid
 import requests
 
+from common import amqp_lib, codec, serving, webapp
 from common.invokes import invoke_http
 
 app = Flask(__name__)
 CORS(app, origins="http://localhost:3000")  # or origins="*"
+webapp.setup_app(app)
 """
 for testing:
 routing_key = match.request
@@ -40,134 +39,37 @@ ORDER_URL = os.environ.get("ORDER_URL") or "http://localhost:5009/order"
 rabbit_host = os.environ.get("rabbit_host", "localhost")
 rabbit_port = int(os.environ.get("rabbit_port", "5672"))
 
-# Exchanges and queues configuration
-EXCHANGES = {
-    "request_organ_exchange": "direct",       # Listen for incoming organ requests
-    "test_compatibility_exchange": "direct",    # Publish test requests
-    "match_test_result_exchange": "direct",     # Listen for test results
-    "match_result_exchange": "direct",          # Publish final match results
-}
-
-SUBSCRIBE_QUEUES = [
-    {"name": "match_request_queue", "exchange": "request_organ_exchange", "routing_key": "match.request", "type": "direct"},
-    {"name": "match_test_result_queue", "exchange": "test_result_exchange", "routing_key": "test.result", "type": "direct"},
-]
-
 @app.route("/", methods=['GET'])
 def health_check():
     return jsonify({"code": 200, "status": "ok"}), 200
 
-# Global channel for publishing messages (set when the channel opens)
-channel = None
-
-MAX_RETRIES = 3  # Maximum number of retry attempts
+# Shared publisher; safe to use from Flask request threads and the consumer thread
+publisher = amqp_lib.Publisher(rabbit_host, rabbit_port)
 
 def handle_message(ch, method, properties, body):
     try:
-        message_dict = ast.literal_eval(body.decode())
-        print(f"Received message from {method.routing_key}: {message_dict}")
+        message = codec.decode_message(body, method.routing_key, properties.content_type)
+        print(f"Received message from {method.routing_key}: {message}")
         
         # Process the message based on the routing key.
         if method.routing_key == "match.request":
             print("Processing match request...")
-            process_match_request(message_dict)
+            process_match_request(message)
         elif method.routing_key == "test.result":
             print("Processing test result...")
-            process_match_result(message_dict)
+            process_match_result(message)
         else:
             print("Unknown routing key.")
-        
-        # Acknowledge the message after successful processing.
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-    
+
     except Exception as e:
         print(f"Error while handling message: {e}")
-        
-        # Retrieve current retry count from headers, defaulting to 0 if not present.
-        retry_count = 0
-        if properties.headers and 'x-retry-count' in properties.headers:
-            retry_count = properties.headers['x-retry-count']
-        print(f"Current retry count: {retry_count}")
-
-        if retry_count < MAX_RETRIES:
-            # Increase the retry count.
-            new_retry_count = retry_count + 1
-
-            # Create new properties with the updated retry count.
-            new_properties = pika.BasicProperties(
-                headers={"x-retry-count": new_retry_count},
-                delivery_mode=properties.delivery_mode  # Preserve persistence if set.
-            )
-
-            # Republish the message with the updated headers.
-            print(f"Republishing message, retry attempt {new_retry_count}")
-            ch.basic_publish(
-                exchange=method.exchange,
-                routing_key=method.routing_key,
-                body=body,
-                properties=new_properties
-            )
-            # Acknowledge the current message so it is removed from the queue.
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-        else:
-            print("Max retries reached. Discarding message or sending to dead-letter queue.")
-            # Here you could also publish the message to a dead-letter queue instead.
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-
-def on_channel_open(ch):
-    """Callback when the channel has been opened; set up consumers for all queues."""
-    global channel
-    channel = ch  # Save channel for later publishing
-    print("Channel opened, setting up consumers...")
-    for queue in SUBSCRIBE_QUEUES:
-        print(f"Subscribing to queue: {queue['name']}")
-        ch.basic_consume(
-            queue=queue["name"],
-            on_message_callback=handle_message,
-            auto_ack=False
-        )
-    print("Consumers are set up. Waiting for messages...")
-
-def on_connection_open(conn):
-    """Callback when the connection is opened; create a channel."""
-    print("Connection opened")
-    conn.channel(on_open_callback=on_channel_open)
-
-def on_connection_closed(conn, reply_code, reply_text=None):
-    """Callback when the connection is closed."""
-    print(f"Connection closed: reply_code={reply_code}, reply_text={reply_text}")
-    conn.ioloop.stop()
-
-def run_async_consumer():
-    """Set up the asynchronous connection and start the IOLoop with a retry loop."""
-    parameters = pika.ConnectionParameters(
-        host=rabbit_host,
-        port=rabbit_port,
-        heartbeat=300,
-        blocked_connection_timeout=300
-    )
-    while True:
-        try:
-            print(f"Attempting to connect to RabbitMQ at {rabbit_host}:{rabbit_port} ...")
-            conn = pika.SelectConnection(
-                parameters=parameters,
-                on_open_callback=on_connection_open,
-                on_close_callback=on_connection_closed
-            )
-            print("Starting IOLoop")
-            conn.ioloop.start()
-            break  # Exit the loop if the connection and loop run normally
-        except pika.exceptions.AMQPConnectionError as e:
-            print(f"AMQPConnectionError: {e}. Retrying in 5 seconds...")
-            time.sleep(5)
-        except Exception as e:
-            print(f"Unexpected error: {e}. Retrying in 5 seconds...")
-            time.sleep(5)
-
-def ensure_exchange_exists(channel, exchange, exchange_type):
-    # Declare the exchange (it will only create it if it does not already exist)
-    channel.exchange_declare(exchange=exchange, exchange_type=exchange_type, durable=True)
+        raise
 
+# Failed messages are retried with a delay via the broker-side retry queues, then dead-lettered
+consumer = amqp_lib.AsyncConsumer(
+    rabbit_host, rabbit_port, amqp_lib.consumer_queues("match_organ"), handle_message,
+    topology=amqp_lib.load_topology()
+)
 
 def is_compatible(recipient_bloodType, donor_bloodType):
     blood_transfusion_rules = {
@@ -182,22 +84,21 @@ def is_compatible(recipient_bloodType, donor_bloodType):
     }
     return donor_bloodType in blood_transfusion_rules[recipient_bloodType]
 
-def process_match_request(match_request_dict):
+def process_match_request(match_request):
     try:
-        recipient_id = match_request_dict["recipientId"]
+        recipient_id = match_request.recipient_id
         recipient_URL = RECIPIENT_URL + "/" + recipient_id
         print("Invoking recipient atomic service...")
-        recipient_result = invoke_http(recipient_URL, method="GET", json=match_request_dict)
+        recipient_result = invoke_http(recipient_URL, method="GET", json=match_request.to_dict())
         message = json.dumps(recipient_result)
         code = recipient_result["code"]
 
         if code not in range(200, 300):
             print("Publish message with routing_key=match_request.error")
-            channel.basic_publish(
+            publisher.publish(
                 exchange="error_handling_exchange",
                 routing_key="match_request.error",
                 body=message,
-                properties=pika.BasicProperties(delivery_mode=2)
             )
             return jsonify({
                 "code": 500, 
@@ -212,17 +113,16 @@ def process_match_request(match_request_dict):
         print(f"Recipient organs needed: {recipient_organsNeeded}")
 
         print("Invoking organ atomic service...")
-        organ_result = invoke_http(ORGAN_URL, method="GET", json=match_request_dict)
+        organ_result = invoke_http(ORGAN_URL, method="GET", json=match_request.to_dict())
         message = json.dumps(organ_result)
         code = organ_result["code"]
 
         if code not in range(200, 300):
             print("Publish message with routing_key=match_request.error")
-            channel.basic_publish(
+            publisher.publish(
                 exchange="error_handling_exchange",
                 routing_key="match_request.error",
                 body=message,
-                properties=pika.BasicProperties(delivery_mode=2)
             )
             return jsonify({
                 "code": 500, 
@@ -239,60 +139,58 @@ def process_match_request(match_request_dict):
 
         if not organList:
             print("Publish message with routing_key=match_request.info")
-            channel.basic_publish(
+            publisher.publish(
                 exchange="activity_log_exchange",
                 routing_key="match_request.info",
                 body="No matches available",
-                properties=pika.BasicProperties(delivery_mode=2)
             )
             return jsonify({"code": 204, "message": "No compatible matches found."}), 204
 
         print("Publish message with routing_key=match_request.info")
-        channel.basic_publish(
+        publisher.publish(
             exchange="activity_log_exchange",
             routing_key="match_request.info",
             body=message,
-            properties=pika.BasicProperties(delivery_mode=2)
         )
         print("Publish message with routing_key=test.compatibility")
-        channel.basic_publish(
+        # The recipientId header picks the test_compatibility shard (consistent-hash exchange),
+        # so every job for one recipient is handled in order by the same worker.
+        publisher.publish(
             exchange="test_compatibility_exchange",
             routing_key="test.compatibility",
             body=message,
-            properties=pika.BasicProperties(delivery_mode=2)
+            properties=pika.BasicProperties(delivery_mode=2, headers={"recipientId": recipient_id}),
         )
     except Exception as e:
         print("Error in process_match_request:", str(e))
         error_payload = json.dumps({
             "error": str(e),
-            "match_request": match_request_dict
+            "match_request": match_request.to_dict()
         })
         try:
-            channel.basic_publish(
+            publisher.publish(
                 exchange="error_handling_exchange",
                 routing_key="match_request.error",
                 body=error_payload,
-                properties=pika.BasicProperties(delivery_mode=2)
             )
         except Exception as publish_exception:
             print("Failed to publish error message:", str(publish_exception))
         return jsonify({"code": 500, "message": "Error processing match request."}), 500
 
-def process_match_result(match_test_result_dict):
+def process_match_result(test_result):
     try:
         print("Invoking match atomic service...")
-        match_result = invoke_http(MATCH_URL, method="GET", json=match_test_result_dict)
+        match_result = invoke_http(MATCH_URL, method="GET", json=test_result.to_dict())
         match_data = match_result["data"]
         message = json.dumps(match_result)
         code = match_result["code"]
 
         if code not in range(200, 300):
             print("Publish message with routing_key=match_test_result.error")
-            channel.basic_publish(
+            publisher.publish(
                 exchange="error_handling_exchange",
                 routing_key="match_test_result.error.error",
                 body=message,
-                properties=pika.BasicProperties(delivery_mode=2),
             )
             return jsonify({
                 "code": 500,
@@ -300,16 +198,15 @@ def process_match_result(match_test_result_dict):
                 "message": "Error handling matches."
             }), 500
 
-        list_of_match_ids = match_test_result_dict["listOfMatchId"]
+        list_of_match_ids = test_result.match_ids
         print(f"Shortlisted Matches: {list_of_match_ids}")
 
-        message = json.dumps(match_test_result_dict)
+        message = codec.dumps(test_result.to_dict())
         print("Publish message with routing_key=match_result.info")
-        channel.basic_publish(
+        publisher.publish(
             exchange="activity_log_exchange",
             routing_key="match_result.info",
             body=message,
-            properties=pika.BasicProperties(delivery_mode=2),
         )
     # Need to somehow notify the frontend that the matches found are done, then allow user to confirm match
     # maybe it goes to a notification service?
@@ -318,14 +215,13 @@ def process_match_result(match_test_result_dict):
         print("Error in process_match_result:", str(e))
         error_payload = json.dumps({
             "error": str(e),
-            "match_test_result_dict": match_test_result_dict
+            "match_test_result_dict": test_result.to_dict()
         })
         try:
-            channel.basic_publish(
+            publisher.publish(
                 exchange="error_handling_exchange",
                 routing_key="match_result.error",
                 body=error_payload,
-                properties=pika.BasicProperties(delivery_mode=2)
             )
         except Exception as publish_exception:
             print("Failed to publish error message:", str(publish_exception))
@@ -351,11 +247,10 @@ def initiate_match(recipientId):
             print("Publishing message with routing_key=", "match.request")
             # Prepare the message as a JSON string
             message_body = json.dumps({"recipientId": recipientId})
-            channel.basic_publish(
+            publisher.publish(
                 exchange="request_organ_exchange",
                 routing_key="match.request",
                 body=message_body,
-                properties=pika.BasicProperties(delivery_mode=2)  # make message persistent
             )
             # Return a response immediately
             return jsonify({
@@ -491,20 +386,18 @@ def confirm_match():
             print("Publishing message with routing_key=", "order.organ")
             # Prepare the message as a JSON string
             message_body = json.dumps({"orderId": orderId})
-            channel.basic_publish(
+            publisher.publish(
                 exchange="order_exchange",
                 routing_key="order.organ",
                 body=message_body,
-                properties=pika.BasicProperties(delivery_mode=2)  # make message persistent
             )
             print("Publishing message with routing_key=", "order.info")
             # Prepare the message as a JSON string
             message_body = json.dumps({"orderId": orderId})
-            channel.basic_publish(
+            publisher.publish(
                 exchange="activity_log_exchange",
                 routing_key="order.info",
                 body=message_body,
-                properties=pika.BasicProperties(delivery_mode=2)  # make message persistent
             )
             # Return a response immediately
             return jsonify({
@@ -514,23 +407,20 @@ def confirm_match():
 
     except Exception as e:
         print("Error confirming match:", str(e))
-        channel.basic_publish(
-            exchange="error_handling_exchange",
-            routing_key="order.error",
-            body=e,
-            properties=pika.BasicProperties(delivery_mode=2)
-        )
+        publisher.publish(exchange="error_handling_exchange", routing_key="order.error", body=str(e))
         return jsonify({
             "code": 500,
             "message": "An error occurred while confirming the match: " + str(e)
         }), 500
 
 
+# Started next to the HTTP server; the consumer runs on its own daemon thread
+serving.background(publisher.start, publisher.close)
+serving.background(consumer.start, consumer.stop)
+
 if __name__ == "__main__":
     print("This is flask " + os.path.basename(__file__) + " for matching an organ...")
-    # Run the asynchronous AMQP consumer in a separate daemon thread.
-    consumer_thread = threading.Thread(target=run_async_consumer, daemon=True)
-    consumer_thread.start()
+    serving.start_background()
 
     # Now run the Flask server in the main thread.
     app.run(host="0.0.0.0", port=5020, debug=True)
\ No newline at end of file
@@ -0,0 +1,71 @@
+"""
+Render throughput of the precompiled notification templates versus building each email
+with f-strings, as send_notification did before.
+
+Run from composite/SendNotification:
+    python benchmark_templates.py [emails]
+"""
+
+import random
+import sys
+import time
+
+import templates
+
+STATUSES = list(templates.LOCALES["en"]["status_labels"])
+SUBJECTS = templates.LOCALES["en"]["status_labels"]
+
+
+def fstring_status(status_key):
+    """The pre-template path: subject map and HTML rebuilt for every message."""
+    subject_status_dict = dict(SUBJECTS)
+    status = subject_status_dict.get(status_key, "Status Updated")
+    subject = "Delivery Status Update: " + status
+    plain_text = f"Hello there! Your GrabOrgan delivery status is: {status}."
+    html_text = f"""
+    <html>
+      <body>
+        <h1>Hello there!</h1>
+        <p>Your GrabOrgan delivery status is: <strong>{status}</strong></p>
+      </body>
+    </html>
+    """
+    return subject, plain_text, html_text
+
+
+def rate(fn, workload):
+    start = time.perf_counter()
+    for item in workload:
+        fn(item)
+    return len(workload) / (time.perf_counter() - start)
+
+
+def main():
+    emails = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    rng = random.Random(42)
+    singles = [rng.choice(STATUSES) for _ in range(emails)]
+    digests = [tuple(rng.sample(STATUSES, rng.randint(2, 4))) for _ in range(emails // 10)]
+
+    # Same output as the old code for single-status emails
+    for status_key in STATUSES:
+        assert templates.render_status(status_key) == fstring_status(status_key), status_key
+
+    start = time.perf_counter()
+    templates.warm()
+    print(f"warm-up: {(time.perf_counter() - start) * 1000:.2f} ms for {len(templates.COMPILED)} locale(s)")
+
+    cases = [
+        ("f-string per message", fstring_status, singles),
+        ("render_status (cached)", templates.render_status, singles),
+        ("render_status ms (cached)", lambda key: templates.render_status(key, "ms"), singles),
+        ("render_digest (2-4 statuses)", templates.render_digest, digests),
+    ]
+    baseline = None
+    for name, fn, workload in cases:
+        per_second = rate(fn, workload)
+        baseline = baseline or per_second
+        print(f"{name:<30} {per_second:>12,.0f} emails/s  {per_second / baseline:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Per-recipient coalescing of delivery status notifications.
+
+Status updates for one address are held for `window` seconds after the latest update
+(but never longer than `max_wait` after the first) and merged into one digest. Each
+address may receive at most `rate_limit` digests per `rate_period` seconds; a digest that
+would exceed it stays pending, and keeps absorbing updates, until a slot frees up.
+"""
+
+import threading
+import time
+from collections import deque
+
+
+class PendingDigest:
+    __slots__ = ("address", "statuses", "first", "due", "deadline", "limited", "locale")
+
+    def __init__(self, address, now, window, max_wait):
+        self.address = address
+        self.statuses = []
+        self.first = now
+        self.due = now + window
+        self.deadline = now + max_wait
+        self.limited = False
+        self.locale = None
+
+    def add(self, status, now, window, locale=None):
+        self.locale = locale or self.locale
+        if status not in self.statuses:
+            self.statuses.append(status)
+        self.due = min(now + window, self.deadline)
+
+
+class NotificationAggregator:
+    def __init__(self, send, window=10.0, max_wait=30.0, rate_limit=3, rate_period=60.0, tick=0.25,
+                 on_error=None):
+        """
+        send(address, statuses, locale) is called from the flush thread with statuses in
+        arrival order and the locale of the latest update. If it raises, the digest is
+        dropped and on_error(address, statuses, locale, error) is called, so the caller can
+        report it: the updates were acked when they were added.
+        """
+        self.send = send
+        self.on_error = on_error
+        self.window = window
+        self.max_wait = max(max_wait, window)
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        self.tick = tick
+        self.stats = {"received": 0, "sent": 0, "rate_limited": 0, "failed": 0}
+        self._pending = {}
+        self._sent = {}  # address -> deque of send times within rate_period
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="notification-aggregator", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the flush thread and send everything still pending."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush(force=True)
+
+    def add(self, address, status, locale=None):
+        now = time.monotonic()
+        with self._lock:
+            self.stats["received"] += 1
+            digest = self._pending.get(address)
+            if digest is None:
+                digest = self._pending[address] = PendingDigest(address, now, self.window, self.max_wait)
+            digest.add(status, now, self.window, locale)
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _prune(self, sent, now):
+        while sent and sent[0] <= now - self.rate_period:
+            sent.popleft()
+
+    def _allowed(self, address, now):
+        """Sliding-window rate limit; returns True and records the send if the address has a slot."""
+        sent = self._sent.setdefault(address, deque())
+        self._prune(sent, now)
+        if self.rate_limit and len(sent) >= self.rate_limit:
+            return False
+        sent.append(now)
+        return True
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        ready = []
+        with self._lock:
+            for address, digest in list(self._pending.items()):
+                if not force and digest.due > now:
+                    continue
+                if not force and not self._allowed(address, now):
+                    if not digest.limited:
+                        digest.limited = True
+                        self.stats["rate_limited"] += 1
+                    # Try again after the next tick; new updates keep merging into this digest
+                    digest.due = now + self.tick
+                    continue
+                ready.append(self._pending.pop(address))
+            # Forget addresses with no send left in the rate window, or _sent grows forever
+            for address, sent in list(self._sent.items()):
+                self._prune(sent, now)
+                if not sent and address not in self._pending:
+                    del self._sent[address]
+        for digest in ready:
+            try:
+                self.send(digest.address, digest.statuses, digest.locale)
+                self.stats["sent"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"Failed to send notification digest to {digest.address}: {e}")
+                if self.on_error is not None:
+                    try:
+                        self.on_error(digest.address, digest.statuses, digest.locale, e)
+                    except Exception as report_error:
+                        print(f"Failed to report the failed digest: {report_error}")
+
+    def _run(self):
+        while not self._stopped.wait(self.tick):
+            self.flush()
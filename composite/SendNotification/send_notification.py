@@ -2,167 +2,58 @@
 from os import environ
 import json
 import os
+from common import amqp_lib, codec, serving, webapp
 from common.invokes import invoke_http
-import pika  # or your preferred AMQP library
-import ast
-import threading
-import time
 from flask import Flask, jsonify
 from flask_cors import CORS
+from notification_aggregator import NotificationAggregator
+import templates
 
 app = Flask(__name__)
 CORS(app)
+webapp.setup_app(app)
 # Retrieve connection parameters from the environment if available.
 rabbit_host = environ.get("rabbit_host") or "localhost"
 rabbit_port = int(environ.get("rabbit_port")) or 5672
 EMAIL_SUBDOMAIN = environ.get("email_subdomain") or 'DoNotReply@c4de2af4-af42-4134-8003-492f444c8562.azurecomm.net'
 AZURE_EMAIL_URL = environ.get("AZURE_EMAIL_URL") or "http://localhost:5014/email"
-
-SUBSCRIBE_QUEUES = [
-    {"name": "noti_delivery_status_queue", "exchange": "notification_status_exchange", "routing_key": "*.status", "type": "topic"},
-    {"name": "noti_acknowledgement_queue","exchange":"notification_acknowledge_exchange", "routing_key": "*.acknowledge", "type": "topic"},
-]
-MAX_RETRIES = 3
-# Global channel for publishing messages (set when the channel opens)
-channel = None
+# Status updates per address are merged into one digest sent NOTIFY_WINDOW seconds after the
+# latest update (at most NOTIFY_MAX_WAIT after the first); NOTIFY_WINDOW=0 sends every update.
+NOTIFY_WINDOW = float(environ.get("NOTIFY_WINDOW") or 10)
+NOTIFY_MAX_WAIT = float(environ.get("NOTIFY_MAX_WAIT") or 30)
+# At most NOTIFY_RATE_LIMIT status emails per address every NOTIFY_RATE_PERIOD seconds
+NOTIFY_RATE_LIMIT = int(environ.get("NOTIFY_RATE_LIMIT") or 3)
+NOTIFY_RATE_PERIOD = float(environ.get("NOTIFY_RATE_PERIOD") or 60)
+# Locale used when a notification does not carry one
+NOTIFY_LOCALE = environ.get("NOTIFY_LOCALE") or templates.DEFAULT_LOCALE
+
+# Shared publisher; safe to use from Flask request threads and the consumer thread
+publisher = amqp_lib.Publisher(rabbit_host, rabbit_port)
 
 def handle_message(ch, method, properties, body):
     try:
-        message_dict = ast.literal_eval(body.decode())
-        print(f"Received message from {method.routing_key}: {message_dict}")
+        message = codec.decode_message(body, method.routing_key, properties.content_type)
+        print(f"Received message from {method.routing_key}: {message}")
         parts = method.routing_key.split(".")
         # Simulate processing
         if len(parts) == 2 and parts[1] == "status":            
             print("Processing status request with routing_key: ", method.routing_key)
-            process_delivery_status(message_dict, method.routing_key)
+            process_delivery_status(message, method.routing_key)
         elif len(parts) == 2 and parts[1] == "acknowledge":
             print("Processing acknowledgement request...")
-            process_acknowledgment_request(message_dict, method.routing_key)
+            process_acknowledgment_request(message, method.routing_key)
         else:
             print("Unknown routing key.")
-       # Acknowledge the message after successful processing.
-        ch.basic_ack(delivery_tag=method.delivery_tag)
     
     except Exception as e:
         print(f"Error while handling message: {e}")
-        
-        # Retrieve current retry count from headers, defaulting to 0 if not present.
-        retry_count = 0
-        if properties.headers and 'x-retry-count' in properties.headers:
-            retry_count = properties.headers['x-retry-count']
-        print(f"Current retry count: {retry_count}")
-
-        if retry_count < MAX_RETRIES:
-            # Increase the retry count.
-            new_retry_count = retry_count + 1
-
-            # Create new properties with the updated retry count.
-            new_properties = pika.BasicProperties(
-                headers={"x-retry-count": new_retry_count},
-                delivery_mode=properties.delivery_mode  # Preserve persistence if set.
-            )
-
-            # Republish the message with the updated headers.
-            print(f"Republishing message, retry attempt {new_retry_count}")
-            ch.basic_publish(
-                exchange=method.exchange,
-                routing_key=method.routing_key,
-                body=body,
-                properties=new_properties
-            )
-            # Acknowledge the current message so it is removed from the queue.
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-        else:
-            print("Max retries reached. Discarding message or sending to dead-letter queue.")
-            # Here you could also publish the message to a dead-letter queue instead.
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-
-def on_channel_open(ch):
-    """Callback when the channel has been opened; set up consumers for all queues."""
-    global channel
-    channel = ch  # Save channel for later publishing
-    print("Channel opened, setting up consumers...")
-    for queue in SUBSCRIBE_QUEUES:
-        print(f"Subscribing to queue: {queue['name']}")
-        ch.basic_consume(
-            queue=queue["name"],
-            on_message_callback=handle_message,
-            auto_ack=False
-        )
-    print("Consumers are set up. Waiting for messages...")
-
-def on_connection_open(conn):
-    """Callback when the connection is opened; create a channel."""
-    print("Connection opened")
-    conn.channel(on_open_callback=on_channel_open)
-
-def on_connection_closed(conn, reply_code, reply_text=None):
-    """Callback when the connection is closed."""
-    print(f"Connection closed: reply_code={reply_code}, reply_text={reply_text}")
-    conn.ioloop.stop()
-
-def run_async_consumer():
-    """Set up the asynchronous connection and start the IOLoop with a retry loop."""
-    parameters = pika.ConnectionParameters(
-        host=rabbit_host,
-        port=rabbit_port,
-        heartbeat=300,
-        blocked_connection_timeout=300
-    )
-    while True:
-        try:
-            print(f"Attempting to connect to RabbitMQ at {rabbit_host}:{rabbit_port} ...")
-            conn = pika.SelectConnection(
-                parameters=parameters,
-                on_open_callback=on_connection_open,
-                on_close_callback=on_connection_closed
-            )
-            print("Starting IOLoop")
-            conn.ioloop.start()
-            break  # Exit the loop if the connection and loop run normally
-        except pika.exceptions.AMQPConnectionError as e:
-            print(f"AMQPConnectionError: {e}. Retrying in 5 seconds...")
-            time.sleep(5)
-        except Exception as e:
-            print(f"Unexpected error: {e}. Retrying in 5 seconds...")
-            time.sleep(5)
+        raise
 
-def ensure_exchange_exists(channel, exchange, exchange_type):
-    # Declare the exchange (it will only create it if it does not already exist)
-    channel.exchange_declare(exchange=exchange, exchange_type=exchange_type, durable=True)
-
-def delivery_status_email(status):
-    """
-    Returns a tuple of (plain_text, html_text)
-    incorporating the delivery status into the email body.
-    """
-    plain_text = f"Hello there! Your GrabOrgan delivery status is: {status}."
-    html_text = f"""
-    <html>
-      <body>
-        <h1>Hello there!</h1>
-        <p>Your GrabOrgan delivery status is: <strong>{status}</strong></p>
-      </body>
-    </html>
-    """
-    return plain_text, html_text
-
-
-def request_acknowledgement_email():
-    """
-    Returns a tuple of (plain_text, html_text)
-    incorporating the delivery status into the email body.
-    """
-    plain_text = f"Hello there! Your acknowledgement is required on GrabOrgan"
-    html_text = f"""
-    <html>
-      <body>
-        <h1>Hello there!</h1>
-        <p>Your <strong>acknowledgement</strong> is required on GrabOrgan</p>
-      </body>
-    </html>
-    """
-    return plain_text, html_text
+# Failed messages are retried with a delay via the broker-side retry queues, then dead-lettered
+consumer = amqp_lib.AsyncConsumer(
+    rabbit_host, rabbit_port, amqp_lib.consumer_queues("send_notification"), handle_message,
+    topology=amqp_lib.load_topology()
+)
 
 def create_email_message(driver_email, subject, plain_text, html_text):
     # Build the final email message dictionary.
@@ -179,7 +70,59 @@ def create_email_message(driver_email, subject, plain_text, html_text):
     }
     return email_message
 
-def process_delivery_status(message_dict, routing_key):
+def send_status_digest(driver_email, status_keys, locale=None):
+    """
+    Send one email covering every status in status_keys (in arrival order) and log it.
+    Called by the aggregator's flush thread, or directly when coalescing is off.
+    """
+    subject, plain_text, html_text = templates.render_digest(status_keys, locale or NOTIFY_LOCALE)
+    email_message = create_email_message(driver_email, subject, plain_text, html_text)
+    print(f"Sending Email with status: {', '.join(status_keys)}")
+    email_resp = invoke_http(AZURE_EMAIL_URL, method="POST", json=email_message)
+    json_resp = json.dumps(email_resp)
+    code = email_resp["code"]
+
+    if code not in range(200, 300):
+        print("Email sending failed with code:", code)
+        publisher.publish(
+            exchange="error_handling_exchange",
+            routing_key="email.error",
+            body=json_resp,
+        )
+        return
+
+    print("Publishing message to with routing_key: ", "delivery_status.info")
+    publisher.publish(
+        exchange="activity_log_exchange",
+        routing_key="delivery_status.info",
+        body=json.dumps({"email": driver_email, "statuses": status_keys, "response": email_resp}),
+    )
+
+
+def report_failed_digest(driver_email, status_keys, locale, error):
+    """Report a digest that could not be sent: its updates were acked when they were queued."""
+    publisher.publish(
+        exchange="error_handling_exchange",
+        routing_key="delivery_status.error",
+        body=json.dumps({
+            "error": str(error),
+            "routing_key": "delivery_status.digest",
+            "message_dict": {"email": driver_email, "statuses": status_keys, "locale": locale},
+        }),
+    )
+
+
+aggregator = NotificationAggregator(
+    send_status_digest,
+    window=NOTIFY_WINDOW,
+    max_wait=NOTIFY_MAX_WAIT,
+    rate_limit=NOTIFY_RATE_LIMIT,
+    rate_period=NOTIFY_RATE_PERIOD,
+    on_error=report_failed_digest,
+)
+
+
+def process_delivery_status(notification, routing_key):
     """
     Process delivery status and send an email notification.
 
@@ -192,78 +135,38 @@ def process_delivery_status(message_dict, routing_key):
       - arrived.status
       - completed.status     (delivery completed/acknowledged)
 
+    Updates for the same address within NOTIFY_WINDOW are merged into one digest email.
+
     amqp message example:
     {
         "doctorId": "example@gmail.com",
     }
     """
     try:
-        # Extract information from the message
-        driver_id = message_dict.get("driverId", "Driver")
-        driver_email = message_dict.get("email")
-
-        # Build email subject and body based on routing_key
-        subject_prefix = "Delivery Status Update: "
-        subject_status_dict = {
-            "searching": "Searching for Driver",
-            "assigned": "Driver Assigned",
-            "on_the_way": "Driver On The Way",
-            "halfway": "Driver Halfway",
-            "close_by": "Driver Close By",
-            "arrived": "Driver Has Arrived",
-            "completed": "Delivery Completed",
-        }
-
+        driver_email = notification.email
+        if not driver_email:
+            raise ValueError("Status notification has no email address")
         # Get the status (before .status) from the routing key.
         status_key = routing_key.split(".")[0]
-        subject = subject_prefix + subject_status_dict.get(status_key, "Status Updated")
-
-            # Generate email body using our helper function.
-        if status_key in subject_status_dict:
-            plain_text, html_text = delivery_status_email(subject_status_dict[status_key])
+        if NOTIFY_WINDOW > 0:
+            aggregator.add(driver_email, status_key, notification.locale)
         else:
-            plain_text, html_text = delivery_status_email("Status Updated")
-        
-        email_message = create_email_message(driver_email, subject, plain_text, html_text)
-        print("Sending Email with status: " + routing_key)
-        email_resp = invoke_http(AZURE_EMAIL_URL, method="POST",json=email_message)
-        json_resp = json.dumps(email_resp)
-        code = email_resp["code"]
-
-        if code not in range(200,300):
-            print("Email sending failed with code:", code)
-            channel.basic_publish(
-                exchange="error_handling_exchange",
-                routing_key="email.error",
-                body=json_resp,
-                properties=pika.BasicProperties(delivery_mode=2)
-            )
-            # return jsonify({"code": code, "message": email_resp["message"]}), code
-            return
-        
-        print("Publishing message to with routing_key: ", "status.info")
-        channel.basic_publish(
-                exchange="activity_log_exchange",
-                routing_key="delivery_status.info",
-                body=json_resp,
-                properties=pika.BasicProperties(delivery_mode=2)  # make message persistent
-            )
+            send_status_digest(driver_email, [status_key], notification.locale)
     except Exception as e:
         print("Exception in process_delivery_status:", str(e))
         error_payload = json.dumps({
             "error": str(e),
             "routing_key": routing_key,
-            "message_dict": message_dict
+            "message_dict": notification.to_dict()
         })
-        channel.basic_publish(
+        publisher.publish(
             exchange="error_handling_exchange",
             routing_key="delivery_status.error",
             body=error_payload,
-            properties=pika.BasicProperties(delivery_mode=2)
         )
 
 
-def process_acknowledgment_request(message_dict, routing_key):
+def process_acknowledgment_request(notification, routing_key):
     """
     Process an acknowledgement message and send an email notification.
 
@@ -277,22 +180,14 @@ def process_acknowledgment_request(message_dict, routing_key):
     }
     """
     try:
-        subject_prefix = "Acknowledgement Required: "
         status_key = routing_key.split(".")[0]
 
         # Extract information from the message
-        driver_id = message_dict.get("driverId", "Driver")
-        driver_email = message_dict.get("email")
+        driver_email = notification.email
+        rendered = templates.render_acknowledgement(status_key, notification.locale or NOTIFY_LOCALE)
 
-        subject_dict = {
-            "request": "Delivery Assigned",
-            "completed": "Delivery Completed",
-
-        }
-
-        if status_key in subject_dict:
-            subject = subject_prefix + subject_dict[status_key]
-            plain_text, html_text = request_acknowledgement_email()
+        if rendered is not None:
+            subject, plain_text, html_text = rendered
             email_message = create_email_message(driver_email, subject, plain_text, html_text)
             print("Sending Email with status: " + routing_key)
             email_resp = invoke_http(AZURE_EMAIL_URL, "POST", json=email_message)
@@ -301,49 +196,57 @@ def process_acknowledgment_request(message_dict, routing_key):
 
             if code not in range(200,300):
                 print("Email sending failed with code:", code)
-                channel.basic_publish(
+                publisher.publish(
                     exchange="error_handling_exchange",
                     routing_key="email.error",
                     body=json_resp,
-                    properties=pika.BasicProperties(delivery_mode=2)
                 )
                 return jsonify({"code": code, "message": email_resp["message"]}), code
             
             print("Publishing message to with routing_key: ", "acknowledge.info")
-            channel.basic_publish(
-                    exchange="activity_log_exchange",
-                    routing_key="acknowledge.info",
-                    body=json_resp,
-                    properties=pika.BasicProperties(delivery_mode=2)  # make message persistent
-                )
+            publisher.publish(
+                exchange="activity_log_exchange",
+                routing_key="acknowledge.info",
+                body=json_resp,
+            )
             
         else:
             print("Publishing message to with routing_key: ", routing_key) # publish any unknown keys to the error log
-            channel.basic_publish(
+            publisher.publish(
                 exchange="error_handling_exchange",
                 routing_key="email.error",
-                body=message_dict,
-                properties=pika.BasicProperties(delivery_mode=2)  # make message persistent
+                body=json.dumps(notification.to_dict()),
             )
     except Exception as e:
         print("Exception in process_acknowledgment_request:", str(e))
         error_payload = json.dumps({
             "error": str(e),
             "routing_key": routing_key,
-            "message_dict": message_dict
+            "message_dict": notification.to_dict()
         })
-        channel.basic_publish(
+        publisher.publish(
             exchange="error_handling_exchange",
             routing_key="acknowledge.error",
             body=error_payload,
-            properties=pika.BasicProperties(delivery_mode=2)
         )
 
 
+@app.route("/", methods=["GET"])
+def health_check():
+    data = dict(aggregator.stats, pending=aggregator.pending())
+    return jsonify({"code": 200, "status": "ok", "data": data}), 200
+
+
+# Stopped in reverse: the consumer drains, the aggregator sends what is pending, then
+# the publisher flushes
+serving.background(templates.warm)
+serving.background(publisher.start, publisher.close)
+serving.background(aggregator.start, aggregator.stop)
+serving.background(consumer.start, consumer.stop)
+
 if __name__ == "__main__":
     print(f"This is {os.path.basename(__file__)} - Send Notification service...")
-    consumer_thread = threading.Thread(target=run_async_consumer, daemon=True)
-    consumer_thread.start()
+    serving.start_background()
 
     # Now run the Flask server in the main thread.
     app.run(host="0.0.0.0", port=5027, debug=True)
\ No newline at end of file
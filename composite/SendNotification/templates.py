@@ -0,0 +1,187 @@
+"""
+Precompiled, localised notification email templates.
+
+Every template string is split once, at import, into its static text and its
+placeholders, so rendering is a join over the parts. Emails that depend only on the
+status and the locale (every single-status and acknowledgement email) are rendered once
+and then served from a cache. Values are HTML-escaped for the html bodies.
+
+A locale is a dict of template strings and labels; add one to LOCALES and it is
+compiled with the rest. Missing keys fall back to DEFAULT_LOCALE.
+"""
+
+import html
+import string
+from functools import lru_cache
+
+DEFAULT_LOCALE = "en"
+
+_HTML_PAGE = """
+    <html>
+      <body>
+        <h1>{greeting}</h1>
+        {body}
+      </body>
+    </html>
+    """
+
+LOCALES = {
+    "en": {
+        "greeting": "Hello there!",
+        "status_subject": "Delivery Status Update: {status}",
+        "status_plain": "Hello there! Your GrabOrgan delivery status is: {status}.",
+        "status_html": "<p>Your GrabOrgan delivery status is: <strong>{status}</strong></p>",
+        "digest_plain": "Hello there! Your GrabOrgan delivery status updates: {statuses}.",
+        "digest_html": "<p>Your GrabOrgan delivery status is now: <strong>{status}</strong></p>\n        <ol>{items}</ol>",
+        "ack_subject": "Acknowledgement Required: {status}",
+        "ack_plain": "Hello there! Your acknowledgement is required on GrabOrgan",
+        "ack_html": "<p>Your <strong>acknowledgement</strong> is required on GrabOrgan</p>",
+        "status_labels": {
+            "searching": "Searching for Driver",
+            "assigned": "Driver Assigned",
+            "on_the_way": "Driver On The Way",
+            "halfway": "Driver Halfway",
+            "close_by": "Driver Close By",
+            "arrived": "Driver Has Arrived",
+            "completed": "Delivery Completed",
+        },
+        "status_unknown": "Status Updated",
+        "ack_labels": {
+            "request": "Delivery Assigned",
+            "completed": "Delivery Completed",
+        },
+    },
+    "ms": {
+        "greeting": "Helo!",
+        "status_subject": "Kemas Kini Status Penghantaran: {status}",
+        "status_plain": "Helo! Status penghantaran GrabOrgan anda ialah: {status}.",
+        "status_html": "<p>Status penghantaran GrabOrgan anda ialah: <strong>{status}</strong></p>",
+        "digest_plain": "Helo! Kemas kini status penghantaran GrabOrgan anda: {statuses}.",
+        "digest_html": "<p>Status penghantaran GrabOrgan anda kini: <strong>{status}</strong></p>\n        <ol>{items}</ol>",
+        "ack_subject": "Pengesahan Diperlukan: {status}",
+        "ack_plain": "Helo! Pengesahan anda diperlukan di GrabOrgan",
+        "ack_html": "<p><strong>Pengesahan</strong> anda diperlukan di GrabOrgan</p>",
+        "status_labels": {
+            "searching": "Mencari Pemandu",
+            "assigned": "Pemandu Ditugaskan",
+            "on_the_way": "Pemandu Dalam Perjalanan",
+            "halfway": "Pemandu Separuh Jalan",
+            "close_by": "Pemandu Hampir Tiba",
+            "arrived": "Pemandu Telah Tiba",
+            "completed": "Penghantaran Selesai",
+        },
+        "status_unknown": "Status Dikemas Kini",
+        "ack_labels": {
+            "request": "Penghantaran Ditugaskan",
+            "completed": "Penghantaran Selesai",
+        },
+    },
+}
+
+TEMPLATE_KEYS = ("status_subject", "status_plain", "status_html", "digest_plain", "digest_html",
+                 "ack_subject", "ack_plain", "ack_html")
+HTML_KEYS = {"status_html", "digest_html", "ack_html"}
+
+
+class Template:
+    """A format string split into (literal, field) pairs once, rendered by joining."""
+    __slots__ = ("parts", "escape")
+
+    def __init__(self, source, escape=False):
+        self.parts = tuple(
+            (literal, field) for literal, field, _, _ in string.Formatter().parse(source)
+        )
+        self.escape = escape
+
+    def render(self, values, raw=()):
+        out = []
+        for literal, field in self.parts:
+            out.append(literal)
+            if field is not None:
+                value = str(values[field])
+                out.append(html.escape(value) if self.escape and field not in raw else value)
+        return "".join(out)
+
+
+def _compile(locale):
+    strings = dict(LOCALES[DEFAULT_LOCALE], **LOCALES[locale])
+    compiled = {key: Template(strings[key], escape=key in HTML_KEYS) for key in TEMPLATE_KEYS}
+    compiled["page"] = Template(_HTML_PAGE)
+    compiled["greeting"] = html.escape(strings["greeting"])
+    compiled["status_labels"] = dict(LOCALES[DEFAULT_LOCALE]["status_labels"], **strings["status_labels"])
+    compiled["ack_labels"] = dict(LOCALES[DEFAULT_LOCALE]["ack_labels"], **strings["ack_labels"])
+    compiled["status_unknown"] = strings["status_unknown"]
+    return compiled
+
+
+COMPILED = {locale: _compile(locale) for locale in LOCALES}
+
+
+def _templates(locale):
+    return COMPILED.get(locale) or COMPILED[DEFAULT_LOCALE]
+
+
+def _page(t, body_html):
+    return t["page"].render({"greeting": t["greeting"], "body": body_html})
+
+
+def status_label(status_key, locale=DEFAULT_LOCALE):
+    t = _templates(locale)
+    return t["status_labels"].get(status_key, t["status_unknown"])
+
+
+@lru_cache(maxsize=1024)
+def render_status(status_key, locale=DEFAULT_LOCALE):
+    """(subject, plain_text, html_text) for one delivery status; cached per status and locale."""
+    t = _templates(locale)
+    values = {"status": status_label(status_key, locale)}
+    return (
+        t["status_subject"].render(values),
+        t["status_plain"].render(values),
+        _page(t, t["status_html"].render(values)),
+    )
+
+
+def render_digest(status_keys, locale=DEFAULT_LOCALE):
+    """(subject, plain_text, html_text) listing several statuses, oldest first."""
+    if len(status_keys) == 1:
+        return render_status(status_keys[0], locale)
+    return _render_digest(tuple(status_keys), locale)
+
+
+# Digests are ordered combinations of a handful of statuses, so they cache well too
+@lru_cache(maxsize=4096)
+def _render_digest(status_keys, locale):
+    t = _templates(locale)
+    labels = [status_label(key, locale) for key in status_keys]
+    latest = {"status": labels[-1]}
+    items = "".join(f"<li>{html.escape(label)}</li>" for label in labels)
+    return (
+        t["status_subject"].render(latest),
+        t["digest_plain"].render({"statuses": " -> ".join(labels)}),
+        _page(t, t["digest_html"].render({"status": labels[-1], "items": items}, raw=("items",))),
+    )
+
+
+@lru_cache(maxsize=1024)
+def render_acknowledgement(kind, locale=DEFAULT_LOCALE):
+    """(subject, plain_text, html_text) for an acknowledgement request, or None for an unknown kind."""
+    t = _templates(locale)
+    label = t["ack_labels"].get(kind)
+    if label is None:
+        return None
+    values = {"status": label}
+    return (
+        t["ack_subject"].render(values),
+        t["ack_plain"].render(values),
+        _page(t, t["ack_html"].render(values)),
+    )
+
+
+def warm():
+    """Render every cacheable email for every locale; called at startup."""
+    for locale, t in COMPILED.items():
+        for status_key in t["status_labels"]:
+            render_status(status_key, locale)
+        for kind in t["ack_labels"]:
+            render_acknowledgement(kind, locale)
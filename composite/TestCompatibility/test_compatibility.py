@@ -6,13 +6,16 @@ import random
 from datetime import datetime
 import os
 import threading
+import multiprocessing
+import signal
+from common import amqp_lib, codec, serving, webapp
 from common.invokes import invoke_http
-import ast
 import time
 import logging
 
 app = Flask(__name__)
 CORS(app)
+webapp.setup_app(app)
 
 # RabbitMQ Connection Details
 rabbit_host = os.environ.get("rabbit_host", "localhost") or "localhost"
@@ -20,7 +23,6 @@ rabbit_port = os.environ.get("rabbit_port", "5672")
 
 # RabbitMQ Exchange & Routing Keys
 TEST_COMPATIBILITY_EXCHANGE = "test_compatibility_exchange"
-TEST_COMPATIBILITY_QUEUE = "test_compatibility_queue"
 TEST_RESULT_EXCHANGE = "test_result_exchange"
 MATCH_TEST_RESULT_ROUTING_KEY = "test.result"
 ORGAN_URL = os.environ.get("ORGAN_URL") or "http://localhost:5010/organ"
@@ -31,10 +33,9 @@ LAB_INFO_URL = os.environ.get("LAB_INFO_URL") or "http://localhost:5007/lab-repo
 def health_check():
     return jsonify({"code": 200, "status": "ok"}), 200
 
-# Global channel for publishing messages (set when the channel opens)
-channel = None
+# Shared publisher; safe to use from Flask request threads and the consumer thread
+publisher = amqp_lib.Publisher(rabbit_host, rabbit_port)
 
-MAX_RETRIES = 3  # Maximum number of retry attempts
 HLA_THRESHOLD = 4
 
 
@@ -47,106 +48,61 @@ HLA_THRESHOLD = 4
 
 def handle_message(ch, method, properties, body):
     try:
-        message_dict = ast.literal_eval(body.decode())
-        print(f"Received message from {method.routing_key}: {message_dict}")
+        message = codec.decode_message(body, method.routing_key, properties.content_type)
+        print(f"Received message from {method.routing_key}: {message}")
         
         if method.routing_key == "test.compatibility":	
             print("Processing compatibility request...")
-            response = process_message(message_dict)
+            response = process_message(message)
             print("Publishing match results...")
             print(f"Match results sent: {response}")
         else:
             print("Unknown routing key.")
-        
-        # Acknowledge the message after successful processing.
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-    
+
     except Exception as e:
         print(f"Error while handling message: {e}")
-        
-        # Retrieve current retry count from headers, defaulting to 0 if not present.
-        retry_count = 0
-        if properties.headers and 'x-retry-count' in properties.headers:
-            retry_count = properties.headers['x-retry-count']
-        print(f"Current retry count: {retry_count}")
-
-        if retry_count < MAX_RETRIES:
-            # Increase the retry count.
-            new_retry_count = retry_count + 1
-
-            # Create new properties with the updated retry count.
-            new_properties = pika.BasicProperties(
-                headers={"x-retry-count": new_retry_count},
-                delivery_mode=properties.delivery_mode  # Preserve persistence if set.
-            )
+        raise
 
-            # Republish the message with the updated headers.
-            print(f"Republishing message, retry attempt {new_retry_count}")
-            ch.basic_publish(
-                exchange=method.exchange,
-                routing_key=method.routing_key,
-                body=body,
-                properties=new_properties
-            )
-            # Acknowledge the current message so it is removed from the queue.
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-        else:
-            print("Max retries reached. Discarding message or sending to dead-letter queue.")
-            # Here you could also publish the message to a dead-letter queue instead.
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-
-def on_channel_open(ch):
-    """Callback when the channel has been opened; set up consumers for all queues."""
-    global channel
-    channel = ch  # Save channel for later publishing
-    print("Channel opened, setting up consumers...")
-    print(f"Subscribing to queue: {TEST_COMPATIBILITY_QUEUE}")
-    ch.basic_consume(
-        queue=TEST_COMPATIBILITY_QUEUE,
-        on_message_callback=handle_message,
-        auto_ack=False
-    )
-    print("Consumers are set up. Waiting for messages...")
-
-def on_connection_open(conn):
-    """Callback when the connection is opened; create a channel."""
-    print("Connection opened")
-    conn.channel(on_open_callback=on_channel_open)
-
-def on_connection_closed(conn, reply_code, reply_text=None):
-    """Callback when the connection is closed."""
-    print(f"Connection closed: reply_code={reply_code}, reply_text={reply_text}")
-    conn.ioloop.stop()
-
-def run_async_consumer():
-    """Set up the asynchronous connection and start the IOLoop with a retry loop."""
-    parameters = pika.ConnectionParameters(
-        host=rabbit_host,
-        port=rabbit_port,
-        heartbeat=300,
-        blocked_connection_timeout=300
+# Compatibility jobs are sharded by recipientId over the test_compatibility_queue.N queues.
+# Each shard is owned by exactly one worker process, so jobs for a recipient stay in order.
+# More workers than shard queues are not started (see start_consumers).
+WORKERS = max(1, int(os.environ.get("TEST_COMPATIBILITY_WORKERS", "1")))
+# Seconds worker processes get to finish their current message on shutdown, as gunicorn gives its workers
+GRACEFUL_TIMEOUT = int(os.environ.get("WEB_GRACEFUL_TIMEOUT") or 30)
+SHARD_EXCHANGE = "test_compatibility_hash_exchange"
+
+def shard_queues():
+    """(shard queues bound to SHARD_EXCHANGE, other queues such as the legacy unsharded one)."""
+    topology = amqp_lib.load_topology()
+    shards, others = [], []
+    for queue in amqp_lib.consumer_queues("test_compatibility", topology):
+        bindings = topology["queues"][queue].get("bindings") or []
+        sharded = any(binding["exchange"] == SHARD_EXCHANGE for binding in bindings)
+        (shards if sharded else others).append(queue)
+    return shards, others
+
+def make_consumer(worker_index=0, worker_count=1):
+    """Consumer for the queues owned by this worker: shard i goes to worker i % worker_count,
+    and worker 0 also drains the other queues.
+    Failed messages are retried with a delay via the broker-side retry queues, then dead-lettered."""
+    shards, others = shard_queues()
+    owned = [queue for index, queue in enumerate(shards) if index % worker_count == worker_index]
+    if worker_index == 0:
+        owned += others
+    return amqp_lib.AsyncConsumer(
+        rabbit_host, rabbit_port, owned, handle_message, topology=amqp_lib.load_topology()
     )
-    while True:
-        try:
-            print(f"Attempting to connect to RabbitMQ at {rabbit_host}:{rabbit_port} ...")
-            conn = pika.SelectConnection(
-                parameters=parameters,
-                on_open_callback=on_connection_open,
-                on_close_callback=on_connection_closed
-            )
-            print("Starting IOLoop")
-            conn.ioloop.start()
-            break  # Exit the loop if the connection and loop run normally
-        except pika.exceptions.AMQPConnectionError as e:
-            print(f"AMQPConnectionError: {e}. Retrying in 5 seconds...")
-            time.sleep(5)
-        except Exception as e:
-            print(f"Unexpected error: {e}. Retrying in 5 seconds...")
-            time.sleep(5)
 
-def ensure_exchange_exists(channel, exchange, exchange_type):
-    # Declare the exchange (it will only create it if it does not already exist)
-    channel.exchange_declare(exchange=exchange, exchange_type=exchange_type, durable=True)
+def run_worker(worker_index, worker_count):
+    """Entry point of a worker process: its own publisher and consumer, consuming in the foreground."""
+    print(f"Compatibility worker {worker_index + 1}/{worker_count} starting")
+    publisher.start()
+    consumer = make_consumer(worker_index, worker_count)
+    # SIGTERM from stop_consumers: finish and ack the message in hand, then disconnect
+    signal.signal(signal.SIGTERM, lambda signum, frame: consumer.stop(timeout=None))
+    consumer.run()
+    publisher.close()
+    print(f"Compatibility worker {worker_index + 1}/{worker_count} stopped")
 
 hla_options = {
     "A": ["A1", "A2", "A3", "A11", "A24", "A26"],
@@ -188,12 +144,12 @@ def generate_hla_match_flags(hla_score):
     return result
 
 
-def process_message(message_dict):
+def process_message(compatibility_request):
     """Process the matching request message as described earlier."""
     try:
         # Extract basic information.
-        recipient_uuid = message_dict["recipientId"]
-        organ_uuids = message_dict["listOfOrganId"]
+        recipient_uuid = compatibility_request.recipient_id
+        organ_uuids = compatibility_request.organ_ids
         print(f"Received message for recipientId: {recipient_uuid}, listOfOrganId: {organ_uuids}")
 
         setOfDonorId = set()
@@ -203,7 +159,7 @@ def process_message(message_dict):
             try:
                 print(f"Fetching organ data for organId: {organ_uuid}...")
                 organ_url = f"{ORGAN_URL}/{organ_uuid}"
-                organ_result = invoke_http(organ_url, method="GET", json=message_dict)
+                organ_result = invoke_http(organ_url, method="GET", json=compatibility_request.to_dict())
                 message = json.dumps(organ_result)
                 code = organ_result["code"] 
 
@@ -213,37 +169,34 @@ def process_message(message_dict):
                     organ_data[organ_uuid] = organ
                     setOfDonorId.add(organ["donorId"])
                     # print(f"Successfully fetched organ data for {organ_uuid}: {organ_result}")
-                    channel.basic_publish(
+                    publisher.publish(
                         exchange="activity_log_exchange",
                         routing_key="test_compatibility.info",
                         body=json.dumps({
                             "organId": organ_uuid,
                             "message": organ_result
                         }),
-                        properties=pika.BasicProperties(delivery_mode=2)
                     )
                 else:
                     error_msg = organ_result.get('message', 'Unknown error')
                     print(f"Failed to fetch organ data for organId: {organ_uuid}. Error: {error_msg}")
-                    channel.basic_publish(
+                    publisher.publish(
                         exchange="error_handling_exchange",
                         routing_key="test_compatibility.error",
                         body=json.dumps({
                             "organId": organ_uuid,
                             "message": error_msg
                         }),
-                        properties=pika.BasicProperties(delivery_mode=2)
                     )
             except Exception as ex:
                 print(f"Exception fetching organ {organ_uuid}: {str(ex)}")
-                channel.basic_publish(
+                publisher.publish(
                     exchange="error_handling_exchange",
                     routing_key="test_compatibility.error",
                     body=json.dumps({
                         "organId": organ_uuid,
                         "message": str(ex)
                     }),
-                    properties=pika.BasicProperties(delivery_mode=2)
                 )
         # Compare Tissue Test from donor & recipient to get hlaScore
         try:
@@ -298,14 +251,13 @@ def process_message(message_dict):
                     # print(store_compatibility)
                     if store_compatibility["code"] not in range(200,300):
                         print(f"Publishing error via AMQP: {str(store_compatibility["message"])}")
-                        channel.basic_publish(
+                        publisher.publish(
                             exchange="error_handling_exchange",
                             routing_key="test_compatibility.error",
                             body=json.dumps({
                                 "message": str(store_compatibility["message"]),
                                 "data": recipient_uuid,
                             }),
-                            properties=pika.BasicProperties(delivery_mode=2)
                         )
 
                 except Exception as e:
@@ -329,14 +281,13 @@ def process_message(message_dict):
 
                     if code not in range(200, 300):
                         print(f"Publishing error via AMQP: {str(compatibility_test["message"])}")
-                        channel.basic_publish(
+                        publisher.publish(
                             exchange="error_handling_exchange",
                             routing_key="test_compatibility.error",
                             body=json.dumps({
                                 "message": str(e),
                                 "data": match_ids
                             }),
-                            properties=pika.BasicProperties(delivery_mode=2)
                         )
 
                     hlaTyping = compatibility_data["hlaTyping"]
@@ -363,14 +314,13 @@ def process_message(message_dict):
                     print(f"OrganId {organ_uuid} did not meet HLA threshold: {score}/6")
             except Exception as ex:
                 print(f"Error processing match for organId {organ_uuid}: {str(ex)}")
-                channel.basic_publish(
+                publisher.publish(
                     exchange="error_handling_exchange",
                     routing_key="test_compatibility.error",
                     body=json.dumps({
                         "organId": organ_uuid,
                         "message": str(ex)
                     }),
-                    properties=pika.BasicProperties(delivery_mode=2)
                 )
 
         # Post valid matches to Match Atomic Service.
@@ -379,14 +329,13 @@ def process_message(message_dict):
                 post_matches_to_match_service(matches)
             except Exception as post_ex:
                 print(f"Error posting matches: {str(post_ex)}")
-                channel.basic_publish(
+                publisher.publish(
                     exchange="error_handling_exchange",
                     routing_key="test_compatibility.error",
                     body=json.dumps({
                         "message": str(post_ex),
                         "matches": matches
                     }),
-                    properties=pika.BasicProperties(delivery_mode=2)
                 )
         else:
             print("No valid HLA matches to post.")
@@ -402,14 +351,13 @@ def process_message(message_dict):
                 send_results_to_match_organ([])
         except Exception as e:
             print(f"Publishing error via AMQP: {str(e)}")
-            channel.basic_publish(
+            publisher.publish(
                 exchange="error_handling_exchange",
                 routing_key="test_compatibility.error",
                 body=json.dumps({
                     "message": str(e),
                     "data": match_ids
                 }),
-                properties=pika.BasicProperties(delivery_mode=2)
             )
 
         return {"listOfMatchId": match_ids}
@@ -418,14 +366,13 @@ def process_message(message_dict):
         print("Error in process_message:", str(e))
         error_payload = json.dumps({
             "message": str(e),
-            "data": message_dict
+            "data": compatibility_request.to_dict()
         })
         try:
-            channel.basic_publish(
+            publisher.publish(
                 exchange="error_handling_exchange",
                 routing_key="test_compatibility.error",
                 body=error_payload,
-                properties=pika.BasicProperties(delivery_mode=2)
             )
         except Exception as publish_exception:
             print("Failed to publish error message:", str(publish_exception))
@@ -465,13 +412,10 @@ def post_matches_to_match_service(matches):
                 # Prepare the message as a JSON string
                 message_body = json.dumps({"message": log_message, "matchId": match_id})
                 
-                channel.basic_publish(
-                    exchange="activity_log_exchange",  # Use the activity_log_exchange
-                    routing_key="test_compatibility.info",  # Use routing key 'test_compatibility.info'
-                    body=message_body,  # The log message body
-                    properties=pika.BasicProperties(
-                        delivery_mode=2  # Make message persistent
-                    )
+                publisher.publish(
+                    exchange="activity_log_exchange",
+                    routing_key="test_compatibility.info",
+                    body=message_body,
                 )
                 print(f"Activity log sent: {log_message}")
                 
@@ -485,22 +429,65 @@ def send_results_to_match_organ(match_ids):
     """Send results back to matchOrgan composite via AMQP (test.result)."""
     try:
         amqp_message = {"listOfMatchId": match_ids}
-        channel.basic_publish(
+        publisher.publish(
             exchange=TEST_RESULT_EXCHANGE,
             routing_key=MATCH_TEST_RESULT_ROUTING_KEY,
             body=json.dumps(amqp_message),
-            properties=pika.BasicProperties(delivery_mode=2)  # Make message persistent
         )
         print(f"AMQP message sent: {json.dumps(amqp_message)}")
     except Exception as e:
         print(f"Failed to send AMQP message: {str(e)}")
 
+consumers = []
+
+def start_consumers():
+    """One consumer thread, or WORKERS processes that each own a share of the shard queues."""
+    # A worker without a shard queue would have nothing to consume
+    shards = len(shard_queues()[0])
+    workers = max(1, min(WORKERS, shards))
+    if workers < WORKERS:
+        print(f"TEST_COMPATIBILITY_WORKERS={WORKERS} but there are only {shards} shard queues; starting {workers} workers")
+    if workers > 1:
+        # spawn (not fork) so no worker inherits the parent's AMQP connections or threads
+        context = multiprocessing.get_context("spawn")
+        for index in range(workers):
+            process = context.Process(
+                target=run_worker, args=(index, workers), name=f"compatibility-worker-{index}", daemon=True
+            )
+            process.start()
+            consumers.append(process)
+    else:
+        consumers.append(make_consumer().start())
+
+def stop_consumers():
+    """Let every consumer finish its current message; worker processes that do not exit
+    within GRACEFUL_TIMEOUT are killed, and their unacked messages go back to the queue."""
+    processes = []
+    for consumer in consumers:
+        if isinstance(consumer, amqp_lib.AsyncConsumer):
+            consumer.stop()
+        else:
+            consumer.terminate()  # SIGTERM: the worker drains (see run_worker)
+            processes.append(consumer)
+    deadline = time.monotonic() + GRACEFUL_TIMEOUT
+    for process in processes:
+        process.join(max(0, deadline - time.monotonic()))
+        if process.is_alive():
+            print(f"{process.name} did not stop within {GRACEFUL_TIMEOUT}s; killing it")
+            process.kill()
+            process.join()
+    consumers.clear()
+
+# Only one process may run these: two consumers per shard break per-recipient ordering,
+# so this service is served by a single gunicorn worker
+serving.background(publisher.start, publisher.close)
+serving.background(start_consumers, stop_consumers)
+
 # Run the Flask app
 if __name__ == "__main__":
     print(f"This is {os.path.basename(__file__)} - Test Compatibility Service")
+    serving.start_background()
 
-    consumer_thread = threading.Thread(target=run_async_consumer, daemon=True)
-    consumer_thread.start()
-
-    # Start the Flask app in the main thread.
-    app.run(host="0.0.0.0", port=5022, debug=True)
+    # Start the Flask app in the main thread. The reloader would run a second copy of this
+    # block, i.e. two consumers per shard, which breaks per-recipient ordering.
+    app.run(host="0.0.0.0", port=5022, debug=True, use_reloader=False)
@@ -7,10 +7,11 @@ import os
 import pika
 import time
 import uuid
-import threading
+from common import amqp_lib, codec, serving, webapp
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
+webapp.setup_app(app)
 
 # Service Endpoints
 SERVICE_URLS = {
@@ -50,28 +51,11 @@ rabbit_host = os.environ.get("RABBITMQ_HOST", "rabbitmq")
 rabbit_port = int(os.environ.get("RABBITMQ_PORT", "5672"))
 print('RabbitMQ host:', rabbit_host)
 
-# Exchanges and queues configuration
-EXCHANGES = {
-    "driver_match_exchange": "direct",  # Publish driver match request
-    "order_exchange": "direct"          # Add this to listen for order messages
-}
-
-ROUTING_KEYS = {
-    "driver_request": "driver.request"
-}
-
-SUBSCRIBE_QUEUES = [
-    {"name": "order_queue", "exchange": "order_exchange", "routing_key": "order.organ", "type": "direct"}
-]
-
-print('exchange & keys declared')
-
 HEADERS = {'Content-Type': 'application/json'}
 TIMEOUT = 10  # API timeout for requests
 
-# Global channel variable
-channel = None
-connection = None
+# Shared publisher; safe to use from Flask request threads and the consumer thread
+publisher = amqp_lib.Publisher(rabbit_host, rabbit_port)
 
 
 def make_request(url, method="POST", payload=None):
@@ -117,12 +101,6 @@ def retrieve_polyline(coord1, coord2):
 # AMQP selection for driver
 def publish_delivery_request(delivery_id, origin_address, destination_address):
     """Publish delivery request to RabbitMQ"""
-    global channel
-    
-    if channel is None or not channel.is_open:
-        print("Channel is not open, cannot publish message")
-        return False
-    
     message = {
         "deliveryId": delivery_id,
         "origin_address": origin_address,
@@ -130,14 +108,14 @@ def publish_delivery_request(delivery_id, origin_address, destination_address):
     }
     
     try:
-        channel.basic_publish(
+        publisher.publish(
             exchange='driver_match_exchange',
             routing_key='driver.request',
             body=json.dumps(message),
             properties=pika.BasicProperties(
                 delivery_mode=2,  # make message persistent
                 content_type='application/json'
-            )
+            ),
         )
         print(f"Published delivery request for delivery_id={delivery_id}")
         return True
@@ -188,114 +166,18 @@ def create_delivery(origin, destination, destination_time, polyline, organ_type,
         return response.get("data", {}).get("deliveryId")
     return None
 
-# Modify your on_channel_open function to set up consumers
-def on_channel_open(ch):
-    """Callback when the channel has been opened"""
-    global channel
-    channel = ch  # Save channel for later publishing
-    print("Channel opened for publishing and consuming")
-    
-    # Declare exchanges
-    for exchange_name, exchange_type in EXCHANGES.items():
-        print(f"Declaring exchange: {exchange_name} of type {exchange_type}")
-        ch.exchange_declare(exchange=exchange_name, exchange_type=exchange_type, durable=True)
-        
-    # Declare the queue and bind it to the exchange for publishing
-    ch.queue_declare(
-        queue='driver_match_request_queue',
-        durable=True
-    )
-    
-    ch.queue_bind(
-        exchange='driver_match_exchange',
-        queue='driver_match_request_queue',
-        routing_key='driver.request'
-    )
-    
-    # Set up consumers for subscribing
-    for queue in SUBSCRIBE_QUEUES:
-        queue_name = queue["name"]
-        exchange = queue["exchange"]
-        routing_key = queue["routing_key"]
-        
-        print(f"Declaring queue: {queue_name}")
-        ch.queue_declare(queue=queue_name, durable=True)
-        
-        print(f"Binding queue {queue_name} to exchange {exchange} with routing key {routing_key}")
-        ch.queue_bind(
-            exchange=exchange,
-            queue=queue_name,
-            routing_key=routing_key
-        )
-        
-        print(f"Setting up consumer for queue: {queue_name}")
-        ch.basic_consume(
-            queue=queue_name,
-            on_message_callback=handle_message,
-            auto_ack=False
-        )
-    
-    print("Queues declared, bound to exchanges, and consumers set up")
-
-def on_connection_open(conn):
-    """Callback when the connection is opened; create a channel."""
-    global connection
-    connection = conn
-    print("RabbitMQ connection opened")
-    conn.channel(on_open_callback=on_channel_open)
-
-
-def on_connection_closed(conn, reply_code, reply_text=None):
-    """Callback when the connection is closed."""
-    print(f"RabbitMQ connection closed: reply_code={reply_code}, reply_text={reply_text}")
-    global connection, channel
-    connection = None
-    channel = None
-    conn.ioloop.stop()
-
-
-# Rename your main function
-def run_async_rabbitmq():
-    """Set up the asynchronous connection for both publishing and consuming."""
-    print(f"Connecting to RabbitMQ with host={rabbit_host}, port={rabbit_port}")
-    parameters = pika.ConnectionParameters(
-        host=rabbit_host,
-        port=rabbit_port,
-        heartbeat=300,
-        blocked_connection_timeout=300
-    )
-    while True:
-        try:
-            print(f"Attempting to connect to RabbitMQ at {rabbit_host}:{rabbit_port} ...")
-            conn = pika.SelectConnection(
-                parameters=parameters,
-                on_open_callback=on_connection_open,
-                on_close_callback=on_connection_closed
-            )
-            print("Starting IOLoop for RabbitMQ")
-            conn.ioloop.start()
-            break  # Exit the loop if the connection and loop run normally
-        except pika.exceptions.AMQPConnectionError as e:
-            print(f"AMQPConnectionError: {e}. Retrying in 5 seconds...")
-            time.sleep(5)
-        except Exception as e:
-            print(f"Unexpected error: {e}. Retrying in 5 seconds...")
-            time.sleep(5)
-
-
 def handle_message(ch, method, properties, body):
     try:
         print(f"Received message from {method.routing_key}: {body}")
-        message_dict = json.loads(body.decode())
+        order_message = codec.decode_message(body, method.routing_key, properties.content_type)
         
         # Process the message based on the routing key
         if method.routing_key == "order.organ":
             print("Processing order.organ message...")
-            order_id = message_dict.get("orderId")
+            order_id = order_message.order_id
             
             if not order_id:
                 print("No orderId found in message")
-                ch.basic_ack(delivery_tag=method.delivery_tag)
                 return
                 
             # Fetch order details from your order service
@@ -304,7 +186,6 @@ def handle_message(ch, method, properties, body):
             
             if not order_response:
                 print(f"Failed to retrieve order details for order_id: {order_id}")
-                ch.basic_ack(delivery_tag=method.delivery_tag)
                 return
             
             order_details = order_response.get("data", {})
@@ -334,14 +215,12 @@ def handle_message(ch, method, properties, body):
                 
                 if not origin_coord or not destination_coord:
                     print("Failed to convert addresses to coordinates")
-                    ch.basic_ack(delivery_tag=method.delivery_tag)
                     return
 
                 # Get polyline route
                 encoded_polyline = retrieve_polyline(origin_coord, destination_coord)
                 if not encoded_polyline:
                     print("Failed to retrieve polyline")
-                    ch.basic_ack(delivery_tag=method.delivery_tag)
                     return
                 
                 # Create delivery record
@@ -358,7 +237,6 @@ def handle_message(ch, method, properties, body):
                 
                 if not delivery_id:
                     print("Failed to create delivery")
-                    ch.basic_ack(delivery_tag=method.delivery_tag)
                     return
 
                 # Publish driver request to RabbitMQ for asynchronous driver selection
@@ -372,36 +250,36 @@ def handle_message(ch, method, properties, body):
                     "timestamp": time.time()
                 })
 
-                channel.basic_publish(
-                exchange="activity_log_exchange",
-                routing_key="create_delivery.info",
-                body=message,
-                properties=pika.BasicProperties(delivery_mode=2)
-            )
+                publisher.publish(
+                    exchange="activity_log_exchange",
+                    routing_key="create_delivery.info",
+                    body=message,
+                )
                 
             except Exception as inner_e:
                 print(f"Error processing delivery: {inner_e}")
-        
-        # Acknowledge the message
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-        
+
     except Exception as e:
         print(f"Error processing message: {e}")
         error_payload = json.dumps({
             "event": "Error processing message",
-            "error": e,
+            "error": str(e),
             "timestamp": time.time()
         })
 
-        channel.basic_publish(
-        exchange="error_handling_exchange",
-        routing_key="create_delivery.error",
-        body=error_payload,
-        properties=pika.BasicProperties(delivery_mode=2)
-            )
-        
-        # Negative acknowledge with requeue=False
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        publisher.publish(
+            exchange="error_handling_exchange",
+            routing_key="create_delivery.error",
+            body=error_payload,
+        )
+        raise
+
+
+# Failed messages are retried with a delay via the broker-side retry queues, then dead-lettered
+consumer = amqp_lib.AsyncConsumer(
+    rabbit_host, rabbit_port, amqp_lib.consumer_queues("create_delivery"), handle_message,
+    topology=amqp_lib.load_topology()
+)
 
 
 @app.route('/health', methods=['GET'])
@@ -411,8 +289,11 @@ def health_check():
 
 
 # Update your main block
+serving.background(publisher.start, publisher.close)
+serving.background(consumer.start, consumer.stop)
+
 if __name__ == '__main__':
-    # Start the RabbitMQ handler in a separate thread
-    threading.Thread(target=run_async_rabbitmq, daemon=True).start()
+    # Starts the publisher and the RabbitMQ consumer thread
+    serving.start_background()
 
     app.run(host='0.0.0.0', port=5026)
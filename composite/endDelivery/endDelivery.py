@@ -1,14 +1,14 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import requests
+from common import amqp_lib, serving, webapp
 from common.invokes import invoke_http
-import pika
 import os
 import time
-import json
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
+webapp.setup_app(app)
 
 DRIVER_INFO_ENDPOINT = "http://driverInfo_service:5004/drivers"
 DELIVERY_ENDPOINT = "http://delivery_service:5002/deliveryinfo"
@@ -21,7 +21,8 @@ TIMEOUT = 10  # API timeout for requests
 rabbit_host = os.environ.get("rabbit_host", "localhost")
 rabbit_port = int(os.environ.get("rabbit_port", "5672"))
 
-channel = None
+# Shared publisher; reconnects and retries unconfirmed messages on its own thread
+publisher = amqp_lib.Publisher(rabbit_host, rabbit_port)
 
 
 def make_request(url, method="POST", payload=None):
@@ -80,28 +81,12 @@ def update_delivery(delivery_id):
     return None
 
 def safe_publish(exchange, routing_key, message):
-    """Safely publish a message, with connection checks and error handling"""
-    global channel
-    
-    if channel is None or not hasattr(channel, 'basic_publish'):
-        print("Channel not available. Attempting to reconnect...")
-        if not connect_to_rabbitmq():
-            print("Failed to reconnect to RabbitMQ. Message not sent.")
-            return False
-    
+    """Hand a message to the shared publisher; it is buffered until the broker confirms it"""
     try:
-        message_str = message if isinstance(message, str) else json.dumps(message)
-        channel.basic_publish(
-            exchange=exchange,
-            routing_key=routing_key,
-            body=message_str,
-            properties=pika.BasicProperties(delivery_mode=2)
-        )
-        print(f"Message published to {exchange} with routing key {routing_key}")
+        publisher.publish(exchange=exchange, routing_key=routing_key, body=message)
         return True
     except Exception as e:
         print(f"Error publishing message: {e}")
-        channel = None  # Reset channel so next attempt will reconnect
         return False
 
 #Migrate to send to doctor instead to end delivery
@@ -136,25 +121,6 @@ def safe_publish(exchange, routing_key, message):
 #         print(f"Error sending notification: {e}")
 #         return False
 
-def connect_to_rabbitmq():
-    global channel
-    for i in range(5):  # Try 5 times
-        try:
-            print(f"Attempt {i+1} to connect to RabbitMQ at {rabbit_host}:{rabbit_port}")
-            connection = pika.BlockingConnection(
-                pika.ConnectionParameters(host=rabbit_host, port=rabbit_port)
-            )
-            channel = connection.channel()
-            print("Connected to RabbitMQ successfully")
-            return True
-        except Exception as e:
-            print(f"Failed to connect to RabbitMQ: {str(e)}")
-            if i < 4:  # Don't sleep after the last attempt
-                print(f"Retrying in 5 seconds...")
-                time.sleep(5)
-    channel = None
-    return False
-
 @app.route('/endDelivery', methods=['POST'])
 def endDelivery():
     """Ends Delivery with updates to delivery and driver"""
@@ -211,6 +177,8 @@ def health_check():
     """Simple health check endpoint"""
     return jsonify({"status": "healthy"}), 200
 
+serving.background(publisher.start, publisher.close)
+
 if __name__ == '__main__':
-    connect_to_rabbitmq()
+    serving.start_background()
     app.run(host='0.0.0.0', port=5028)
\ No newline at end of file
@@ -2,14 +2,20 @@ import os
 import json
 import uuid
 from flask import Flask, request, jsonify
-from common import amqp_lib  # Reusable AMQP functions
+from common import amqp_lib, serving, webapp  # Reusable AMQP functions
 from common.invokes import invoke_http  # Import the invoke_http function
 from flask_cors import CORS
-import pika
 import random
+import time
+import queue
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, wait
 
 app = Flask(__name__)
 CORS(app)
+webapp.setup_app(app)
 
 rabbitmq_host = os.environ.get("RABBITMQ_HOST") or "localhost"
 rabbitmq_port = int(os.environ.get("RABBITMQ_PORT")) or "5672"
@@ -21,27 +27,34 @@ RECIPIENT_URL = os.environ.get("RECIPIENT_URL", "http://recipient:5013/recipient
 LAB_REPORT_URL = os.environ.get("LAB_REPORT_URL", "http://labInfo:5007/lab-reports") or "http://localhost:5007/lab-reports"
 OUTSYSTEMS_PERSONAL_DATA_URL = os.environ.get("OUTSYSTEMS_PERSONAL_DATA_URL" ) or "https://personal-gbst4bsa.outsystemscloud.com/PatientAPI/rest/patientAPI/patients/"
 
-connection = None 
-channel = None
+# PersonalData, Recipient and LabInfo are written concurrently; all must finish within
+# FANOUT_DEADLINE seconds or the ones that succeeded are deleted again.
+FANOUT_DEADLINE = float(os.environ.get("FANOUT_DEADLINE") or 10)
+STEP_TIMEOUT = float(os.environ.get("STEP_TIMEOUT") or FANOUT_DEADLINE)
+FANOUT_WORKERS = int(os.environ.get("FANOUT_WORKERS") or 16)
+executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="fanout")
+# Best-effort OutSystems copies get their own threads so a batch cannot starve the fan-out pool
+outsystems_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="outsystems")
+
+# Async mode (?async=true or "Prefer: respond-async"): requests wait in a queue of at most
+# ASYNC_QUEUE_SIZE for one of ASYNC_WORKERS pipeline threads; the last ASYNC_MAX_RESULTS
+# outcomes are kept for the status endpoint.
+ASYNC_WORKERS = int(os.environ.get("ASYNC_WORKERS") or 4)
+ASYNC_QUEUE_SIZE = int(os.environ.get("ASYNC_QUEUE_SIZE") or 500)
+ASYNC_MAX_RESULTS = int(os.environ.get("ASYNC_MAX_RESULTS") or 10000)
+# Hosts an async request may name in "callbackUrl" (comma-separated); none by default,
+# so the service cannot be used to POST to arbitrary internal addresses
+ASYNC_CALLBACK_HOSTS = {
+    host.strip().lower() for host in (os.environ.get("ASYNC_CALLBACK_HOSTS") or "").split(",") if host.strip()
+}
+
+# Shared publisher; batches messages and waits for broker confirms in the background
+publisher = amqp_lib.Publisher(rabbitmq_host, rabbitmq_port)
 
 @app.route("/", methods=['GET'])
 def health_check():
     return jsonify({"code": 200, "status": "ok"}), 200
 
-def connectAMQP():
-    global connection, channel
-    print("Connecting to AMQP broker...")
-    try:
-        connection, channel = amqp_lib.connect(
-            hostname=rabbitmq_host,
-            port=rabbitmq_port,
-            exchange_name=exchange_name,
-            exchange_type="direct",
-        )
-    except Exception as e:
-        print(f"Unable to connect to RabbitMQ: {e}")
-        exit(1)
-
 def remove_code_field(response):
     """Helper to remove the 'code' field from a response dictionary."""
     if isinstance(response, dict) and "code" in response:
@@ -60,227 +73,508 @@ def generate_hla_profile():
         profile[locus] = random.sample(alleles, 2)
     return profile # output: {'A': ['A24', 'A3'], 'B': ['B7', 'B27'], 'DR': ['DR11', 'DR1']}
 
-@app.route('/request-for-organ', methods=['POST'])
-def request_for_organ():
-    # Set a default for payload in case request.get_json() fails.
-    global channel
-    if channel is None or channel.is_closed:
-        connectAMQP()
+class StepFailed(Exception):
+    """A pipeline step failed; carries the HTTP response to return to the client."""
+    def __init__(self, status, body):
+        super().__init__(body.get("message") or body.get("error"))
+        self.status = status
+        self.body = body
 
-    payload = {}
+def publish_error(routing_key, body):
+    print("Publishing message with routing key =", routing_key)
+    publisher.publish(exchange="error_handling_exchange", routing_key=routing_key, body=body)
+
+def timed(timings, name, fn, *args, **kwargs):
+    """Run fn and record its latency in milliseconds under timings[name]."""
+    start = time.perf_counter()
     try:
-        payload = request.get_json() or {}
-        data = payload.get("data", {})
-        recipient_data = data.get("recipient", {})
-        lab_info_data = data.get("labInfo", {})
+        return fn(*args, **kwargs)
+    finally:
+        timings[name] = round((time.perf_counter() - start) * 1000, 1)
 
-        # Generate a unique ID for this request.
-        new_uuid = str(uuid.uuid4())
+def pseudonymise(new_uuid, recipient_data, timings):
+    """Call the Pseudonym service; returns (pseudonym_data, masked_data, personal_data)."""
+    pseudonym_payload = {
+        new_uuid: {**recipient_data, "uuid": new_uuid}
+    }
+    pseudonym_resp = timed(timings, "pseudonym", invoke_http, PSEUDONYM_URL, method="POST",
+                           json=pseudonym_payload, timeout=STEP_TIMEOUT)
+    code = pseudonym_resp.get("code", 500)
+    pseudonym_data = pseudonym_resp.get("data", {})
 
-        # Prepare payload for the pseudonym service.
-        pseudonym_payload = {
-            new_uuid: {**recipient_data, "uuid": new_uuid}
-        }
-        responses = {}
-
-        # --- Call the Pseudonym Service ---
-        pseudonym_resp = invoke_http(PSEUDONYM_URL, method="POST", json=pseudonym_payload)
-        code = pseudonym_resp.get("code", 500)
-        pseudonym_data = pseudonym_resp.get("data", {})
-        message = json.dumps(pseudonym_resp)
-
-        if code not in range(200, 300):
-            print("Publishing message with routing key =", "request_pseudo.error")
-            channel.basic_publish(
-                exchange="error_handling_exchange",
-                routing_key="request_pseudo.error",
-                body=message,
-                properties=pika.BasicProperties(delivery_mode=2)
-            )
-            return jsonify({
-                "code": 500,
-                "message": pseudonym_resp.get("message", "Error from pseudonym service")
-            }), 500
-
-        # Remove the code field from the pseudonym response.
-        pseudonym_resp = remove_code_field(pseudonym_resp)
-        responses["pseudonym"] = pseudonym_data
+    if code not in range(200, 300):
+        publish_error("request_pseudo.error", json.dumps(pseudonym_resp))
+        raise StepFailed(500, {
+            "code": 500,
+            "message": pseudonym_resp.get("message", "Error from pseudonym service")
+        })
 
-        # --- Extract Masked Data ---
-        masked_data = pseudonym_data.get("maskedData", {}).get(new_uuid, {})
-        if not masked_data:
-            err_msg = "Pseudonym service did not return masked data"
-            print(err_msg)
-            channel.basic_publish(
-                exchange="error_handling_exchange",
-                routing_key="request_pseudo.error",
-                body=err_msg,
-                properties=pika.BasicProperties(delivery_mode=2)
-            )
-            return jsonify({"error": err_msg}), 500
-
-        # --- Build Personal Data Payload ---
-        personal_data_from_ps = pseudonym_data.get("personalData", {})
-        if not personal_data_from_ps:
-            err_msg = "Pseudonym service did not return personalData"
-            print(err_msg)
-            channel.basic_publish(
-                exchange="error_handling_exchange",
-                routing_key="request_pseudo.error",
-                body=err_msg,
-                properties=pika.BasicProperties(delivery_mode=2)
-            )
-            return jsonify({"error": err_msg}), 500
-
-        personal_payload = {
-            "uuid": new_uuid,
-            "firstName": personal_data_from_ps.get("firstName"),
-            "lastName": personal_data_from_ps.get("lastName"),
-            "dateOfBirth": personal_data_from_ps.get("dateOfBirth"),
-            "nric": personal_data_from_ps.get("nric"),
-            "email": personal_data_from_ps.get("email"),
-            "address": personal_data_from_ps.get("address"),
-            "nokContact": personal_data_from_ps.get("nokContact")
-        }
+    # --- Extract Masked Data ---
+    masked_data = pseudonym_data.get("maskedData", {}).get(new_uuid, {})
+    if not masked_data:
+        err_msg = "Pseudonym service did not return masked data"
+        print(err_msg)
+        publish_error("request_pseudo.error", err_msg)
+        raise StepFailed(500, {"error": err_msg})
 
-        # --- Build Recipient and Lab Payloads ---
-        recipient_payload = {**masked_data, "recipientId": new_uuid}
-        lab_payload = lab_info_data.copy()
-        lab_payload["uuid"] = new_uuid
-        lab_payload["hlaTyping"] = generate_hla_profile()
+    personal_data_from_ps = pseudonym_data.get("personalData", {})
+    if not personal_data_from_ps:
+        err_msg = "Pseudonym service did not return personalData"
+        print(err_msg)
+        publish_error("request_pseudo.error", err_msg)
+        raise StepFailed(500, {"error": err_msg})
 
-        # --- Call the Personal Data Service ---
-        try:
-            os_personal_resp = invoke_http(OUTSYSTEMS_PERSONAL_DATA_URL, method="POST", json=personal_payload)
-            if (os_personal_resp.get("Success") == True):
-                print("Publishing message with routing key =", "stored_os_personal_data.info")
-                channel.basic_publish(
-                    exchange="activity_log_exchange",
-                    routing_key="stored_os_personal_data.info",
-                    body=message,
-                    properties=pika.BasicProperties(delivery_mode=2)
-                )
-        except Exception as e:
-            print("Publishing message with routing key =", "request_personalData.error")
-            channel.basic_publish(
-                exchange="error_handling_exchange",
-                routing_key="request_personalData.error",
-                body=message,
-                properties=pika.BasicProperties(delivery_mode=2)
-            )
-            raise Exception("Failed to store PersonalData on OutSystems")
-
-        personal_resp = invoke_http(PERSONAL_DATA_URL, method="POST", json=personal_payload) # as a backup for now
-        code = personal_resp.get("code", 500)
-        message = json.dumps(personal_resp.get("message", ""))
-        if code not in range(200, 300):
-            print("Publishing message with routing key =", "request_personalData.error")
-            channel.basic_publish(
-                exchange="error_handling_exchange",
-                routing_key="request_personalData.error",
-                body=message,
-                properties=pika.BasicProperties(delivery_mode=2)
-            )
-            return jsonify({
-                "code": 500,
-                "data": {"personal_data_result": pseudonym_resp},
-                "message": "Error handling Personal Data."
-            }), 500
-
-        print("Publishing message with routing key =", "stored_personal_data.info")
-        channel.basic_publish(
+    return pseudonym_data, masked_data, personal_data_from_ps
+
+def build_write_payloads(new_uuid, masked_data, personal_data_from_ps, lab_info_data):
+    """Payloads for the PersonalData, Recipient and LabInfo writes."""
+    personal_payload = {
+        "uuid": new_uuid,
+        "firstName": personal_data_from_ps.get("firstName"),
+        "lastName": personal_data_from_ps.get("lastName"),
+        "dateOfBirth": personal_data_from_ps.get("dateOfBirth"),
+        "nric": personal_data_from_ps.get("nric"),
+        "email": personal_data_from_ps.get("email"),
+        "address": personal_data_from_ps.get("address"),
+        "nokContact": personal_data_from_ps.get("nokContact")
+    }
+    recipient_payload = {**masked_data, "recipientId": new_uuid}
+    lab_payload = lab_info_data.copy()
+    lab_payload["uuid"] = new_uuid
+    lab_payload["hlaTyping"] = generate_hla_profile()
+    return personal_payload, recipient_payload, lab_payload
+
+# Writes that must all succeed: name -> (url, error routing key, failure response key, failure message)
+WRITE_STEPS = {
+    "personal_data": (PERSONAL_DATA_URL, "request_personalData.error", "personal_data_result", "Error handling Personal Data."),
+    "recipient": (RECIPIENT_URL, "request_recipient.error", "recipient_result", "Error handling recipient."),
+    "lab_report": (LAB_REPORT_URL, "request_lab.error", "lab_result", "Error handling Lab Info."),
+}
+
+def store_outsystems(personal_payload):
+    """Best-effort copy of the personal data on OutSystems; never fails the request."""
+    start = time.perf_counter()
+    os_personal_resp = invoke_http(OUTSYSTEMS_PERSONAL_DATA_URL, method="POST", json=personal_payload,
+                                   timeout=STEP_TIMEOUT)
+    print(f"OutSystems personal data took {(time.perf_counter() - start) * 1000:.1f} ms")
+    if os_personal_resp.get("Success") == True:
+        print("Publishing message with routing key =", "stored_os_personal_data.info")
+        publisher.publish(
             exchange="activity_log_exchange",
-            routing_key="stored_personal_data.info",
-            body=message,
-            properties=pika.BasicProperties(delivery_mode=2)
+            routing_key="stored_os_personal_data.info",
+            body=json.dumps({"uuid": personal_payload["uuid"]}),
         )
+    else:
+        publish_error("request_personalData.error", json.dumps(os_personal_resp))
+    return os_personal_resp
 
-        # --- Call the Recipient Service ---
-        recipient_resp = invoke_http(RECIPIENT_URL, method="POST", json=recipient_payload)
-        code = recipient_resp.get("code", 500)
-        message = json.dumps(recipient_resp)
-        if code not in range(200, 300):
-            print("Publishing message with routing key =", "request_recipient.error")
-            channel.basic_publish(
-                exchange="error_handling_exchange",
-                routing_key="request_recipient.error",
-                body=message,
-                properties=pika.BasicProperties(delivery_mode=2)
-            )
-            return jsonify({
-                "code": 500,
-                "data": {"recipient_result": recipient_resp},
-                "message": "Error handling recipient."
-            }), 500
-
-        recipient_resp = remove_code_field(recipient_resp)
-        responses["recipient"] = recipient_resp
-
-        # --- Call the Lab Report Service ---
-        lab_resp = invoke_http(LAB_REPORT_URL, method="POST", json=lab_payload)
-        code = lab_resp.get("code", 500)
-        message = json.dumps(lab_resp)
-
-        if code not in range(200, 300):
-            print("Publishing message with routing key =", "request_lab.error")
-            channel.basic_publish(
-                exchange="error_handling_exchange",
-                routing_key="request_lab.error",
-                body=message,
-                properties=pika.BasicProperties(delivery_mode=2)
-            )
-            return jsonify({
-                "code": 500,
-                "data": {"lab_result": lab_resp},
-                "message": "Error handling Lab Info."
-            }), 500
-
-        lab_resp = remove_code_field(lab_resp)
-        responses["lab_report"] = lab_resp
-
-        # --- Publish Composite Payload for Activity Logging ---
-        composite_for_logging = {}
-        composite_for_logging.update(recipient_data)
-        composite_for_logging.update(lab_info_data)
-        composite_for_logging["recipientId"] = new_uuid
-        message = json.dumps({"recipientId": composite_for_logging["recipientId"]})
-        
-        print("Publishing message with routing key =", routing_key)
-        channel.basic_publish(
-            exchange=exchange_name, 
-            routing_key=routing_key, 
-            body=message,
-            properties=pika.BasicProperties(delivery_mode=2)
-        )
-        print("Publishing message with routing key =", "request_organ.info")
-        channel.basic_publish(
-            exchange="activity_log_exchange",
-            routing_key="request_organ.info",
-            body=message,
-            properties=pika.BasicProperties(delivery_mode=2)
+def compensate(name, new_uuid):
+    """Undo a completed write with a DELETE on the owning service."""
+    url = WRITE_STEPS[name][0]
+    resp = invoke_http(f"{url}/{new_uuid}", method="DELETE", timeout=STEP_TIMEOUT)
+    code = resp.get("code", 500)
+    if code not in range(200, 300) and code != 404:
+        publish_error("request_organ.compensation.error",
+                      json.dumps({"step": name, "uuid": new_uuid, "response": resp}))
+    else:
+        print(f"Compensated {name} for {new_uuid}")
+
+def compensate_when_done(name, new_uuid):
+    """Future callback that undoes a write which completed after the deadline."""
+    def callback(future):
+        if future.exception() is None and future.result().get("code", 500) in range(200, 300):
+            compensate(name, new_uuid)
+    return callback
+
+def write_records(new_uuid, payloads, timings):
+    """
+    Run the PersonalData, Recipient and LabInfo writes (plus the OutSystems copy) concurrently.
+    If any write fails or misses the FANOUT_DEADLINE, the writes that did succeed are deleted
+    again and StepFailed is raised. Returns {step name: response} on success.
+    """
+    futures = {
+        executor.submit(timed, timings, name, invoke_http, WRITE_STEPS[name][0], method="POST",
+                        json=payload, timeout=STEP_TIMEOUT): name
+        for name, payload in zip(WRITE_STEPS, payloads)
+    }
+    outsystems_executor.submit(store_outsystems, payloads[0])
+
+    done, not_done = wait(futures, timeout=FANOUT_DEADLINE)
+    results, failed = {}, []
+    for future in done:
+        name = futures[future]
+        resp = future.result()
+        if resp.get("code", 500) in range(200, 300):
+            results[name] = resp
+        else:
+            failed.append((name, resp))
+            publish_error(WRITE_STEPS[name][1], json.dumps(resp))
+
+    if not failed and not not_done:
+        return results
+
+    for name in results:
+        executor.submit(compensate, name, new_uuid)
+    for future in not_done:
+        name = futures[future]
+        timings[name] = None
+        failed.append((name, {"code": 504, "message": f"{name} did not finish within {FANOUT_DEADLINE}s"}))
+        publish_error(WRITE_STEPS[name][1], json.dumps(failed[-1][1]))
+        # The write may still land after the deadline; undo it when it does
+        future.add_done_callback(compensate_when_done(name, new_uuid))
+
+    name, resp = failed[0]
+    _, _, result_key, message = WRITE_STEPS[name]
+    raise StepFailed(500, {"code": 500, "data": {result_key: resp}, "message": message})
+
+def register_recipient(payload, new_uuid=None):
+    """
+    Run the request-for-organ pipeline for one request body.
+    Returns (response body, HTTP status).
+    """
+    data = payload.get("data", {})
+    recipient_data = data.get("recipient", {})
+    lab_info_data = data.get("labInfo", {})
+    timings = {}
+    start = time.perf_counter()
+
+    # Generate a unique ID for this request.
+    new_uuid = new_uuid or str(uuid.uuid4())
+    responses = {}
+    try:
+        # --- Pseudonymise, then write PersonalData, Recipient and LabInfo in parallel ---
+        pseudonym_data, masked_data, personal_data_from_ps = pseudonymise(new_uuid, recipient_data, timings)
+        responses["pseudonym"] = pseudonym_data
+        payloads = build_write_payloads(new_uuid, masked_data, personal_data_from_ps, lab_info_data)
+        results = write_records(new_uuid, payloads, timings)
+    except StepFailed as e:
+        timings["total"] = round((time.perf_counter() - start) * 1000, 1)
+        print(f"request_for_organ {new_uuid} failed, timings (ms): {dict(timings)}")
+        return e.body, e.status
+
+    print("Publishing message with routing key =", "stored_personal_data.info")
+    publisher.publish(
+        exchange="activity_log_exchange",
+        routing_key="stored_personal_data.info",
+        body=json.dumps(results["personal_data"].get("message", "")),
+    )
+    responses["recipient"] = remove_code_field(results["recipient"])
+    responses["lab_report"] = remove_code_field(results["lab_report"])
+
+    # --- Publish match request and activity log ---
+    message = json.dumps({"recipientId": new_uuid})
+    print("Publishing message with routing key =", routing_key)
+    publisher.publish(exchange=exchange_name, routing_key=routing_key, body=message)
+    print("Publishing message with routing key =", "request_organ.info")
+    publisher.publish(
+        exchange="activity_log_exchange",
+        routing_key="request_organ.info",
+        body=message,
+    )
+
+    timings["total"] = round((time.perf_counter() - start) * 1000, 1)
+    responses["timings"] = dict(timings)
+    print(f"request_for_organ {new_uuid} timings (ms): {responses['timings']}")
+    responses["message"] = "Composite request processed successfully."
+    return {"code": 201, "data": responses}, 201
+
+def publish_exception(error_message, payload):
+    error_payload = json.dumps({
+        "error": error_message,
+        "payload": payload
+    })
+    try:
+        publisher.publish(
+            exchange="error_handling_exchange",
+            routing_key="request_organ.exception",
+            body=error_payload,
         )
+    except Exception as publish_exception:
+        print("Failed to publish error message:", str(publish_exception))
+
+class RequestQueue:
+    """Work queue for async requests; the request id is the recipientId the pipeline will use."""
+
+    def __init__(self, workers, max_queued, max_results):
+        self.workers = workers
+        self.max_results = max_results
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
 
-        responses["message"] = "Composite request processed successfully."
-        return jsonify({"code": 201, "data": responses}), 201
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f"request-organ-{i}", daemon=True).start()
+
+    def stop(self, timeout=15):
+        """Wait up to timeout seconds for queued work to finish."""
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.05)
+
+    def submit(self, payload):
+        """Queue a payload and return its request id; raises queue.Full when there is no room."""
+        request_id = str(uuid.uuid4())
+        self._set(request_id, {"requestId": request_id, "status": "queued", "submitted": time.time()})
+        try:
+            self._queue.put_nowait((request_id, payload))
+        except queue.Full:
+            with self._lock:
+                self._results.pop(request_id, None)
+            raise
+        return request_id
+
+    def get(self, request_id):
+        with self._lock:
+            return self._results.get(request_id)
+
+    def _set(self, request_id, entry):
+        with self._lock:
+            self._results[request_id] = entry
+            self._results.move_to_end(request_id)
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+
+    def _work(self):
+        while True:
+            request_id, payload = self._queue.get()
+            try:
+                self._process(request_id, payload)
+            except Exception as e:
+                # Never let one request take the worker thread down with it
+                print(f"Async request {request_id} failed: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _process(self, request_id, payload):
+        entry = dict(self.get(request_id) or {"requestId": request_id}, status="processing")
+        self._set(request_id, entry)
+        try:
+            body, status = register_recipient(payload, new_uuid=request_id)
+        except Exception as e:
+            print("Error in async request_for_organ:", str(e))
+            publish_exception(str(e), payload)
+            body, status = {"code": 500, "message": "Error processing organ request."}, 500
+        entry = dict(entry, status="completed" if status in range(200, 300) else "failed",
+                     code=status, result=body, finished=time.time())
+        self._set(request_id, entry)
+        callback_url = payload.get("callbackUrl")
+        if callback_url and callback_allowed(callback_url):
+            # Push the outcome to the caller as well; polling still works if this fails
+            try:
+                invoke_http(callback_url, method="POST", json=entry, timeout=STEP_TIMEOUT)
+            except Exception as e:
+                print(f"Callback for async request {request_id} failed: {e}")
+
+def callback_allowed(url):
+    """Whether url is an http(s) URL on one of the ASYNC_CALLBACK_HOSTS."""
+    try:
+        parts = urlsplit(url)
+        host = parts.hostname
+    except (TypeError, ValueError):
+        return False
+    return parts.scheme in ("http", "https") and bool(host) and host.lower() in ASYNC_CALLBACK_HOSTS
+
+request_queue = RequestQueue(ASYNC_WORKERS, ASYNC_QUEUE_SIZE, ASYNC_MAX_RESULTS)
+
+MAX_BATCH = 500
+
+def compensate_batch_when_done(name, record_ids):
+    """Future callback for a batch write that finished after the deadline: undo what it created."""
+    def callback(future):
+        if future.exception() is not None:
+            return
+        items = future.result().get("data")
+        if isinstance(items, list):
+            for record_id, item in zip(record_ids, items):
+                if isinstance(item, dict) and item.get("code") == 201:
+                    compensate(name, record_id)
+    return callback
+
+def register_recipients(records):
+    """
+    Batch version of register_recipient: one Pseudonym call for all records, one batched
+    write per downstream service (run concurrently), then one publish of every match request.
+    A record succeeds only if all three writes succeeded for it; otherwise the writes that
+    did succeed for that record are deleted. Returns (response body, HTTP status).
+    """
+    timings = {}
+    start = time.perf_counter()
+    ids = [str(uuid.uuid4()) for _ in records]
+    results = [{"index": index, "recipientId": record_id} for index, record_id in enumerate(ids)]
+
+    # --- One Pseudonym call for every record ---
+    pseudonym_payload = {
+        record_id: {**(record.get("recipient") or {}), "uuid": record_id}
+        for record_id, record in zip(ids, records)
+    }
+    pseudonym_resp = timed(timings, "pseudonym", invoke_http, f"{PSEUDONYM_URL}/batch", method="POST",
+                           json=pseudonym_payload, timeout=STEP_TIMEOUT)
+    if pseudonym_resp.get("code", 500) not in range(200, 300):
+        publish_error("request_pseudo.error", json.dumps(pseudonym_resp))
+        return {"code": 500, "message": pseudonym_resp.get("message", "Error from pseudonym service")}, 500
+    masked_all = pseudonym_resp.get("data", {}).get("maskedData", {})
+    personal_all = pseudonym_resp.get("data", {}).get("personalData", {})
+
+    pending_indexes, pending_ids, pending_payloads = [], [], []
+    for index, record_id in enumerate(ids):
+        masked_data, personal_data = masked_all.get(record_id), personal_all.get(record_id)
+        if not masked_data or not personal_data:
+            results[index].update(code=500, message="Pseudonym service did not return data for this record")
+            continue
+        lab_info_data = records[index].get("labInfo") or {}
+        pending_indexes.append(index)
+        pending_ids.append(record_id)
+        pending_payloads.append(build_write_payloads(record_id, masked_data, personal_data, lab_info_data))
+
+    # --- Batched PersonalData, Recipient and LabInfo writes, concurrently ---
+    step_results = {}
+    if pending_ids:
+        futures = {
+            executor.submit(timed, timings, name, invoke_http, f"{WRITE_STEPS[name][0]}/batch", method="POST",
+                            json={"data": [payloads[step] for payloads in pending_payloads]},
+                            timeout=STEP_TIMEOUT): name
+            for step, name in enumerate(WRITE_STEPS)
+        }
+        for payloads in pending_payloads:
+            outsystems_executor.submit(store_outsystems, payloads[0])
+
+        done, not_done = wait(futures, timeout=FANOUT_DEADLINE)
+        for future, name in futures.items():
+            if future in done:
+                resp = future.result()
+                items = resp.get("data")
+                if resp.get("code", 500) in range(200, 300) and isinstance(items, list) and len(items) == len(pending_ids):
+                    step_results[name] = items
+                    continue
+                publish_error(WRITE_STEPS[name][1], json.dumps(resp))
+            else:
+                publish_error(WRITE_STEPS[name][1], json.dumps(
+                    {"code": 504, "message": f"{name} batch did not finish within {FANOUT_DEADLINE}s"}))
+                future.add_done_callback(compensate_batch_when_done(name, list(pending_ids)))
+            step_results[name] = None
+
+    # --- Per-record outcome; undo partial writes ---
+    created = []
+    for position, (index, record_id) in enumerate(zip(pending_indexes, pending_ids)):
+        steps = {}
+        for name in WRITE_STEPS:
+            items = step_results.get(name)
+            steps[name] = items[position] if items else {"code": 500, "message": f"{name} batch call failed"}
+        if all(step.get("code") == 201 for step in steps.values()):
+            results[index].update(code=201, message="Recipient registered.")
+            created.append(record_id)
+            continue
+        for name, step in steps.items():
+            if step.get("code") == 201:
+                executor.submit(compensate, name, record_id)
+        results[index].update(code=500, message="Registration failed.", steps=steps)
+
+    # --- Publish every match request and activity log in one batch ---
+    messages = []
+    for record_id in created:
+        message = json.dumps({"recipientId": record_id})
+        messages.append((exchange_name, routing_key, message))
+        messages.append(("activity_log_exchange", "request_organ.info", message))
+    if messages:
+        print(f"Publishing {len(created)} match request(s) with routing key =", routing_key)
+        publisher.publish_many(messages)
+
+    timings["total"] = round((time.perf_counter() - start) * 1000, 1)
+    print(f"request_for_organ batch of {len(records)}: {len(created)} registered, timings (ms): {dict(timings)}")
+    if len(created) == len(records):
+        code = 201
+    elif created:
+        code = 207
+    else:
+        code = 500
+    return {
+        "code": code,
+        "data": {"results": results, "timings": dict(timings)},
+        "message": f"Registered {len(created)} of {len(records)} recipient(s)."
+    }, code
+
+def wants_async():
+    return (request.args.get("async", "").lower() in ("1", "true", "yes")
+            or "respond-async" in request.headers.get("Prefer", ""))
+
+@app.route('/request-for-organ', methods=['POST'])
+def request_for_organ():
+    """
+    Register a recipient and publish a match request.
+    With ?async=true (or "Prefer: respond-async") the request is queued and 202 is returned
+    with a requestId to poll at GET /request-for-organ/<requestId>; an optional "callbackUrl"
+    in the body receives the same status document when processing ends.
+    """
+    # Set a default for payload in case request.get_json() fails.
+    payload = {}
+    try:
+        payload = request.get_json() or {}
+        if not isinstance(payload, dict):
+            return jsonify({"code": 400, "message": "Request body must be a JSON object."}), 400
+        if wants_async():
+            callback_url = payload.get("callbackUrl")
+            if callback_url is not None and not callback_allowed(callback_url):
+                return jsonify({
+                    "code": 400,
+                    "message": "callbackUrl must be an http(s) URL on an allowed host (ASYNC_CALLBACK_HOSTS)."
+                }), 400
+            try:
+                request_id = request_queue.submit(payload)
+            except queue.Full:
+                return jsonify({"code": 503, "message": "Too many pending requests, try again later."}), 503
+            response = jsonify({
+                "code": 202,
+                "data": {"requestId": request_id, "status": "queued"},
+                "message": "Request accepted for processing."
+            })
+            response.headers["Location"] = f"/request-for-organ/{request_id}"
+            return response, 202
+        body, status = register_recipient(payload)
+        return jsonify(body), status
 
     except Exception as e:
         error_message = str(e)
         print("Error in request_for_organ:", error_message)
-        error_payload = json.dumps({
-            "error": error_message,
-            "payload": payload
-        })
-        try:
-            channel.basic_publish(
-                exchange="error_handling_exchange",
-                routing_key="request_organ.exception",
-                body=error_payload,
-                properties=pika.BasicProperties(delivery_mode=2)
-            )
-        except Exception as publish_exception:
-            print("Failed to publish error message:", str(publish_exception))
+        publish_exception(error_message, payload)
         return jsonify({"code": 500, "message": "Error processing organ request."}), 500
 
+@app.route('/request-for-organ/batch', methods=['POST'])
+def request_for_organ_batch():
+    """
+    Register many recipients: {"data": [{"recipient": {...}, "labInfo": {...}}, ...]}.
+    Returns one result per record, in order (201 all registered, 207 some, 500 none).
+    """
+    payload = {}
+    try:
+        payload = request.get_json() or {}
+        records = payload.get("data")
+        if not isinstance(records, list) or not records:
+            return jsonify({"code": 400, "message": "data must be a non-empty list."}), 400
+        if len(records) > MAX_BATCH:
+            return jsonify({"code": 400, "message": f"At most {MAX_BATCH} records per batch."}), 400
+        if not all(isinstance(record, dict) for record in records):
+            return jsonify({"code": 400, "message": "Every record must be an object."}), 400
+        body, status = register_recipients(records)
+        return jsonify(body), status
+
+    except Exception as e:
+        error_message = str(e)
+        print("Error in request_for_organ_batch:", error_message)
+        publish_exception(error_message, {"records": len(payload.get("data") or [])})
+        return jsonify({"code": 500, "message": "Error processing organ request batch."}), 500
+
+@app.route('/request-for-organ/<string:request_id>', methods=['GET'])
+def get_request_status(request_id):
+    """Status of an async request: queued, processing, completed or failed (with the result)."""
+    entry = request_queue.get(request_id)
+    if entry is None:
+        return jsonify({"code": 404, "message": f"Request {request_id} not found."}), 404
+    return jsonify({"code": 200, "data": entry}), 200
+
+serving.background(publisher.start, publisher.close)
+serving.background(request_queue.start, request_queue.stop)
+
 if __name__ == '__main__':
-    connectAMQP()
-    app.run(host='0.0.0.0', port=5021, debug=True)
+    serving.start_background()
+    app.run(host='0.0.0.0', port=5021, debug=True, use_reloader=False)
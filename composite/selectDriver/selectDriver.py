@@ -2,16 +2,16 @@ from flask import Flask, request, jsonify
 from flask_cors import CORS
 import requests
 import random
+from common import amqp_lib, codec, serving, webapp
 from common.invokes import invoke_http
 import os
-import ast
 import pika
 import json
-import threading
 import time
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
+webapp.setup_app(app)
 
 DRIVER_INFO_ENDPOINT = "http://driverInfo_service:5004/drivers"
 DELIVERY_ENDPOINT = "http://delivery_service:5002/deliveryinfo"
@@ -22,20 +22,9 @@ Route_ENDPOINT = "https://zsq.outsystemscloud.com/Location/rest/Location/route"
 rabbit_host = os.environ.get("rabbit_host", "rabbitmq")
 rabbit_port = int(os.environ.get("rabbit_port", "5672"))
 
-# Exchanges and queues configuration
-EXCHANGES = {
-    "driver_match_exchange": "direct", # Publish driver match request
-    "notification_status_exchange": "topic"  # Add exchange for notification status
-}
+# Shared publisher; safe to use from Flask request threads and the consumer thread
+publisher = amqp_lib.Publisher(rabbit_host, rabbit_port)
 
-SUBSCRIBE_QUEUES = [
-    {"name": "driver_match_request_queue", "exchange": "driver_match_exchange", "routing_key": "driver.request", "type": "direct"}
-]
-
-# Global channel for publishing messages (set when the channel opens)
-channel = None
-
-MAX_RETRIES = 3  # Maximum number of retries for message processing
 HEADERS = {'Content-Type': 'application/json'}
 TIMEOUT = 10  # API timeout for requests
 
@@ -71,11 +60,11 @@ def make_request(url, method="POST", payload=None):
 
 def handle_message(ch, method, properties, body):
     try:
-        message_dict = ast.literal_eval(body.decode())
-        print(f"Received message from {method.routing_key}: {message_dict}")
-        delivery_id = message_dict.get("deliveryId")
-        origin_address = message_dict.get("origin_address")
-        destination_address = message_dict.get("destination_address")
+        message = codec.decode_message(body, method.routing_key, properties.content_type)
+        print(f"Received message from {method.routing_key}: {message}")
+        delivery_id = message.delivery_id
+        origin_address = message.origin_address
+        destination_address = message.destination_address
         
         print(f"Processing delivery request: id={delivery_id}, origin={origin_address}, destination={destination_address}")
         
@@ -96,16 +85,12 @@ def handle_message(ch, method, properties, body):
                 "timestamp": time.time()
             })
 
-            channel.basic_publish(
-            exchange="activity_log_exchange",
-            routing_key="select_driver.info",
-            body=message,
-            properties=pika.BasicProperties(delivery_mode=2)
-        )
-            
-        # Acknowledge the message after successful processing.
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-    
+            publisher.publish(
+                exchange="activity_log_exchange",
+                routing_key="select_driver.info",
+                body=message,
+            )
+
     except Exception as e:
         print(f"Error while handling message: {e}")
 
@@ -115,103 +100,18 @@ def handle_message(ch, method, properties, body):
             "timestamp": time.time()
         })
 
-        channel.basic_publish(
-        exchange="error_handling_exchange",
-        routing_key="select_driver.error",
-        body=error_payload,
-        properties=pika.BasicProperties(delivery_mode=2)
-            )
-        
-        # Retrieve current retry count from headers, defaulting to 0 if not present.
-        retry_count = 0
-        if properties.headers and 'x-retry-count' in properties.headers:
-            retry_count = properties.headers['x-retry-count']
-        print(f"Current retry count: {retry_count}")
-
-        if retry_count < MAX_RETRIES:
-            # Increase the retry count.
-            new_retry_count = retry_count + 1
-
-            # Create new properties with the updated retry count.
-            new_properties = pika.BasicProperties(
-                headers={"x-retry-count": new_retry_count},
-                delivery_mode=properties.delivery_mode  # Preserve persistence if set.
-            )
-
-            # Republish the message with the updated headers.
-            print(f"Republishing message, retry attempt {new_retry_count}")
-            ch.basic_publish(
-                exchange=method.exchange,
-                routing_key=method.routing_key,
-                body=body,
-                properties=new_properties
-            )
-            # Acknowledge the current message so it is removed from the queue.
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-        else:
-            print("Max retries reached. Discarding message or sending to dead-letter queue.")
-            # Here you could also publish the message to a dead-letter queue instead.
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-
-def on_channel_open(ch):
-    """Callback when the channel has been opened; set up consumers for all queues."""
-    global channel
-    channel = ch  # Save channel for later publishing
-    print("Channel opened, setting up consumers...")
-    for queue in SUBSCRIBE_QUEUES:
-        print(f"Subscribing to queue: {queue['name']}")
-        ch.basic_consume(
-            queue=queue["name"],
-            on_message_callback=handle_message,
-            auto_ack=False
+        publisher.publish(
+            exchange="error_handling_exchange",
+            routing_key="select_driver.error",
+            body=error_payload,
         )
-    print("Consumers are set up. Waiting for messages...")
-
-def on_connection_open(conn):
-    """Callback when the connection is opened; create a channel."""
-    global connection
-    connection = conn
-    print("RabbitMQ connection opened")
-    conn.channel(on_open_callback=on_channel_open)
-
-def on_connection_closed(conn, reply_code, reply_text=None):
-    """Callback when the connection is closed."""
-    print(f"RabbitMQ connection closed: reply_code={reply_code}, reply_text={reply_text}")
-    global connection, channel
-    connection = None
-    channel = None
-    conn.ioloop.stop()
-
-def run_async_consumer():
-    """Set up the asynchronous connection for consuming and start the IOLoop with a retry loop."""
-    parameters = pika.ConnectionParameters(
-        host=rabbit_host,
-        port=rabbit_port,
-        heartbeat=300,
-        blocked_connection_timeout=300
-    )
-    
-    while True:
-        try:
-            print(f"Attempting to connect to RabbitMQ at {rabbit_host}:{rabbit_port} ...")
-            conn = pika.SelectConnection(
-                parameters=parameters,
-                on_open_callback=on_connection_open,
-                on_close_callback=on_connection_closed
-            )
-            print("Starting IOLoop for consumer")
-            conn.ioloop.start()
-            break  # Exit the loop if the connection and loop run normally
-        except pika.exceptions.AMQPConnectionError as e:
-            print(f"AMQPConnectionError: {e}. Retrying in 5 seconds...")
-            time.sleep(5)
-        except Exception as e:
-            print(f"Unexpected error: {e}. Retrying in 5 seconds...")
-            time.sleep(5)
-
-def ensure_exchange_exists(channel, exchange, exchange_type):
-    # Declare the exchange (it will only create it if it does not already exist)
-    channel.exchange_declare(exchange=exchange, exchange_type=exchange_type, durable=True)
+        raise
+
+# Failed messages are retried with a delay via the broker-side retry queues, then dead-lettered
+consumer = amqp_lib.AsyncConsumer(
+    rabbit_host, rabbit_port, amqp_lib.consumer_queues("select_driver"), handle_message,
+    topology=amqp_lib.load_topology()
+)
 
 # Method to update driver records with assigned delivery
 def update_driver(driver_id, delivery_id):
@@ -243,10 +143,6 @@ def update_delivery(delivery_id, driver_id):
 def send_driver_notification(driver_id, driver_email, status):
     """Send notification about driver assignment via AMQP"""
     try:
-        if not channel:
-            print("RabbitMQ channel not available. Cannot send notification.")
-            return False
-            
         message = {
             "driverId": driver_id,
             "email": driver_email
@@ -256,14 +152,14 @@ def send_driver_notification(driver_id, driver_email, status):
         routing_key = f"{status}.acknowledge"
         
         print(f"Sending notification with routing key: {routing_key}")
-        channel.basic_publish(
+        publisher.publish(
             exchange="notification_acknowledge_exchange",
             routing_key=routing_key,
             body=json.dumps(message),
             properties=pika.BasicProperties(
                 delivery_mode=2,  # Make message persistent
                 content_type='application/json'
-            )
+            ),
         )
         print(f"Notification sent for driver {driver_id}")
         return True
@@ -405,12 +301,11 @@ def acknowledge_driver():
             "timestamp": time.time()
         })
 
-        channel.basic_publish(
-        exchange="activity_log_exchange",
-        routing_key="select_driver.info",
-        body=message,
-        properties=pika.BasicProperties(delivery_mode=2)
-    )
+        publisher.publish(
+            exchange="activity_log_exchange",
+            routing_key="select_driver.info",
+            body=message,
+        )
     
         return jsonify({
             "code": 200,
@@ -425,12 +320,11 @@ def acknowledge_driver():
             "timestamp": time.time()
         })
 
-        channel.basic_publish(
-        exchange="error_handling_exchange",
-        routing_key="select_driver.error",
-        body=error_payload,
-        properties=pika.BasicProperties(delivery_mode=2)
-            )
+        publisher.publish(
+            exchange="error_handling_exchange",
+            routing_key="select_driver.error",
+            body=error_payload,
+        )
         
         return jsonify({"error": str(e)}), 500
 
@@ -545,9 +439,11 @@ def health_check():
     return jsonify({"status": "healthy"}), 200
 
 
+serving.background(publisher.start, publisher.close)
+serving.background(consumer.start, consumer.stop)
+
 if __name__ == '__main__':
-    # Start RabbitMQ consumer in a separate thread
-    consumer_thread = threading.Thread(target=run_async_consumer, daemon=True)
-    consumer_thread.start()
+    # Starts the publisher and the RabbitMQ consumer thread
+    serving.start_background()
     
     app.run(host='0.0.0.0', port=5024)
\ No newline at end of file
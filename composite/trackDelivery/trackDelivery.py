@@ -2,12 +2,12 @@ from flask import Flask, request, jsonify
 from flask_cors import CORS
 import requests
 import os
-import pika
 import json
-import time
+from common import amqp_lib, serving, webapp
 
 app = Flask(__name__)
 CORS(app)
+webapp.setup_app(app)
 
 # Define service endpoints
 SERVICE_URLS = {
@@ -24,7 +24,8 @@ HEADERS = {'Content-Type': 'application/json'}
 rabbit_host = os.environ.get("rabbit_host", "localhost")
 rabbit_port = int(os.environ.get("rabbit_port", "5672"))
 
-channel = None
+# Shared publisher; reconnects and retries unconfirmed messages on its own thread
+publisher = amqp_lib.Publisher(rabbit_host, rabbit_port)
 
 def addressToCoord(address):
     """Convert an address to latitude/longitude coordinates."""
@@ -104,49 +105,14 @@ def updateDelivery(encoded_polyline, driverCoord, deliveryId):
         print(f"Error in updateDelivery: {e}")
         return False
     
-def connect_to_rabbitmq():
-    global channel
-    for i in range(5):  # Try 5 times
-        try:
-            print(f"Attempt {i+1} to connect to RabbitMQ at {rabbit_host}:{rabbit_port}")
-            connection = pika.BlockingConnection(
-                pika.ConnectionParameters(host=rabbit_host, port=rabbit_port)
-            )
-            channel = connection.channel()
-            print("Connected to RabbitMQ successfully")
-            return True
-        except Exception as e:
-            print(f"Failed to connect to RabbitMQ: {str(e)}")
-            if i < 4:  # Don't sleep after the last attempt
-                print(f"Retrying in 5 seconds...")
-                time.sleep(5)
-    channel = None
-    return False
-
 def safe_publish(exchange, routing_key, message):
-    """Safely publish a message, with connection checks and error handling"""
-    global channel
-    
-    if channel is None:
-        print("Channel not available. Attempting to reconnect...")
-        if not connect_to_rabbitmq():
-            print("Failed to reconnect to RabbitMQ. Message not sent.")
-            return False
-    
+    """Hand a message to the shared publisher; it is buffered until the broker confirms it"""
     try:
-        message_str = message if isinstance(message, str) else json.dumps(message)
-        channel.basic_publish(
-            exchange=exchange,
-            routing_key=routing_key,
-            body=message_str,
-            properties=pika.BasicProperties(delivery_mode=2)
-        )
-        print(f"Message published to {exchange} with routing key {routing_key}")
+        publisher.publish(exchange=exchange, routing_key=routing_key, body=message)
         return True
     except Exception as e:
         print(f"Error publishing message: {e}")
-        channel = None  # Reset channel so next attempt will reconnect
-        pass
+        return False
 
 def getPercentageProgress(originCoord, destinationCoord, currentCoord):
     """Retrieve a progress given 3 points, start, end, current based on travel duration"""
@@ -207,10 +173,6 @@ def getPercentageProgress(originCoord, destinationCoord, currentCoord):
 def send_driver_notification(driver_id, driver_email, status):
     """Send notification about driver assignment via AMQP"""
     try:
-        if not channel:
-            print("RabbitMQ channel not available. Cannot send notification.")
-            return False
-            
         message = {
             "driverId": driver_id,
             "email": driver_email
@@ -342,6 +304,8 @@ def health_check():
     """Simple health check endpoint."""
     return jsonify({"status": "healthy"}), 200
 
+serving.background(publisher.start, publisher.close)
+
 if __name__ == '__main__':
-    connect_to_rabbitmq()
+    serving.start_background()
     app.run(host='0.0.0.0', port=5025)